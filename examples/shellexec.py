@@ -38,7 +38,7 @@ class ShellExec(Worker):
         self.ack(basic_deliver)
         corr_id = str(properties.correlation_id)
         # Notify we are starting
-        self.send(properties.reply_to, corr_id, {'status': 'started'}, exchange='')
+        self.started(properties)
 
         # Start the ls
         command = ['/bin/ls', '-la']
@@ -54,11 +54,11 @@ class ShellExec(Worker):
         for line in process.communicate():
             output.info(line[:-1])
 
-        output.debug('return value: %s' % process.returncode)
+        output.debug('return value: %s', process.returncode)
 
         # Notify the final state based on the return code
         if process.returncode == 0:
-            self.send(properties.reply_to, corr_id, {'status': 'completed'}, exchange='')
+            self.completed(properties)
             # Notify on result. Not required but nice to do.
             self.notify(
                 'ShellExec Executed Successfully',
@@ -68,7 +68,7 @@ class ShellExec(Worker):
                 corr_id)
 
         else:
-            self.send(properties.reply_to, corr_id, {'status': 'failed'}, exchange='')
+            self.failed(properties)
             # Notify on result. Not required but nice to do.
             self.notify(
                 'ShellExec Failed',
@@ -46,6 +46,11 @@ setup(
     },
     packages=find_packages('src'),
     install_requires=reqs,
+    extras_require={
+        'async': ['trollius'],
+        'fastjson': ['ujson'],
+        'msgpack': ['msgpack'],
+    },
     classifiers=[
         ('License :: OSI Approved :: GNU Affero General Public '
          'License v3 or later (AGPLv3+)'),
@@ -0,0 +1,115 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Acknowledgement batching.
+"""
+
+import collections
+
+
+class AckBatcher(object):
+    """
+    Collects completed delivery tags so they can be acked together with
+    multiple=True.
+
+    A multiple ack covers every outstanding tag up to it, so it may only be
+    used for the longest run of delivered tags which have all completed.
+    Tags which complete out of order wait for the gap in front of them to
+    close, or are acked one by one on a full flush.
+    """
+
+    def __init__(self, size=50, interval=0.5):
+        """
+        Creates an instance of AckBatcher.
+
+        size is how many completed tags trigger a flush.
+        interval is the most seconds a completed tag should wait for an ack.
+        """
+        self.size = size
+        self.interval = interval
+        self._delivered = collections.deque()
+        self._done = set()
+        self._rejected = set()
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Creates an instance from the 'ack_batch' worker config section.
+        """
+        return cls(
+            size=config.get('size', 50),
+            interval=config.get('interval', 0.5))
+
+    def __len__(self):
+        """
+        Number of completed tags waiting for an ack.
+        """
+        return len(self._done)
+
+    def reset(self):
+        """
+        Forgets everything. Used when the channel the tags belong to closes.
+        """
+        self._delivered.clear()
+        self._done.clear()
+        self._rejected.clear()
+
+    def delivered(self, delivery_tag):
+        """
+        Records a new delivery. Tags must be recorded in delivery order.
+        """
+        self._delivered.append(delivery_tag)
+
+    def completed(self, delivery_tag):
+        """
+        Records a tag which should be acked. Returns True when enough tags
+        are waiting that a flush should happen now.
+        """
+        self._done.add(delivery_tag)
+        return len(self._done) >= self.size
+
+    def rejected(self, delivery_tag):
+        """
+        Records a tag which was rejected so it no longer blocks the run.
+        """
+        self._rejected.add(delivery_tag)
+
+    def flush(self, full=False):
+        """
+        Returns (multiple_tag, single_tags). multiple_tag is the tag to ack
+        with multiple=True, or None. single_tags are tags to ack one by one
+        which is only done when full is True.
+        """
+        multiple_tag = None
+        while self._delivered:
+            tag = self._delivered[0]
+            if tag in self._done:
+                self._done.discard(tag)
+                multiple_tag = tag
+            elif tag in self._rejected:
+                self._rejected.discard(tag)
+            else:
+                break
+            self._delivered.popleft()
+
+        single_tags = []
+        if full and self._done:
+            single_tags = sorted(self._done)
+            self._done.clear()
+            if self._delivered:
+                remaining = set(single_tags)
+                self._delivered = collections.deque(
+                    t for t in self._delivered if t not in remaining)
+        return (multiple_tag, single_tags)
@@ -0,0 +1,324 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+The asyncio worker class.
+"""
+
+import threading
+import time
+
+try:
+    import asyncio
+except ImportError:
+    try:
+        import trollius as asyncio
+    except ImportError:
+        asyncio = None
+
+from reworker.confirms import Confirmation
+from reworker.worker import Worker
+
+if asyncio is not None:
+    # asyncio.async is a syntax error on newer Pythons so look it up
+    ensure_future = getattr(asyncio, 'ensure_future', None) or \
+        getattr(asyncio, 'async')
+    current_task = getattr(asyncio, 'current_task', None) or \
+        asyncio.Task.current_task
+
+
+class AsyncWorker(Worker):
+    """
+    Parent class for workers whose process is a coroutine.
+
+    Deliveries run as tasks on an event loop in a background thread so many
+    can be in flight at once. Use prefetch in the worker config to bound
+    how many. ack, reject, send, notify and the status shortcuts return
+    futures which may be awaited (yield From on trollius) and resolve once
+    the call has been made on the connection, or once the broker confirms
+    the publish when publisher confirms are enabled. Output calls are fire
+    and forget.
+
+    Requires asyncio or the trollius backport.
+    """
+
+    def __init__(self, mq_config, config_file=None,
+                 logger=None, **kwargs):
+        """
+        Creates an instance of an AsyncWorker. Takes the same arguments as
+        Worker.
+        """
+        if asyncio is None:
+            raise ImportError('AsyncWorker requires asyncio or trollius.')
+        self._loop = asyncio.new_event_loop()
+        self._loop_thread = threading.Thread(
+            target=self._run_loop, name='%s-loop' % (
+                self.__class__.__name__.lower()))
+        self._loop_thread.daemon = True
+        self._loop_thread.start()
+        # Per message state (notify config and dedup keys) per task as all
+        # messages share a thread. _handling is the state of the message
+        # being handled outside of its task and _corr_states the latest
+        # state per correlation id for tasks process() starts itself.
+        self._task_states = {}
+        self._handling = None
+        self._corr_states = {}
+        super(AsyncWorker, self).__init__(
+            mq_config, config_file=config_file, logger=logger, **kwargs)
+
+    def _run_loop(self):
+        """
+        Runs the event loop. Executes on the loop thread.
+        """
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_forever()
+
+    def _uses_threads(self):
+        """
+        Messages always run on the loop thread.
+        """
+        return True
+
+    def _run_message(self, channel, basic_deliver, properties, body,
+                     generation=None):
+        """
+        Hands the delivery to the event loop.
+        """
+        self._loop.call_soon_threadsafe(
+            self._start_message, channel, basic_deliver, properties, body,
+            generation)
+
+    def _start_message(self, channel, basic_deliver, properties, body,
+                       generation=None):
+        """
+        Prepares the message and starts process as a task. Runs on the loop
+        thread.
+        """
+        corr_id = str(properties.correlation_id)
+        state = self._handling = {'dedup_keys': {}, 'generation': generation}
+        self._corr_states[corr_id] = state
+        try:
+            body, output = self._begin(properties, body, corr_id)
+            task = ensure_future(
+                self.process(channel, basic_deliver, properties, body, output),
+                loop=self._loop)
+            self._task_states[task] = state
+        except ValueError, vex:
+            self._parse_failed(basic_deliver, properties, corr_id, vex)
+            self._message_finished(corr_id, basic_deliver, state)
+            return
+        except Exception, ex:
+            self._process_failed(basic_deliver, properties, corr_id, ex)
+            self._message_finished(corr_id, basic_deliver, state)
+            return
+        else:
+            # Still handling so the deadline picks up the generation
+            self._start_deadline(basic_deliver, properties, body, task)
+        finally:
+            self._handling = None
+
+        started = time.time()
+        task.add_done_callback(
+            lambda t: self._task_done(
+                t, basic_deliver, properties, corr_id, output, started))
+
+    def _task_done(self, task, basic_deliver, properties, corr_id, output,
+                   started):
+        """
+        Reports the result of a process task. Runs on the loop thread.
+        """
+        state = self._handling = self._task_states.pop(task, None)
+        try:
+            if task.cancelled():
+                self.app_logger.warn('Processing of %s was cancelled.' % (
+                    corr_id))
+            else:
+                ex = task.exception()
+                if isinstance(ex, KeyError):
+                    self._missing_key(properties, corr_id, output, ex)
+                elif isinstance(ex, ValueError):
+                    self._parse_failed(basic_deliver, properties, corr_id, ex)
+                elif ex is not None:
+                    self._process_failed(
+                        basic_deliver, properties, corr_id, ex)
+            self._end(corr_id, output, started)
+        finally:
+            self._handling = None
+            self._message_finished(corr_id, basic_deliver, state)
+
+    def _message_finished(self, corr_id, basic_deliver, state=None):
+        """
+        Forgets per message state and counts the message done.
+        """
+        if state is not None and self._corr_states.get(corr_id) is state:
+            del self._corr_states[corr_id]
+        self._callbacks.call(
+            self._message_done, corr_id, basic_deliver.delivery_tag,
+            (state or {}).get('generation'))
+
+    def _cancel_running(self, running):
+        """
+        Cancels the task of an expired message.
+        """
+        if running is not None:
+            self._loop.call_soon_threadsafe(running.cancel)
+
+    def _state(self, corr_id):
+        """
+        Returns the state of the message being processed. That is the state
+        of the running task, or of the message being handled outside of its
+        task, or else the latest state for corr_id.
+        """
+        if threading.current_thread() is self._loop_thread:
+            state = self._task_states.get(current_task(loop=self._loop))
+            if state is not None:
+                return state
+            if self._handling is not None:
+                return self._handling
+        return self._corr_states.get(str(corr_id), {})
+
+    def _set_notify_config(self, corr_id, notify_cfg):
+        """
+        Stores the notify section of the message being processed.
+        """
+        self._state(corr_id)['notify_cfg'] = notify_cfg
+
+    def _get_notify_config(self, corr_id):
+        """
+        Returns the notify section of the message being processed.
+        """
+        return self._state(corr_id).get('notify_cfg', {})
+
+    def _get_generation(self):
+        """
+        Returns the channel generation of the message being processed, or
+        None.
+        """
+        return self._state(None).get('generation')
+
+    def _set_dedup_key(self, corr_id, key):
+        """
+        Stores the dedup key of the message being processed.
+        """
+        self._state(corr_id).setdefault('dedup_keys', {})[corr_id] = key
+
+    def _get_dedup_key(self, corr_id):
+        """
+        Returns the dedup key of the message being processed for corr_id.
+        """
+        return self._state(corr_id).get('dedup_keys', {}).get(str(corr_id))
+
+    def _future(self):
+        """
+        Returns a new future bound to the event loop.
+        """
+        return asyncio.Future(loop=self._loop)
+
+    def _resolve(self, future, result=None, exception=None):
+        """
+        Resolves future from any thread.
+        """
+        def _set():
+            if future.done():
+                return
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(result)
+        self._loop.call_soon_threadsafe(_set)
+
+    def _call_on_ioloop(self, func, *args):
+        """
+        Calls func on the ioloop thread. Returns a future for its result.
+        """
+        future = self._future()
+
+        def _call():
+            try:
+                self._resolve(future, func(*args))
+            except Exception, ex:
+                self._resolve(future, exception=ex)
+        self._callbacks.call(_call)
+        return future
+
+    def ack(self, basic_deliver):
+        """
+        Shortcut for acking. Returns a future.
+        """
+        return self._call_on_ioloop(
+            self._basic_ack, basic_deliver.delivery_tag,
+            self._get_generation())
+
+    def reject(self, basic_deliver, requeue=False):
+        """
+        Reject the message with the given `basic_deliver`. Returns a future.
+        """
+        return self._call_on_ioloop(
+            self._basic_reject, basic_deliver.delivery_tag, requeue,
+            self._get_generation())
+
+    def notify(self, *args, **kwargs):
+        """
+        Shortcut for sending a notification. Returns a future which
+        resolves once every notification has been sent.
+        """
+        futures = super(AsyncWorker, self).notify(*args, **kwargs)
+        if not futures:
+            future = self._future()
+            self._resolve(future, [])
+            return future
+        return asyncio.gather(*futures)
+
+    def _publish(self, topic, corr_id, body, exchange='re', reply_to='log'):
+        """
+        Publishes an already serialized body. Returns a future which
+        resolves to True once published, or to the broker's answer when
+        publisher confirms are enabled.
+        """
+        props = self._get_properties(corr_id, reply_to)
+        confirmation = None
+        if self._confirms is not None:
+            confirmation = Confirmation()
+        future = self._future()
+
+        def _call(publish):
+            try:
+                publish(exchange, topic, body, props, confirmation)
+            except Exception, ex:
+                self._resolve(future, exception=ex)
+                return
+            if confirmation is None:
+                self._resolve(future, True)
+            else:
+                confirmation.add_done_callback(
+                    lambda c: self._resolve(future, c.acked))
+        if self._spool is None or self._callbacks.in_ioloop():
+            self._callbacks.call(_call, self._basic_publish)
+            return future
+        with self._spool_lock:
+            if self._channel is None:
+                # Journaled now rather than queued, as in Worker._publish
+                _call(self._spool_publish)
+            else:
+                self._callbacks.call(_call, self._basic_publish)
+        return future
+
+    def process(self, channel, basic_deliver, properties, body, output):
+        """
+        Subclass must override this with a coroutine implementing their
+        logic.
+
+        **Note**: Body is already decoded (json unless another content type).
+        """
+        raise NotImplementedError('process must be implemented.')
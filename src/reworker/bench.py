@@ -0,0 +1,284 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Throughput benchmarks for workers run against the in memory broker.
+
+Run with: python -m reworker.bench [-n MESSAGES] [-s SCENARIO ...]
+"""
+
+import gc
+import json
+import logging
+import os
+import tempfile
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+import pika.spec
+
+from reworker.fake import FakeBroker
+from reworker.worker import Worker
+
+#: Connection settings handed to benchmarked workers. Nothing connects.
+MQ_CONFIG = {
+    'server': 'localhost',
+    'vhost': '/',
+    'user': 'guest',
+    'password': 'guest',
+}
+
+#: Body of every benchmark message
+BODY = json.dumps({
+    'notify': {'completed': {'irc': ['#bench']}},
+    'group': 'bench',
+    'parameters': {'command': 'bench', 'subcommand': 'run'},
+    'dynamic': {}})
+
+
+class _BenchWorker(Worker):
+    """
+    Records how long each stage of a message takes.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.stages = {'decode': [], 'process': []}
+        super(_BenchWorker, self).__init__(*args, **kwargs)
+
+    def _begin(self, properties, body, corr_id):
+        started = time.time()
+        result = super(_BenchWorker, self)._begin(properties, body, corr_id)
+        self.stages['decode'].append(time.time() - started)
+        return result
+
+    def process(self, channel, basic_deliver, properties, body, output):
+        started = time.time()
+        self.work(basic_deliver, properties, body, output)
+        self.stages['process'].append(time.time() - started)
+
+    def work(self, basic_deliver, properties, body, output):
+        raise NotImplementedError('work must be implemented.')
+
+
+class AckWorker(_BenchWorker):
+    """
+    Acks and does nothing else.
+    """
+
+    def work(self, basic_deliver, properties, body, output):
+        self.ack(basic_deliver)
+
+
+class StatusWorker(_BenchWorker):
+    """
+    Sends statuses and a few lines of output like a typical step.
+    """
+
+    def work(self, basic_deliver, properties, body, output):
+        self.ack(basic_deliver)
+        self.started(properties)
+        for num in range(3):
+            output.info('step %s of %s: %s', num, 3, body['group'])
+        self.completed(properties)
+
+
+class NotifyWorker(_BenchWorker):
+    """
+    Sends a notification and a completed status.
+    """
+
+    def work(self, basic_deliver, properties, body, output):
+        self.ack(basic_deliver)
+        self.notify('bench', 'finished', 'completed', properties.correlation_id)
+        self.completed(properties)
+
+
+#: name -> (worker class, worker config)
+SCENARIOS = {
+    'ack': (AckWorker, {}),
+    'status': (StatusWorker, {}),
+    'status-buffered': (StatusWorker, {'output_buffer': {}}),
+    'status-pool': (StatusWorker, {'concurrency': 4, 'prefetch': 32}),
+    'notify': (NotifyWorker, {}),
+}
+
+
+def percentiles(samples, points=(50, 90, 99)):
+    """
+    Returns a dictionary of the given percentiles, and max, of samples.
+    """
+    result = {}
+    if not samples:
+        return result
+    ordered = sorted(samples)
+    for point in points:
+        index = min(len(ordered) - 1, int(len(ordered) * point / 100.0))
+        result['p%s' % point] = ordered[index]
+    result['max'] = ordered[-1]
+    return result
+
+
+def quiet_logger():
+    """
+    Returns a logger which drops everything below ERROR.
+    """
+    logger = logging.getLogger('reworker.bench')
+    if not logger.handlers:
+        logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+    logger.setLevel(logging.ERROR)
+    return logger
+
+
+def start_worker(WorkerCls, broker, config_file=None, logger=None):
+    """
+    Creates a WorkerCls on broker and runs its ioloop until it consumes.
+    """
+    logger = logger or quiet_logger()
+    worker = WorkerCls(
+        MQ_CONFIG, config_file=config_file, logger=logger,
+        connection_class=broker.connection_class)
+    worker.app_logger = logger
+    while worker._consumer_tag is None:
+        worker._connection.ioloop.poll()
+    return worker
+
+
+def run_scenario(name, messages=1000, timeout=60):
+    """
+    Drives messages through the named scenario. Returns a dictionary of
+    results.
+    """
+    WorkerCls, config = SCENARIOS[name]
+    fd, config_file = tempfile.mkstemp(suffix='.json')
+    with os.fdopen(fd, 'w') as f_obj:
+        json.dump(config, f_obj)
+    broker = FakeBroker()
+    try:
+        worker = start_worker(WorkerCls, broker, config_file)
+    finally:
+        os.unlink(config_file)
+    ioloop = worker._connection.ioloop
+    queue = worker._queue
+
+    properties = [
+        pika.spec.BasicProperties(
+            correlation_id=str(num), reply_to='bench.reply')
+        for num in range(messages)]
+
+    gc.collect()
+    objects_before = len(gc.get_objects())
+    if tracemalloc is not None:
+        tracemalloc.start()
+    started = time.time()
+    for props in properties:
+        broker.put(queue, BODY, props)
+    deadline = started + timeout
+    while broker.acked < messages and time.time() < deadline:
+        if ioloop.poll() == 0:
+            time.sleep(0.0005)
+    # Let the last publishes through the ioloop
+    ioloop.poll()
+    elapsed = time.time() - started
+    alloc_peak = None
+    if tracemalloc is not None:
+        alloc_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    objects_after = len(gc.get_objects())
+
+    if worker._pool is not None:
+        # Threads still running at interpreter exit die noisily but a hung
+        # process must not outlast the timeout. A second of grace lets
+        # threads which are done pick up the shutdown.
+        worker._pool.shutdown(timeout=max(deadline - time.time(), 1))
+    return {
+        'scenario': name,
+        'messages': broker.acked,
+        'unsettled': messages - broker.acked - broker.rejected,
+        'seconds': elapsed,
+        'msgs_per_sec': broker.acked / elapsed if elapsed else 0.0,
+        'published': len(broker.published),
+        'stages': {
+            'decode': percentiles(worker.stages['decode']),
+            'process': percentiles(worker.stages['process']),
+            'deliver_to_ack': percentiles(broker.ack_latencies),
+        },
+        'alloc_peak_bytes': alloc_peak,
+        'objects_retained': objects_after - objects_before,
+    }
+
+
+def format_result(result):
+    """
+    Returns a human readable report of a run_scenario or replay result.
+    """
+    lines = ['%s: %d messages in %.3fs, %.1f msgs/sec, %d published' % (
+        result['scenario'], result['messages'], result['seconds'],
+        result['msgs_per_sec'], result['published'])]
+    for stage in ('decode', 'process', 'deliver_to_ack'):
+        points = result['stages'].get(stage)
+        if points:
+            lines.append('  %-15s %s' % (stage, '  '.join(
+                '%s=%.1fus' % (key, points[key] * 1e6)
+                for key in ('p50', 'p90', 'p99', 'max'))))
+    if result['alloc_peak_bytes'] is not None:
+        lines.append('  alloc peak     %d bytes (%.0f per message)' % (
+            result['alloc_peak_bytes'],
+            result['alloc_peak_bytes'] / float(max(result['messages'], 1))))
+    if result['objects_retained'] is not None:
+        lines.append('  objects retained %d' % result['objects_retained'])
+    if result.get('unsettled'):
+        lines.append('  unsettled      %d messages' % result['unsettled'])
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    """
+    Command line entry point.
+    """
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description='Benchmark workers in memory.')
+    parser.add_argument(
+        '-n', '--messages',
+        type=int,
+        default=2000,
+        help='Messages per scenario. Default: 2000')
+    parser.add_argument(
+        '-s', '--scenario',
+        action='append',
+        choices=sorted(SCENARIOS),
+        help='Scenario to run. Repeat for more. Default: all')
+    parser.add_argument(
+        '--json',
+        action='store_true',
+        default=False,
+        help='Print results as JSON.')
+    args = parser.parse_args(argv)
+
+    results = [run_scenario(name, args.messages)
+               for name in (args.scenario or sorted(SCENARIOS))]
+    if args.json:
+        print json.dumps(results, indent=2)
+    else:
+        for result in results:
+            print format_result(result)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Broker selection for workers configured with several servers.
+"""
+
+import random
+import time
+
+
+class BrokerSelector(object):
+    """
+    Picks which broker to connect to from connect latency and failures.
+
+    A broker which fails is skipped for a penalty which doubles with each
+    consecutive failure. Of the rest, one of those whose connect latency is
+    within spread of the fastest is picked at random so connections are
+    spread over healthy brokers. Brokers never connected to are tried
+    first, also at random, so a fleet starting together does not pile onto
+    the first server.
+    """
+
+    def __init__(self, servers, penalty=5.0, max_penalty=300.0, spread=0.5,
+                 alpha=0.3):
+        """
+        Creates an instance of BrokerSelector.
+
+        servers is a list of broker names. Any hashable values work.
+        penalty is how many seconds a broker is skipped after a failure.
+        max_penalty is the longest a broker is skipped for.
+        spread is how much slower, as a fraction of the fastest, a broker
+            may be and still be picked.
+        alpha is the smoothing factor for the latency average.
+        """
+        if not servers:
+            raise ValueError('BrokerSelector needs at least one server.')
+        self.servers = list(servers)
+        self.penalty = float(penalty)
+        self.max_penalty = max(self.penalty, float(max_penalty))
+        self.spread = float(spread)
+        self.alpha = float(alpha)
+        #: server -> smoothed connect latency in seconds
+        self.latency = dict((server, None) for server in self.servers)
+        #: server -> consecutive failures
+        self.failures = dict((server, 0) for server in self.servers)
+        #: server -> time before which the server is skipped
+        self.retry_at = dict((server, 0) for server in self.servers)
+
+    @classmethod
+    def from_config(cls, servers, config):
+        """
+        Creates an instance for servers from the 'failover' mq config
+        section.
+        """
+        return cls(
+            servers,
+            penalty=config.get('penalty', 5.0),
+            max_penalty=config.get('max_penalty', 300.0),
+            spread=config.get('spread', 0.5))
+
+    def available(self, now=None):
+        """
+        Returns the servers which are not being skipped.
+        """
+        now = now or time.time()
+        return [s for s in self.servers if self.retry_at[s] <= now]
+
+    def choose(self, now=None):
+        """
+        Returns the server to connect to next.
+        """
+        candidates = self.available(now)
+        if not candidates:
+            # Everything is failing. Use whichever comes back first.
+            return min(self.servers, key=lambda s: self.retry_at[s])
+        untried = [s for s in candidates if self.latency[s] is None]
+        if untried:
+            return random.choice(untried)
+        fastest = min(self.latency[s] for s in candidates)
+        close = [s for s in candidates
+                 if self.latency[s] <= fastest * (1 + self.spread)]
+        return random.choice(close)
+
+    def succeeded(self, server, latency):
+        """
+        Records a connection to server which opened after latency seconds.
+        """
+        if self.latency[server] is None:
+            self.latency[server] = latency
+        else:
+            self.latency[server] += self.alpha * (
+                latency - self.latency[server])
+        self.failures[server] = 0
+        self.retry_at[server] = 0
+
+    def failed(self, server, now=None):
+        """
+        Records a failed or dropped connection to server.
+        """
+        now = now or time.time()
+        self.failures[server] += 1
+        skip = min(
+            self.max_penalty,
+            self.penalty * (2 ** (self.failures[server] - 1)))
+        self.retry_at[server] = now + skip
+
+    def stats(self):
+        """
+        Returns the latency and failure counts per server as a dictionary.
+        """
+        return dict(
+            (str(s), {'latency': self.latency[s],
+                      'failures': self.failures[s]})
+            for s in self.servers)
@@ -0,0 +1,137 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Recording of incoming deliveries for offline replay.
+"""
+
+import json
+import os
+import os.path
+import struct
+import threading
+
+import pika.spec
+
+MAGIC = 'RWCAPT02'
+#: Record header: receive time, redelivered, properties length, body length
+RECORD = struct.Struct('>dBII')
+#: Record headers by file magic. Version 1 limited properties to 64KiB.
+RECORDS = {
+    'RWCAPT01': struct.Struct('>dBHI'),
+    MAGIC: RECORD,
+}
+#: BasicProperties fields which are recorded when set
+PROPERTIES = (
+    'content_type', 'content_encoding', 'headers', 'delivery_mode',
+    'priority', 'correlation_id', 'reply_to', 'expiration', 'message_id',
+    'timestamp', 'type', 'user_id', 'app_id', 'cluster_id')
+
+
+class Recorder(object):
+    """
+    Appends deliveries to a capture file.
+
+    Each record holds the receive time, the redelivered flag, the set
+    properties as JSON and the raw body. Recording stops once the file
+    reaches max_bytes.
+    """
+
+    def __init__(self, path, max_bytes=256 * 1024 * 1024):
+        """
+        Creates an instance of Recorder.
+
+        path is the capture file. New records are appended to it.
+        max_bytes is the size past which nothing more is recorded.
+        """
+        self.path = os.path.realpath(os.path.expanduser(path))
+        self.max_bytes = int(max_bytes)
+        self.full = False
+        self._lock = threading.Lock()
+        if os.path.exists(self.path) and os.path.getsize(self.path):
+            with open(self.path, 'rb') as f_obj:
+                if f_obj.read(len(MAGIC)) != MAGIC:
+                    raise ValueError(
+                        '%s is not a capture file of this version.' % path)
+        self._file = open(self.path, 'ab')
+        self._size = self._file.tell()
+        if self._size == 0:
+            self._file.write(MAGIC)
+            self._size = len(MAGIC)
+
+    def record(self, received, basic_deliver, properties, body):
+        """
+        Records a delivery received at the given time. Returns False once
+        the capture is full.
+        """
+        props = dict(
+            (name, getattr(properties, name, None)) for name in PROPERTIES)
+        props = json.dumps(
+            dict((k, v) for k, v in props.items() if v is not None),
+            default=str)
+        header = RECORD.pack(
+            received, bool(getattr(basic_deliver, 'redelivered', False)),
+            len(props), len(body))
+        with self._lock:
+            if self.full or self._file.closed:
+                return False
+            length = len(header) + len(props) + len(body)
+            if self._size + length > self.max_bytes:
+                self.full = True
+                return False
+            self._file.write(header + props + body)
+            self._file.flush()
+            self._size += length
+        return True
+
+    def close(self):
+        """
+        Closes the capture file.
+        """
+        with self._lock:
+            self._file.close()
+
+
+def read(path):
+    """
+    Yields (received, redelivered, properties, body) for every record in
+    the capture file at path. properties is a pika BasicProperties.
+    """
+    with open(os.path.realpath(os.path.expanduser(path)), 'rb') as f_obj:
+        record = RECORDS.get(f_obj.read(len(MAGIC)))
+        if record is None:
+            raise ValueError('%s is not a capture file.' % path)
+        while True:
+            header = f_obj.read(record.size)
+            if len(header) < record.size:
+                # End of file, or a record cut short by a crash
+                return
+            received, redelivered, props_len, body_len = record.unpack(
+                header)
+            props = f_obj.read(props_len)
+            body = f_obj.read(body_len)
+            if len(body) < body_len:
+                return
+            props = dict(
+                (str(k), v) for k, v in json.loads(props).items())
+            yield (received, bool(redelivered),
+                   pika.spec.BasicProperties(**props), body)
+
+
+def from_config(config):
+    """
+    Creates the recorder described by the 'capture' worker config section.
+    """
+    return Recorder(
+        config['path'], max_bytes=config.get('max_bytes', 256 * 1024 * 1024))
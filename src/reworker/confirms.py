@@ -0,0 +1,161 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Publisher confirm tracking.
+"""
+
+import collections
+import logging
+import threading
+
+
+class Confirmation(object):
+    """
+    The broker's answer to a single publish. Similar to a future.
+    """
+
+    def __init__(self):
+        """
+        Creates an instance of Confirmation.
+        """
+        #: True if acked, False if nacked or lost, None while outstanding
+        self.acked = None
+        self.reason = None
+        self._event = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def done(self):
+        """
+        Returns True once the broker has answered.
+        """
+        return self._event.is_set()
+
+    def wait(self, timeout=None):
+        """
+        Blocks until the broker answers or timeout seconds pass. Returns
+        acked. Must not be called from the ioloop thread.
+        """
+        self._event.wait(timeout)
+        return self.acked
+
+    def add_done_callback(self, func):
+        """
+        Calls func with this Confirmation once the broker answers. If it
+        already has func is called right away.
+        """
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(func)
+                return
+        func(self)
+
+    def _resolve(self, acked, reason=None):
+        """
+        Records the answer and runs the done callbacks.
+        """
+        with self._lock:
+            self.acked = acked
+            self.reason = reason
+            self._event.set()
+            callbacks = self._callbacks
+            self._callbacks = []
+        for func in callbacks:
+            try:
+                func(self)
+            except Exception, ex:
+                logging.getLogger('reworker').error(
+                    'Unhandled error in confirm callback: %s: %s' % (
+                        type(ex), ex))
+
+
+class ConfirmTracker(object):
+    """
+    Tracks outstanding publishes on a channel in confirm mode.
+
+    Delivery tags are handed out in publish order so outstanding
+    confirmations are kept in an ordered map and a multiple ack settles
+    everything up to its tag by popping from the front.
+    """
+
+    def __init__(self):
+        """
+        Creates an instance of ConfirmTracker.
+        """
+        self._outstanding = collections.OrderedDict()
+        self._next_tag = 1
+        self.acked = 0
+        self.nacked = 0
+
+    def __len__(self):
+        return len(self._outstanding)
+
+    def reset(self):
+        """
+        Starts over for a new channel. Outstanding confirmations are failed
+        since their answers will never come.
+        """
+        self.fail_all('channel closed')
+        self._next_tag = 1
+
+    def published(self, confirmation):
+        """
+        Registers confirmation for the publish just made. Returns its tag.
+        """
+        tag = self._next_tag
+        self._next_tag += 1
+        self._outstanding[tag] = confirmation
+        return tag
+
+    def settle(self, delivery_tag, multiple, acked):
+        """
+        Resolves the confirmation for delivery_tag, or every one up to and
+        including it when multiple is True.
+        """
+        settled = []
+        if multiple:
+            while self._outstanding:
+                tag = next(iter(self._outstanding))
+                if tag > delivery_tag:
+                    break
+                settled.append(self._outstanding.pop(tag))
+        elif delivery_tag in self._outstanding:
+            settled.append(self._outstanding.pop(delivery_tag))
+
+        if acked:
+            self.acked += len(settled)
+        else:
+            self.nacked += len(settled)
+        for confirmation in settled:
+            confirmation._resolve(acked, None if acked else 'nacked')
+
+    def on_confirm(self, method_frame):
+        """
+        Channel callback for Basic.Ack and Basic.Nack from the broker.
+        """
+        method = method_frame.method
+        self.settle(
+            method.delivery_tag, method.multiple,
+            method.NAME == 'Basic.Ack')
+
+    def fail_all(self, reason):
+        """
+        Fails every outstanding confirmation with reason.
+        """
+        outstanding = self._outstanding
+        self._outstanding = collections.OrderedDict()
+        self.nacked += len(outstanding)
+        for confirmation in outstanding.values():
+            confirmation._resolve(False, reason)
@@ -0,0 +1,142 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Caches of finished messages used to skip duplicate deliveries.
+"""
+
+import collections
+import hashlib
+import os.path
+import sqlite3
+import threading
+import time
+
+
+def message_key(corr_id, body):
+    """
+    Returns the cache key for a message from its correlation id and raw
+    body.
+    """
+    return '%s:%s' % (corr_id, hashlib.sha1(body).hexdigest())
+
+
+class DedupCache(object):
+    """
+    In memory LRU of final status bodies with a time to live.
+    """
+
+    def __init__(self, size=10000, ttl=3600):
+        """
+        Creates an instance of DedupCache.
+
+        size is the most entries kept.
+        ttl is how many seconds an entry is valid for.
+        """
+        self.size = size
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Returns the cached status body for key or None.
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, body = entry
+            if expires <= now:
+                del self._entries[key]
+                return None
+            return body
+
+    def put(self, key, body):
+        """
+        Caches body, the serialized final status, for key.
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + self.ttl, body)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SqliteDedupCache(object):
+    """
+    Dedup cache kept in a SQLite file so every worker process on a host
+    shares it.
+    """
+
+    #: Expired rows are purged every this many puts
+    purge_every = 500
+
+    def __init__(self, path, ttl=3600):
+        """
+        Creates an instance of SqliteDedupCache.
+
+        path is the SQLite database file. It is created if needed.
+        ttl is how many seconds an entry is valid for.
+        """
+        self.path = os.path.realpath(os.path.expanduser(path))
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._puts = 0
+        self._db = sqlite3.connect(
+            self.path, timeout=5, check_same_thread=False)
+        with self._db:
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS dedup ('
+                'key TEXT PRIMARY KEY, body BLOB, expires REAL)')
+
+    def get(self, key):
+        """
+        Returns the cached status body for key or None.
+        """
+        with self._lock:
+            row = self._db.execute(
+                'SELECT body FROM dedup WHERE key = ? AND expires > ?',
+                (key, time.time())).fetchone()
+        if row is None:
+            return None
+        return str(row[0])
+
+    def put(self, key, body):
+        """
+        Caches body, the serialized final status, for key.
+        """
+        now = time.time()
+        with self._lock:
+            with self._db:
+                self._db.execute(
+                    'INSERT OR REPLACE INTO dedup VALUES (?, ?, ?)',
+                    (key, sqlite3.Binary(body), now + self.ttl))
+                self._puts += 1
+                if self._puts % self.purge_every == 0:
+                    self._db.execute(
+                        'DELETE FROM dedup WHERE expires <= ?', (now,))
+
+
+def from_config(config):
+    """
+    Creates the cache described by the 'dedup' worker config section.
+    """
+    if config.get('path'):
+        return SqliteDedupCache(config['path'], config.get('ttl', 3600))
+    return DedupCache(config.get('size', 10000), config.get('ttl', 3600))
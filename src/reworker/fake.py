@@ -0,0 +1,405 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+In memory stand-in for a broker and pika's SelectConnection.
+
+Only the parts a Worker uses are implemented. Pass
+FakeBroker().connection_class to a Worker to run it without a bus.
+"""
+
+import collections
+import heapq
+import itertools
+import threading
+import time
+
+import pika.frame
+import pika.spec
+
+
+class FakeIOLoop(object):
+    """
+    Single threaded loop running scheduled callbacks and timeouts.
+    """
+
+    def __init__(self):
+        """
+        Creates an instance of FakeIOLoop.
+        """
+        self._ready = collections.deque()
+        self._timeouts = []
+        self._cancelled = set()
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._stopping = False
+
+    def add_callback(self, callback):
+        """
+        Runs callback on the next pass of the loop.
+        """
+        self._ready.append(callback)
+
+    def add_timeout(self, deadline, callback):
+        """
+        Runs callback after deadline seconds. Returns a handle for
+        remove_timeout.
+        """
+        handle = next(self._seq)
+        with self._lock:
+            heapq.heappush(
+                self._timeouts, (time.time() + deadline, handle, callback))
+        return handle
+
+    def remove_timeout(self, handle):
+        """
+        Cancels the timeout with handle.
+        """
+        self._cancelled.add(handle)
+
+    def _due(self, now):
+        """
+        Pops the callbacks of every timeout which is due.
+        """
+        due = []
+        with self._lock:
+            while self._timeouts and self._timeouts[0][0] <= now:
+                _, handle, callback = heapq.heappop(self._timeouts)
+                if handle in self._cancelled:
+                    self._cancelled.discard(handle)
+                else:
+                    due.append(callback)
+        return due
+
+    def poll(self):
+        """
+        Runs everything which is ready now. Returns the number of callbacks
+        run.
+        """
+        ran = 0
+        for callback in self._due(time.time()):
+            callback()
+            ran += 1
+        # Only what is ready now so callbacks adding callbacks can't starve
+        # the timeouts
+        for _ in range(len(self._ready)):
+            self._ready.popleft()()
+            ran += 1
+        return ran
+
+    def start(self):
+        """
+        Runs the loop until stop is called.
+        """
+        self._stopping = False
+        while not self._stopping:
+            if self.poll() == 0:
+                with self._lock:
+                    wait = 0.001
+                    if self._timeouts:
+                        wait = min(wait, self._timeouts[0][0] - time.time())
+                if wait > 0:
+                    time.sleep(wait)
+
+    def stop(self):
+        """
+        Makes start return after the current pass.
+        """
+        self._stopping = True
+
+
+class _Callbacks(object):
+    """
+    Stand-in for pika's CallbackManager. Registrations are kept but the
+    fake broker never sends connection level methods.
+    """
+
+    def __init__(self):
+        self.added = []
+
+    def add(self, prefix, key, callback, one_shot=True, *args, **kwargs):
+        self.added.append((prefix, key, callback, one_shot))
+
+
+class FakeConnection(object):
+    """
+    Stand-in for pika.SelectConnection backed by a FakeBroker.
+    """
+
+    def __init__(self, parameters=None, on_open_callback=None,
+                 on_close_callback=None, stop_ioloop_on_close=True,
+                 broker=None):
+        """
+        Creates an instance of FakeConnection. Takes the same arguments as
+        SelectConnection plus the broker to connect to.
+        """
+        self.parameters = parameters
+        self.broker = broker or FakeBroker()
+        self.ioloop = FakeIOLoop()
+        self.callbacks = _Callbacks()
+        self.outbound_buffer = collections.deque()
+        self.is_open = True
+        self._on_close_callback = on_close_callback
+        self._stop_ioloop_on_close = stop_ioloop_on_close
+        self._channels = itertools.count(1)
+        self.broker.connections.append(self)
+        if on_open_callback is not None:
+            self.ioloop.add_callback(lambda: on_open_callback(self))
+
+    def add_timeout(self, deadline, callback):
+        return self.ioloop.add_timeout(deadline, callback)
+
+    def add_callback_threadsafe(self, callback):
+        """
+        Runs callback on the ioloop. Safe to call from any thread.
+        """
+        self.ioloop.add_callback(callback)
+
+    def remove_timeout(self, handle):
+        self.ioloop.remove_timeout(handle)
+
+    def channel(self, on_open_callback, channel_number=None):
+        """
+        Opens a FakeChannel and passes it to on_open_callback.
+        """
+        channel = FakeChannel(self, channel_number or next(self._channels))
+        self.ioloop.add_callback(lambda: on_open_callback(channel))
+        return channel
+
+    def close(self, reply_code=200, reply_text='Normal shutdown'):
+        """
+        Closes the connection. Unacked messages go back on their queues.
+        """
+        if not self.is_open:
+            return
+        self.is_open = False
+        for channel in self.broker.channels_of(self):
+            channel._requeue_unacked()
+        self.broker.connections.remove(self)
+        if self._on_close_callback is not None:
+            self.ioloop.add_callback(
+                lambda: self._on_close_callback(self, reply_code, reply_text))
+        if self._stop_ioloop_on_close:
+            self.ioloop.add_callback(self.ioloop.stop)
+
+
+class FakeChannel(object):
+    """
+    Stand-in for pika.channel.Channel.
+    """
+
+    def __init__(self, connection, channel_number):
+        """
+        Creates an instance of FakeChannel.
+        """
+        self.connection = connection
+        self.broker = connection.broker
+        self.channel_number = channel_number
+        self.prefetch_count = 0
+        #: consumer tag -> (callback, queue)
+        self.consumers = collections.OrderedDict()
+        #: delivery tag -> (queue, properties, body)
+        self.unacked = collections.OrderedDict()
+        self._delivered_at = {}
+        self._tags = itertools.count(1)
+        self._consumer_tags = itertools.count(1)
+        self._confirm_callback = None
+        self._publish_seq = itertools.count(1)
+        self._pump_scheduled = False
+        self.broker.channels.append(self)
+
+    def basic_qos(self, callback=None, prefetch_size=0, prefetch_count=0,
+                  all_channels=False):
+        self.prefetch_count = prefetch_count
+        self._schedule_pump()
+
+    def confirm_delivery(self, callback=None, nowait=False):
+        self._confirm_callback = callback
+
+    def basic_consume(self, consumer_callback, queue='', no_ack=False,
+                      exclusive=False, consumer_tag=None, arguments=None):
+        """
+        Starts delivering messages from queue. Returns the consumer tag.
+        """
+        tag = consumer_tag or 'ctag%s.%s' % (
+            self.channel_number, next(self._consumer_tags))
+        self.consumers[tag] = (consumer_callback, queue)
+        # Consuming declares the queue so publishes route to it
+        self.broker.queue(queue)
+        self._schedule_pump()
+        return tag
+
+    def basic_cancel(self, callback=None, consumer_tag='', nowait=False):
+        self.consumers.pop(consumer_tag, None)
+
+    def basic_publish(self, exchange, routing_key, body, properties=None,
+                      mandatory=False, immediate=False):
+        """
+        Records the publish with the broker and confirms it when confirms
+        are on.
+        """
+        self.broker.publish(exchange, routing_key, body, properties)
+        if self._confirm_callback is not None:
+            frame = pika.frame.Method(
+                self.channel_number,
+                pika.spec.Basic.Ack(delivery_tag=next(self._publish_seq)))
+            self.connection.ioloop.add_callback(
+                lambda: self._confirm_callback(frame))
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        """
+        Acks delivery_tag, and every tag before it when multiple is True.
+        """
+        now = time.time()
+        for tag, _ in self._settle(delivery_tag, multiple):
+            self.broker.acked += 1
+            self.broker.ack_latencies.append(
+                now - self._delivered_at.pop(tag))
+        self._schedule_pump()
+
+    def basic_reject(self, delivery_tag, requeue=True):
+        """
+        Rejects delivery_tag, putting it back on its queue when requeue is
+        True.
+        """
+        for tag, (queue, properties, body) in self._settle(
+                delivery_tag, False):
+            self.broker.rejected += 1
+            self._delivered_at.pop(tag, None)
+            if requeue:
+                self.broker.queue(queue).appendleft(
+                    (properties, body, True))
+        self._schedule_pump()
+
+    def basic_nack(self, delivery_tag=0, multiple=False, requeue=True):
+        for tag, _ in self._settle(delivery_tag, multiple):
+            self.broker.rejected += 1
+            self._delivered_at.pop(tag, None)
+        self._schedule_pump()
+
+    def _settle(self, delivery_tag, multiple):
+        """
+        Removes and returns the settled (tag, message) pairs.
+        """
+        if multiple:
+            tags = [t for t in self.unacked if t <= delivery_tag]
+        else:
+            tags = [delivery_tag] if delivery_tag in self.unacked else []
+        return [(tag, self.unacked.pop(tag)) for tag in tags]
+
+    def _requeue_unacked(self):
+        """
+        Puts every unacked message back on its queue, as a broker does when
+        a channel closes.
+        """
+        for queue, properties, body in reversed(self.unacked.values()):
+            self.broker.queue(queue).appendleft((properties, body, True))
+        self.unacked.clear()
+        self._delivered_at.clear()
+        self.consumers.clear()
+        self.broker.channels.remove(self)
+
+    def _schedule_pump(self):
+        if not self._pump_scheduled:
+            self._pump_scheduled = True
+            self.connection.ioloop.add_callback(self._pump)
+
+    def _pump(self):
+        """
+        Delivers waiting messages to the consumers up to the prefetch
+        count.
+        """
+        self._pump_scheduled = False
+        if not self.connection.is_open:
+            return
+        for consumer_tag, (callback, queue) in self.consumers.items():
+            messages = self.broker.queue(queue)
+            while messages and (
+                    not self.prefetch_count or
+                    len(self.unacked) < self.prefetch_count):
+                if consumer_tag not in self.consumers:
+                    break
+                properties, body, redelivered = messages.popleft()
+                tag = next(self._tags)
+                self.unacked[tag] = (queue, properties, body)
+                deliver = pika.spec.Basic.Deliver(
+                    consumer_tag=consumer_tag, delivery_tag=tag,
+                    redelivered=redelivered, exchange='', routing_key=queue)
+                self._delivered_at[tag] = time.time()
+                callback(self, deliver, properties, body)
+
+
+class FakeBroker(object):
+    """
+    In memory broker holding queues and everything published.
+    """
+
+    def __init__(self):
+        """
+        Creates an instance of FakeBroker.
+        """
+        self.queues = {}
+        #: (exchange, routing_key, properties, body) of every publish
+        self.published = []
+        self.connections = []
+        self.channels = []
+        self.acked = 0
+        self.rejected = 0
+        #: Seconds from delivery to ack of every acked message
+        self.ack_latencies = []
+        self._lock = threading.Lock()
+
+    def queue(self, name):
+        """
+        Returns the deque backing the queue called name.
+        """
+        if name not in self.queues:
+            self.queues[name] = collections.deque()
+        return self.queues[name]
+
+    def put(self, queue, body, properties=None, redelivered=False):
+        """
+        Adds a message to queue for delivery.
+        """
+        if properties is None:
+            properties = pika.spec.BasicProperties()
+        self.queue(queue).append((properties, body, redelivered))
+        for channel in self.channels:
+            channel._schedule_pump()
+
+    def publish(self, exchange, routing_key, body, properties=None):
+        """
+        Records a publish. Publishes to the default exchange are routed to
+        a queue of the same name if one exists.
+        """
+        with self._lock:
+            self.published.append((exchange, routing_key, properties, body))
+        if exchange == '' and routing_key in self.queues:
+            self.put(routing_key, body, properties)
+
+    def channels_of(self, connection):
+        """
+        Returns the open channels of connection.
+        """
+        return [c for c in self.channels if c.connection is connection]
+
+    def connection_class(self, parameters=None, on_open_callback=None,
+                         on_close_callback=None, stop_ioloop_on_close=True):
+        """
+        Creates a FakeConnection to this broker. Takes the same arguments
+        as SelectConnection so it can stand in for it.
+        """
+        return FakeConnection(
+            parameters, on_open_callback, on_close_callback,
+            stop_ioloop_on_close, broker=self)
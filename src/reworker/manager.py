@@ -0,0 +1,173 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Runs several workers over one shared connection.
+"""
+
+import logging
+import time
+
+import pika
+import pika.exceptions
+
+from reworker.reconnect import Backoff
+
+
+class ConnectionManager(object):
+    """
+    Owns one connection and the ioloop for a set of workers. Each worker
+    consumes on its own channel with its own prefetch.
+    """
+
+    def __init__(self, mq_config, reconnect=None, logger=None):
+        """
+        Creates an instance of ConnectionManager.
+
+        mq_config should house: user, password, server, port and vhost.
+        reconnect is an optional dictionary of Backoff settings.
+        logger is an optional logger.
+        """
+        self.mq_config = mq_config
+        self.logger = logger or logging.getLogger('reworker.manager')
+        self.workers = []
+        self._backoff = Backoff.from_config(reconnect or {})
+        self._connection = None
+        self._connected = False
+        self._closing = False
+        self._retry_in = None
+        self._drained = set()
+
+    def add(self, WorkerCls, config_file=None, **kwargs):
+        """
+        Creates a worker of WorkerCls on the shared connection and returns
+        it. Workers must be added before run_forever.
+
+        config_file is an optional full path to the worker's config file.
+        """
+        worker = WorkerCls(
+            self.mq_config, config_file=config_file, manager=self, **kwargs)
+        self.workers.append(worker)
+        return worker
+
+    def _connect(self):
+        """
+        Connects to the bus and attaches every worker to the connection.
+        """
+        try:
+            # The first worker picks the broker when several are configured
+            self._connection = pika.SelectConnection(
+                parameters=self.workers[0]._select_broker(),
+                on_open_callback=self._on_open,
+                on_close_callback=self._on_close,
+                stop_ioloop_on_close=False)
+            self._connected = True
+            for num, worker in enumerate(self.workers):
+                # One watcher is enough for the shared connection
+                worker._attach(self._connection, watch_blocked=(num == 0))
+        except pika.exceptions.AMQPConnectionError, ae:
+            self.logger.warn('Unable to make connection: %s' % ae.message)
+            self._on_close(None, -1, str(ae))
+
+    def _on_open(self, connection):
+        """
+        Opens a channel for every worker.
+        """
+        self._backoff.reset()
+        for worker in self.workers:
+            worker._on_open(connection)
+
+    def _on_close(self, connection, reply_code, reply_text):
+        """
+        Resets every worker and schedules a reconnect, or exits when
+        closing.
+        """
+        self._connected = False
+        for worker in self.workers:
+            worker._detach()
+
+        if self._closing:
+            if self._connection is not None:
+                self._connection.ioloop.stop()
+            for worker in self.workers:
+                if worker._pool is not None:
+                    worker._pool.shutdown(wait=False)
+            self.logger.info('Exiting...')
+            raise SystemExit(0)
+
+        self.logger.warn('Connection closed because %s (%s)' % (
+            reply_text, reply_code))
+        delay = self.workers[0]._reconnect_delay(self._backoff)
+        for worker in self.workers:
+            worker.metrics.reconnects.inc()
+        self.logger.info(
+            'Attempting to reconnect in %.1f seconds (attempt %s) ...' % (
+                delay, self._backoff.attempts))
+        if connection is not None:
+            self._connection.add_timeout(delay, self._reconnect)
+        else:
+            self._retry_in = delay
+
+    def _reconnect(self):
+        """
+        Stops the old ioloop so run_forever can make a new connection.
+        """
+        self._retry_in = 0
+        self._connection.ioloop.stop()
+
+    def stop(self):
+        """
+        Gracefully stops every worker and then closes the connection. Runs
+        on the ioloop thread.
+        """
+        self._closing = True
+        self._drained.clear()
+        for worker in self.workers:
+            worker.stop()
+
+    def drained(self, worker):
+        """
+        Called by each worker once its in-flight messages are done. Closes
+        the connection after the last one.
+        """
+        self._drained.add(id(worker))
+        if len(self._drained) == len(self.workers):
+            self._connection.close()
+
+    def run_forever(self):
+        """
+        Run forever ... or until someone makes it stop.
+        """
+        if not self.workers:
+            raise ValueError('No workers added to the ConnectionManager.')
+        try:
+            while True:
+                if self._connected is False:
+                    if self._retry_in:
+                        time.sleep(self._retry_in)
+                    self._retry_in = None
+                    self._connect()
+
+                if self._connected:
+                    self.logger.info('Starting the IOLoop for %s workers.' % (
+                        len(self.workers)))
+                    self._connection.ioloop.start()
+
+                if self._closing or self._retry_in is None:
+                    break
+        except KeyboardInterrupt:
+            self.logger.info('KeyboardInterrupt sent.')
+            self._closing = True
+        except pika.exceptions.IncompatibleProtocolError:
+            self.logger.fatal('No connection or incompatible protocol.')
@@ -0,0 +1,121 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Memory accounting and recycling of long running workers.
+"""
+
+import resource
+import sys
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+def rss_bytes():
+    """
+    Returns the resident set size of this process in bytes.
+
+    Reads /proc when available. Elsewhere the peak resident size is used
+    which only grows, so recycling still triggers once it passes max_rss.
+    """
+    try:
+        with open('/proc/self/statm', 'r') as f_obj:
+            pages = int(f_obj.read().split()[1])
+        return pages * resource.getpagesize()
+    except (IOError, OSError, IndexError, ValueError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Kilobytes everywhere but OS X
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class AllocationTracker(object):
+    """
+    Measures how much memory a call leaves allocated.
+
+    Uses tracemalloc when it is available. Otherwise the change in
+    resident size is used, which is coarser as the allocator hands pages
+    back lazily.
+    """
+
+    def __init__(self, frames=1):
+        """
+        Creates an instance of AllocationTracker.
+
+        frames is how many frames tracemalloc keeps per allocation.
+        """
+        self.traced = tracemalloc is not None
+        if self.traced and not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+
+    def current(self):
+        """
+        Returns the current allocation figure in bytes.
+        """
+        if self.traced:
+            return tracemalloc.get_traced_memory()[0]
+        return rss_bytes()
+
+
+class RecyclePolicy(object):
+    """
+    Decides when a worker has handled enough messages, or grown large
+    enough, that it should exit and be restarted.
+    """
+
+    def __init__(self, max_messages=None, max_rss=None, check_every=100):
+        """
+        Creates an instance of RecyclePolicy.
+
+        max_messages is how many messages to handle before recycling.
+        max_rss is the resident size in bytes to recycle above.
+        check_every is how many messages pass between resident size
+            checks.
+        """
+        self.max_messages = max_messages
+        self.max_rss = max_rss
+        self.check_every = max(int(check_every), 1)
+        self.handled = 0
+        self.rss = None
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Creates an instance from the 'recycle' worker config section.
+        max_rss_mb is in megabytes.
+        """
+        max_rss = config.get('max_rss_mb', None)
+        if max_rss is not None:
+            max_rss = int(max_rss * 1024 * 1024)
+        return cls(
+            max_messages=config.get('max_messages', None),
+            max_rss=max_rss,
+            check_every=config.get('check_every', 100))
+
+    def done(self):
+        """
+        Counts a handled message. Returns why the worker should recycle, or
+        None if it should keep going.
+        """
+        self.handled += 1
+        if self.max_messages and self.handled >= self.max_messages:
+            return 'handled %s messages' % self.handled
+        if self.max_rss and self.handled % self.check_every == 0:
+            self.rss = rss_bytes()
+            if self.rss > self.max_rss:
+                return 'resident size %s bytes is over %s' % (
+                    self.rss, self.max_rss)
+        return None
@@ -0,0 +1,279 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Worker metrics in the Prometheus text format.
+"""
+
+import bisect
+import threading
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+#: Default histogram buckets in seconds
+LATENCY_BUCKETS = (
+    0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+#: Histogram buckets in bytes for per message allocations
+ALLOCATION_BUCKETS = (
+    1024, 16 * 1024, 64 * 1024, 256 * 1024, 1024 ** 2, 4 * 1024 ** 2,
+    16 * 1024 ** 2, 64 * 1024 ** 2, 256 * 1024 ** 2)
+
+
+class Counter(object):
+    """
+    A value which only goes up.
+    """
+
+    kind = 'counter'
+
+    def __init__(self, name, help_text):
+        """
+        Creates an instance of Counter.
+
+        name is the metric name.
+        help_text describes the metric.
+        """
+        self.name = name
+        self.help = help_text
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        """
+        Increments the counter by amount.
+        """
+        with self._lock:
+            self.value += amount
+
+    def samples(self):
+        """
+        Returns a list of (name, labels, value) tuples.
+        """
+        return [(self.name, '', self.value)]
+
+
+class Gauge(Counter):
+    """
+    A value which can go up and down.
+    """
+
+    kind = 'gauge'
+
+    def set(self, value):
+        """
+        Sets the gauge to value.
+        """
+        self.value = value
+
+    def dec(self, amount=1):
+        """
+        Decrements the gauge by amount.
+        """
+        self.inc(-amount)
+
+
+class Histogram(object):
+    """
+    Counts observations into fixed buckets.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS):
+        """
+        Creates an instance of Histogram.
+
+        name is the metric name.
+        help_text describes the metric.
+        buckets are the sorted upper bounds of the buckets.
+        """
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(sorted(buckets))
+        # One extra slot for observations above the last bound (+Inf)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        """
+        Records one observation.
+        """
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def samples(self):
+        """
+        Returns a list of (name, labels, value) tuples with cumulative
+        bucket counts.
+        """
+        with self._lock:
+            counts = list(self.counts)
+            total, count = self.sum, self.count
+        samples = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            samples.append((
+                self.name + '_bucket', '{le="%s"}' % repr(bound), cumulative))
+        samples.append((self.name + '_bucket', '{le="+Inf"}', count))
+        samples.append((self.name + '_sum', '', total))
+        samples.append((self.name + '_count', '', count))
+        return samples
+
+
+class Metrics(object):
+    """
+    The set of metrics a worker records.
+    """
+
+    def __init__(self, prefix='reworker'):
+        """
+        Creates an instance of Metrics.
+
+        prefix is put in front of every metric name.
+        """
+        self.prefix = prefix
+        self._metrics = []
+        self.received = self.counter(
+            'messages_received_total', 'Messages delivered to the worker.')
+        self.acked = self.counter(
+            'messages_acked_total', 'Messages acked.')
+        self.rejected = self.counter(
+            'messages_rejected_total', 'Messages rejected.')
+        self.duplicates = self.counter(
+            'messages_duplicate_total',
+            'Redelivered messages answered from the dedup cache.')
+        self.deadlines = self.counter(
+            'messages_deadline_exceeded_total',
+            'Messages which ran past their deadline.')
+        self.missing_keys = self.counter(
+            'messages_missing_key_total',
+            'Messages which failed due to a missing key.')
+        self.profiled = self.counter(
+            'messages_profiled_total', 'Messages run under the profiler.')
+        self.published = self.counter(
+            'published_total', 'Messages published.')
+        self.published_bytes = self.counter(
+            'published_bytes_total', 'Bytes of message bodies published.')
+        self.spooled = self.counter(
+            'spooled_total', 'Publishes spooled while disconnected.')
+        self.spool_dropped = self.counter(
+            'spool_dropped_total', 'Publishes dropped as the spool was full.')
+        self.reconnects = self.counter(
+            'reconnects_total', 'Reconnects scheduled.')
+        self.rss = self.gauge(
+            'resident_memory_bytes', 'Resident set size at the last check.')
+        self.paused = self.gauge(
+            'consumer_paused', '1 while consuming is paused by backpressure.')
+        self.latency = self.histogram(
+            'message_latency_seconds', 'Time from delivery to ack.')
+        self.process_time = self.histogram(
+            'process_seconds', 'Time spent in process().')
+        self.decode_time = self.histogram(
+            'decode_seconds', 'Time spent decoding message bodies.')
+        self.allocations = self.histogram(
+            'message_allocated_bytes',
+            'Memory still allocated after process() returned.',
+            ALLOCATION_BUCKETS)
+
+    def counter(self, name, help_text):
+        """
+        Creates and registers a Counter.
+        """
+        return self._register(Counter(self.prefix + '_' + name, help_text))
+
+    def gauge(self, name, help_text):
+        """
+        Creates and registers a Gauge.
+        """
+        return self._register(Gauge(self.prefix + '_' + name, help_text))
+
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS):
+        """
+        Creates and registers a Histogram.
+        """
+        return self._register(
+            Histogram(self.prefix + '_' + name, help_text, buckets))
+
+    def _register(self, metric):
+        """
+        Adds metric to the exported set.
+        """
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """
+        Returns every metric in the Prometheus text exposition format.
+        """
+        lines = []
+        for metric in self._metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            for name, labels, value in metric.samples():
+                lines.append('%s%s %s' % (name, labels, repr(value)))
+        return '\n'.join(lines) + '\n'
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    """
+    Serves the rendered metrics on any GET.
+    """
+
+    def do_GET(self):
+        body = self.server.metrics.render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        # Scrapes are too frequent to log
+        pass
+
+
+class MetricsServer(object):
+    """
+    Serves metrics over HTTP from a background thread.
+    """
+
+    def __init__(self, metrics, port, address='127.0.0.1'):
+        """
+        Creates an instance of MetricsServer and starts serving.
+
+        metrics is the Metrics instance to serve.
+        port is the port to listen on. 0 picks a free port.
+        address is the address to listen on. Default: 127.0.0.1
+        """
+        self._server = HTTPServer((address, port), _MetricsHandler)
+        self._server.metrics = metrics
+        self.address, self.port = self._server.server_address
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name='reworker-metrics')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def shutdown(self):
+        """
+        Stops serving.
+        """
+        self._server.shutdown()
+        self._server.server_close()
@@ -17,6 +17,13 @@ The worker class.
 """
 
 import logging
+import threading
+import time
+
+
+#: Numeric levels by name, looked up once rather than on every log call
+LEVELS = dict((name, logging.getLevelName(name)) for name in (
+    'DEBUG', 'INFO', 'ERROR', 'WARN', 'WARNING', 'CRITICAL', 'FATAL'))
 
 
 class Output(object):
@@ -33,7 +40,7 @@ class Output(object):
         """
         self.send = send_meth
         self.corr_id = corr_id
-        self._level = logging.getLevelName('INFO')  # Default to INFO
+        self._level = LEVELS['INFO']  # Default to INFO
         self.setLevel(level)
 
     def setLevel(self, level):
@@ -41,29 +48,160 @@ class Output(object):
         Level like setter. Ignores unknown levels.
         """
         level = level.upper()
-        if level in (
-                'DEBUG', 'INFO', 'ERROR', 'WARN',
-                'WARNING', 'CRITICAL', 'FATAL'):
-            self._level = logging.getLevelName(level)
+        if level in LEVELS:
+            self._level = LEVELS[level]
+
+    def isEnabledFor(self, level):
+        """
+        Returns True if a message at level would be sent.
+
+        level is a level name (like 'info') or number.
+        """
+        return self._levelno(level) >= self._level
 
-    def log(self, level, message):
+    def _levelno(self, level):
+        """
+        Returns the numeric value of level. Unknown names are always sent.
+        """
+        if isinstance(level, int):
+            return level
+        try:
+            return LEVELS[level]
+        except KeyError:
+            return LEVELS.get(level.upper(), logging.CRITICAL)
+
+    def log(self, level, message, *args):
         """
         'Logs' to the bus.
 
         level string to log at (like 'info')
         message is the textual messae
+        args are only formatted into message if level is enabled
         """
-        if logging.getLevelName(level) >= self._level:
-            body = {
-                'message': message,
-            }
-            self.send('output', self.corr_id, body)
+        levelno = self._levelno(level)
+        if levelno >= self._level:
+            if args:
+                message = message % args
+            self._emit(levelno, message)
+
+    def _emit(self, levelno, message):
+        """
+        Sends an already filtered and formatted message to the bus.
+        """
+        body = {
+            'message': message,
+        }
+        self.send('output', self.corr_id, body)
+
+    def flush(self):
+        """
+        Nothing is buffered so nothing to flush.
+        """
+        pass
 
     # Specific level calls
-    debug = lambda s, m: s.log('DEBUG', m)
-    info = lambda s, m: s.log('INFO', m)
-    error = lambda s, m: s.log('ERROR', m)
-    warn = lambda s, m: s.log('WARN', m)
-    warning = lambda s, m: s.log('WARNING', m)
-    critical = lambda s, m: s.log('CRITICAL', m)
-    fatal = lambda s, m: s.log('FATAL', m)
+    debug = lambda s, m, *a: s.log(logging.DEBUG, m, *a)
+    info = lambda s, m, *a: s.log(logging.INFO, m, *a)
+    error = lambda s, m, *a: s.log(logging.ERROR, m, *a)
+    warn = lambda s, m, *a: s.log(logging.WARN, m, *a)
+    warning = lambda s, m, *a: s.log(logging.WARNING, m, *a)
+    critical = lambda s, m, *a: s.log(logging.CRITICAL, m, *a)
+    fatal = lambda s, m, *a: s.log(logging.FATAL, m, *a)
+
+
+class BufferedOutput(Output):
+    """
+    Output which coalesces lines and publishes them as a list in a single
+    bus message.
+
+    Lines are flushed when the buffer holds max_lines lines or max_bytes
+    bytes, when the oldest buffered line is older than interval seconds,
+    when a line at flush_level or above is logged and when flush is called.
+    Without call_later the interval is only checked when a line is logged.
+    """
+
+    def __init__(self, send_meth, corr_id, level='INFO', max_lines=100,
+                 max_bytes=65536, interval=1.0, flush_level='ERROR',
+                 call_later=None):
+        """
+        Creates an instance of BufferedOutput.
+
+        send_meth is the Worker.send method.
+        corr_id is the correlation id.
+        max_lines is the most lines held before a flush.
+        max_bytes is the most bytes of lines held before a flush.
+        interval is the most seconds a line is held before a flush.
+        flush_level is the level at which lines are flushed right away.
+        call_later is an optional callable taking (seconds, func) which
+            calls func after seconds, possibly from another thread. With it
+            lines are flushed after interval even if nothing more is logged.
+        """
+        super(BufferedOutput, self).__init__(send_meth, corr_id, level)
+        self.max_lines = max_lines
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self._flush_level = self._levelno(flush_level)
+        self._call_later = call_later
+        self._lock = threading.Lock()
+        self._lines = []
+        self._bytes = 0
+        self._first = None
+        # Counts flushes so a timer knows if its lines already went out
+        self._flushes = 0
+
+    @classmethod
+    def from_config(cls, send_meth, corr_id, config, level='INFO',
+                    call_later=None):
+        """
+        Creates an instance from the 'output_buffer' worker config section.
+        """
+        return cls(
+            send_meth, corr_id, level,
+            max_lines=config.get('lines', 100),
+            max_bytes=config.get('bytes', 65536),
+            interval=config.get('interval', 1.0),
+            flush_level=config.get('flush_level', 'ERROR'),
+            call_later=call_later)
+
+    def _emit(self, levelno, message):
+        """
+        Adds a message to the buffer. Flushes when a threshold is hit.
+        """
+        now = time.time()
+        with self._lock:
+            if self._first is None:
+                self._first = now
+                if self._call_later is not None:
+                    flushes = self._flushes
+                    self._call_later(
+                        self.interval, lambda: self._on_interval(flushes))
+            self._lines.append(message)
+            self._bytes += len(message)
+            due = (levelno >= self._flush_level or
+                   len(self._lines) >= self.max_lines or
+                   self._bytes >= self.max_bytes or
+                   now - self._first >= self.interval)
+        if due:
+            self.flush()
+
+    def _on_interval(self, flushes):
+        """
+        Flushes the lines a timer was set for unless they already went out.
+        """
+        if self._flushes == flushes:
+            self.flush()
+
+    def flush(self):
+        """
+        Sends all buffered lines as one message.
+        """
+        # Held while sending so lines go out in order when a timer and the
+        # processing thread flush at once
+        with self._lock:
+            if self._lines:
+                lines = self._lines
+                self._lines = []
+                self._bytes = 0
+                self._first = None
+                self._flushes += 1
+                self.send('output', self.corr_id, {'messages': lines})
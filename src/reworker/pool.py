@@ -0,0 +1,411 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Thread pool and ioloop callback helpers for concurrent workers.
+"""
+
+import errno
+import fcntl
+import logging
+import os
+import Queue
+import select
+import threading
+import time
+import zlib
+
+
+def _remaining(deadline):
+    """
+    Returns the seconds left until deadline, or None if there is none.
+    """
+    if deadline is None:
+        return None
+    return max(deadline - time.time(), 0)
+
+
+class WorkerPool(object):
+    """
+    Bounded pool of threads which execute submitted callables.
+    """
+
+    def __init__(self, size, max_pending=None, name='reworker'):
+        """
+        Creates an instance of WorkerPool.
+
+        size is the number of threads to run.
+        max_pending is how many tasks may wait for a free thread before
+            submit blocks. 0 never blocks. Default: size
+        name is the prefix used when naming the threads.
+        """
+        if size < 1:
+            raise ValueError('WorkerPool size must be 1 or more.')
+        self.size = size
+        self.max_pending = size if max_pending is None else max_pending
+        self.name = name
+        self._tasks = Queue.Queue(self.max_pending)
+        self._logger = logging.getLogger(name)
+        self._lock = threading.Lock()
+        self._threads = []
+        self._retired = set()
+        self._started = 0
+        for _ in range(size):
+            self._start_thread()
+
+    def _start_thread(self):
+        """
+        Starts one more pool thread.
+        """
+        thread = threading.Thread(
+            target=self._run, name='%s-%s' % (self.name, self._started))
+        thread.daemon = True
+        thread.start()
+        self._started += 1
+        self._threads.append(thread)
+
+    def _run(self):
+        """
+        Thread loop. Executes tasks until a None task is received or the
+        thread is retired.
+        """
+        while True:
+            task = self._tasks.get()
+            try:
+                if task is None:
+                    return
+                func, args, kwargs = task
+                try:
+                    func(*args, **kwargs)
+                except Exception, ex:
+                    self._logger.error(
+                        'Unhandled error in pool task: %s: %s' % (
+                            type(ex), ex))
+            finally:
+                self._tasks.task_done()
+            if self._retired:
+                with self._lock:
+                    ident = threading.current_thread().ident
+                    if ident in self._retired:
+                        self._retired.discard(ident)
+                        return
+
+    def retire(self, ident):
+        """
+        Replaces the thread with the given ident, which is stuck in a task,
+        with a new thread. The old thread exits once its task returns.
+        Returns True if the thread belonged to this pool.
+        """
+        with self._lock:
+            for thread in self._threads:
+                if thread.ident == ident:
+                    break
+            else:
+                return False
+            self._logger.warn('Retiring stuck pool thread %s.' % thread.name)
+            self._threads.remove(thread)
+            self._retired.add(ident)
+            self._start_thread()
+            return True
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Queue func to be called with args and kwargs by a pool thread.
+        Blocks while max_pending tasks are already waiting.
+        """
+        self._tasks.put((func, args, kwargs))
+
+    def dispatch(self, key, func, *args, **kwargs):
+        """
+        Same as submit. key is accepted for compatibility with
+        KeyedWorkerPool and ignored.
+        """
+        self.submit(func, *args, **kwargs)
+
+    def shutdown(self, wait=True, timeout=None):
+        """
+        Stops all threads once the queued tasks have been executed.
+
+        wait will block until all threads have exited. Default: True
+        timeout is how many seconds to block at most. Default: None, no
+            limit
+
+        Returns True if every thread has exited.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        for _ in self._threads:
+            try:
+                self._tasks.put(None, timeout=_remaining(deadline))
+            except Queue.Full:
+                # Every thread is stuck with tasks waiting behind it
+                break
+        if wait:
+            return self.join(_remaining(deadline))
+        return not self.alive()
+
+    def join(self, timeout=None):
+        """
+        Blocks until all threads have exited after a shutdown, or at most
+        timeout seconds. Returns True if every thread has exited.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        for thread in list(self._threads):
+            thread.join(_remaining(deadline))
+        return not self.alive()
+
+    def alive(self):
+        """
+        Returns how many threads are still running.
+        """
+        return len([t for t in self._threads if t.is_alive()])
+
+
+class KeyedWorkerPool(object):
+    """
+    Pool of single threaded lanes. Tasks with the same key always run on
+    the same lane, in the order they were dispatched, while tasks with
+    different keys can run in parallel.
+    """
+
+    def __init__(self, lanes, max_pending=None, name='reworker'):
+        """
+        Creates an instance of KeyedWorkerPool.
+
+        lanes is the number of lanes (threads) to run.
+        max_pending is how many tasks may wait in each lane before
+            dispatch blocks. Default: 0, never block
+        name is the prefix used when naming the threads.
+        """
+        if lanes < 1:
+            raise ValueError('KeyedWorkerPool needs 1 or more lanes.')
+        self.size = lanes
+        self._lanes = [
+            WorkerPool(1, max_pending or 0, name='%s-lane%s' % (name, num))
+            for num in range(lanes)]
+
+    def lane_for(self, key):
+        """
+        Returns the lane number for key. Stable across processes.
+        """
+        return (zlib.crc32(str(key)) & 0xffffffff) % self.size
+
+    def dispatch(self, key, func, *args, **kwargs):
+        """
+        Queue func to be called with args and kwargs on key's lane.
+        Blocks while the lane's max_pending tasks are already waiting.
+        """
+        self._lanes[self.lane_for(key)].submit(func, *args, **kwargs)
+
+    def retire(self, ident):
+        """
+        Replaces the stuck thread with the given ident in whichever lane
+        it belongs to. Returns True if it was found.
+        """
+        for lane in self._lanes:
+            if lane.retire(ident):
+                return True
+        return False
+
+    def shutdown(self, wait=True, timeout=None):
+        """
+        Stops all lanes once the queued tasks have been executed.
+
+        wait will block until all threads have exited. Default: True
+        timeout is how many seconds to block at most. Default: None, no
+            limit
+
+        Returns True if every thread has exited.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        for lane in self._lanes:
+            lane.shutdown(wait=False, timeout=_remaining(deadline))
+        if wait:
+            for lane in self._lanes:
+                lane.join(_remaining(deadline))
+        return not self.alive()
+
+    def alive(self):
+        """
+        Returns how many threads are still running.
+        """
+        return sum(lane.alive() for lane in self._lanes)
+
+
+class IOLoopCallbacks(object):
+    """
+    Marshals calls from pool threads back onto the ioloop thread.
+
+    Queued calls wake the ioloop right away: through the connection's
+    add_callback_threadsafe when it has one, otherwise through a pipe
+    registered on the connection's poller. Pollers which can't take an
+    extra descriptor fall back to draining every interval.
+    """
+
+    def __init__(self, interval=0.01):
+        """
+        Creates an instance of IOLoopCallbacks.
+
+        interval is how often, in seconds, pending calls are drained when
+            the ioloop can not be woken.
+        """
+        self.interval = interval
+        self._logger = logging.getLogger('reworker')
+        self._pending = Queue.Queue()
+        self._connection = None
+        self._timeout = None
+        self._wake = None
+        self._woken = False
+        self._wake_lock = threading.Lock()
+        # Created once and never closed so a late write from a pool thread
+        # can't land on a reused descriptor
+        self._pipe = None
+        self.ioloop_thread = None
+
+    def start(self, connection):
+        """
+        Starts draining pending calls on the given connection's ioloop.
+        Must be called from the ioloop thread.
+        """
+        self._connection = connection
+        self.ioloop_thread = threading.current_thread()
+        self._woken = False
+        if hasattr(connection, 'add_callback_threadsafe'):
+            self._wake = lambda: connection.add_callback_threadsafe(
+                self._on_wake)
+        elif self._register_pipe(connection):
+            self._wake = lambda: os.write(self._pipe[1], 'x')
+        else:
+            self._wake = None
+            self._schedule()
+        if not self._pending.empty():
+            self.drain()
+
+    def _register_pipe(self, connection):
+        """
+        Registers the wake pipe with pika's poll or epoll poller. Returns
+        False if the poller can't take it.
+        """
+        poller = getattr(getattr(connection, 'ioloop', None), 'poller', None)
+        poll = getattr(poller, '_poll', None)
+        if poll is None or not hasattr(poller, '_handler'):
+            return False
+        if self._pipe is None:
+            self._pipe = os.pipe()
+            for fd in self._pipe:
+                flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+                fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        try:
+            poll.register(self._pipe[0], select.POLLIN)
+        except (IOError, OSError), ex:
+            self._logger.debug('Could not register wake pipe: %s' % ex)
+            return False
+        handler = poller._handler
+        pipe_fd = self._pipe[0]
+
+        def _handler(fileno, events, *args, **kwargs):
+            # pika's pollers send every event to the connection
+            if fileno == pipe_fd:
+                return self._on_wake()
+            return handler(fileno, events, *args, **kwargs)
+        poller._handler = _handler
+        return True
+
+    def stop(self):
+        """
+        Stops draining pending calls.
+        """
+        if self._connection is not None and self._timeout is not None:
+            self._connection.remove_timeout(self._timeout)
+        self._connection = None
+        self._timeout = None
+        self._wake = None
+
+    def in_ioloop(self):
+        """
+        Returns True if the caller is running on the ioloop thread.
+        """
+        return (self.ioloop_thread is None or
+                self.ioloop_thread is threading.current_thread())
+
+    def call(self, func, *args, **kwargs):
+        """
+        Calls func on the ioloop thread. If already on the ioloop thread
+        func is called right away.
+        """
+        if self.in_ioloop():
+            return func(*args, **kwargs)
+        self._pending.put((func, args, kwargs))
+        wake = self._wake
+        if wake is None:
+            return
+        with self._wake_lock:
+            if self._woken:
+                return
+            self._woken = True
+        try:
+            wake()
+        except (IOError, OSError), ex:
+            # A full pipe already wakes the ioloop
+            if ex.errno != errno.EAGAIN:
+                self._logger.warn('Could not wake the ioloop: %s' % ex)
+
+    def _on_wake(self):
+        """
+        Drains pending calls once woken. Runs on the ioloop thread.
+        """
+        # Reset first so calls queued while draining wake again
+        with self._wake_lock:
+            self._woken = False
+        if self._pipe is not None:
+            try:
+                while os.read(self._pipe[0], 4096):
+                    pass
+            except OSError, ex:
+                if ex.errno != errno.EAGAIN:
+                    raise
+        self.drain()
+
+    def drain(self):
+        """
+        Executes every pending call. Runs on the ioloop thread.
+        """
+        while True:
+            try:
+                func, args, kwargs = self._pending.get_nowait()
+            except Queue.Empty:
+                break
+            try:
+                func(*args, **kwargs)
+            except Exception, ex:
+                self._logger.error(
+                    'Unhandled error in ioloop callback: %s: %s' % (
+                        type(ex), ex))
+
+    def _on_timeout(self):
+        """
+        Timer callback which drains and then reschedules itself.
+        """
+        self._timeout = None
+        try:
+            self.drain()
+        finally:
+            self._schedule()
+
+    def _schedule(self):
+        """
+        Schedules the next drain on the connection.
+        """
+        if self._connection is not None:
+            self._timeout = self._connection.add_timeout(
+                self.interval, self._on_timeout)
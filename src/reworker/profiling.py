@@ -0,0 +1,140 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Sampling profiler for process() calls.
+"""
+
+import cProfile
+import os
+import os.path
+import pstats
+import threading
+import time
+
+from StringIO import StringIO
+
+
+class Profiler(object):
+    """
+    Profiles a sample of messages with cProfile and aggregates the stats.
+
+    Every Nth message, and every message whose correlation id is listed,
+    is profiled. The rest run untouched so the overhead stays bounded.
+    cProfile only follows the calling thread which keeps messages running
+    concurrently on other threads out of each other's stats.
+    """
+
+    def __init__(self, every=100, corr_ids=None, directory=None,
+                 dump_every=None, name='worker'):
+        """
+        Creates an instance of Profiler.
+
+        every profiles one in every this many messages. 0 profiles only
+        the listed correlation ids.
+        corr_ids is an optional list of correlation ids to always profile.
+        directory is where dump writes stats files.
+        dump_every dumps after every this many profiled messages when a
+            directory is set.
+        name starts the names of the stats files.
+        """
+        self.every = int(every or 0)
+        self.corr_ids = set(str(c) for c in (corr_ids or []))
+        self.directory = directory
+        if directory:
+            self.directory = os.path.realpath(os.path.expanduser(directory))
+        self.dump_every = dump_every
+        self.name = name
+        self.seen = 0
+        self.profiled = 0
+        self._stats = None
+        self._lock = threading.Lock()
+
+    def sampled(self, corr_id):
+        """
+        Returns True if the message with corr_id should be profiled.
+        """
+        with self._lock:
+            self.seen += 1
+            seen = self.seen
+        if str(corr_id) in self.corr_ids:
+            return True
+        return bool(self.every) and seen % self.every == 0
+
+    def call(self, func, *args, **kwargs):
+        """
+        Runs func under the profiler and adds its stats to the aggregate.
+        Returns what func returns.
+        """
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(func, *args, **kwargs)
+        finally:
+            self._add(profile)
+
+    def _add(self, profile):
+        """
+        Adds the stats of a finished profile to the aggregate.
+        """
+        with self._lock:
+            if self._stats is None:
+                self._stats = pstats.Stats(profile)
+            else:
+                self._stats.add(profile)
+            self.profiled += 1
+            if (self.directory and self.dump_every and
+                    self.profiled % self.dump_every == 0):
+                self._dump()
+
+    def dump(self):
+        """
+        Writes the aggregated stats to a new file in directory. Returns the
+        path, or None if nothing was profiled yet.
+        """
+        with self._lock:
+            return self._dump()
+
+    def _dump(self):
+        if self._stats is None:
+            return None
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        path = os.path.join(self.directory, '%s-%s-%d.prof' % (
+            self.name, os.getpid(), time.time() * 1000))
+        self._stats.dump_stats(path)
+        return path
+
+    def report(self, top=30):
+        """
+        Returns the top functions by cumulative time as text.
+        """
+        with self._lock:
+            if self._stats is None:
+                return 'Nothing profiled yet.'
+            stream = StringIO()
+            self._stats.stream = stream
+            self._stats.sort_stats('cumulative').print_stats(top)
+            return stream.getvalue()
+
+
+def from_config(config, name='worker'):
+    """
+    Creates the profiler described by the 'profile' worker config section.
+    """
+    return Profiler(
+        every=config.get('every', 100),
+        corr_ids=config.get('corr_ids', None),
+        directory=config.get('directory', None),
+        dump_every=config.get('dump_every', None),
+        name=name)
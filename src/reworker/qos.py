@@ -0,0 +1,182 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Prefetch (basic_qos) tuning.
+"""
+
+import math
+import threading
+import time
+
+
+class AdaptivePrefetch(object):
+    """
+    Tunes the prefetch count from recent process() latency.
+
+    The prefetch count is sized so that messages held locally can be worked
+    through in about target_wait seconds. Fast messages get a deeper
+    prefetch to keep the pipeline full, slow messages a shallow one so they
+    are left on the broker for other workers.
+    """
+
+    def __init__(self, initial=1, minimum=1, maximum=100, target_wait=1.0,
+                 workers=1, alpha=0.2, interval=5.0):
+        """
+        Creates an instance of AdaptivePrefetch.
+
+        initial is the prefetch count to start with.
+        minimum and maximum bound the prefetch count.
+        target_wait is how many seconds of work should be held locally.
+        workers is how many messages are processed at the same time.
+        alpha is the smoothing factor for the latency average.
+        interval is the minimum number of seconds between changes.
+        """
+        self.minimum = max(1, int(minimum))
+        self.maximum = max(self.minimum, int(maximum))
+        self.target_wait = float(target_wait)
+        self.workers = max(1, int(workers))
+        self.alpha = float(alpha)
+        self.interval = float(interval)
+        self.current = self._clamp(initial)
+        self.latency = None
+        self._last_change = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config, initial=1, workers=1):
+        """
+        Creates an instance from the 'prefetch_adaptive' worker config
+        section.
+        """
+        return cls(
+            initial=initial,
+            minimum=config.get('min', 1),
+            maximum=config.get('max', 100),
+            target_wait=config.get('target_wait', 1.0),
+            workers=workers,
+            alpha=config.get('alpha', 0.2),
+            interval=config.get('interval', 5.0))
+
+    def _clamp(self, count):
+        """
+        Keeps count within the minimum and maximum.
+        """
+        return min(self.maximum, max(self.minimum, int(count)))
+
+    def desired(self):
+        """
+        Returns the prefetch count for the current latency average.
+        """
+        if not self.latency:
+            return self.current
+        # Messages the workers can get through in target_wait seconds, plus
+        # one in flight per worker so none of them sit idle.
+        ahead = self.workers * self.target_wait / self.latency
+        return self._clamp(self.workers + int(math.ceil(ahead)))
+
+    def record(self, latency, now=None):
+        """
+        Records the latency, in seconds, of one process() call. Returns the
+        new prefetch count if it should change, otherwise None.
+        """
+        now = now or time.time()
+        with self._lock:
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency += self.alpha * (latency - self.latency)
+
+            if now - self._last_change < self.interval:
+                return None
+            desired = self.desired()
+            # Ignore small moves so the broker isn't sent a qos per message
+            if abs(desired - self.current) <= max(1, self.current // 4):
+                return None
+            self.current = desired
+            self._last_change = now
+            return desired
+
+
+class Backpressure(object):
+    """
+    Decides when consuming should pause and resume from high and low
+    watermarks on in-flight deliveries and pending outbound bytes.
+
+    Consuming pauses once either value goes above its high watermark and
+    resumes once both are back at or below their low watermarks.
+    """
+
+    def __init__(self, in_flight_high=None, in_flight_low=None,
+                 outbound_high=None, outbound_low=None, interval=0.1):
+        """
+        Creates an instance of Backpressure.
+
+        in_flight_high and in_flight_low are the watermarks for deliveries
+            being worked on. None disables the check.
+        outbound_high and outbound_low are the watermarks, in bytes, for
+            frames waiting in the connection's outbound buffer. None
+            disables the check.
+        interval is how often, in seconds, a paused worker checks whether
+            it can resume.
+
+        A missing low watermark defaults to half of its high watermark.
+        """
+        self.in_flight_high = in_flight_high
+        self.in_flight_low = self._low(in_flight_high, in_flight_low)
+        self.outbound_high = outbound_high
+        self.outbound_low = self._low(outbound_high, outbound_low)
+        self.interval = float(interval)
+        self.paused = False
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Creates an instance from the 'backpressure' worker config section.
+        """
+        return cls(
+            in_flight_high=config.get('in_flight_high'),
+            in_flight_low=config.get('in_flight_low'),
+            outbound_high=config.get('outbound_high'),
+            outbound_low=config.get('outbound_low'),
+            interval=config.get('interval', 0.1))
+
+    def _low(self, high, low):
+        """
+        Returns the low watermark to use for high.
+        """
+        if high is None:
+            return None
+        if low is None:
+            return high // 2
+        return min(low, high)
+
+    def _above(self, value, mark):
+        return mark is not None and value > mark
+
+    def update(self, in_flight, outbound_bytes):
+        """
+        Records the current in-flight count and outbound bytes. Returns
+        True if consuming should now pause or resume, see paused for which.
+        """
+        if not self.paused:
+            if (self._above(in_flight, self.in_flight_high) or
+                    self._above(outbound_bytes, self.outbound_high)):
+                self.paused = True
+                return True
+        elif not (self._above(in_flight, self.in_flight_low) or
+                  self._above(outbound_bytes, self.outbound_low)):
+            self.paused = False
+            return True
+        return False
@@ -0,0 +1,112 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Reconnect backoff.
+"""
+
+import math
+import random
+import time
+
+
+class Backoff(object):
+    """
+    Exponential backoff with jitter for reconnect attempts.
+
+    Each consecutive failure doubles (by multiplier) the ceiling of the
+    delay up to maximum. With jitter the delay is picked at random between
+    initial and the ceiling, which starts one step above initial, so a
+    fleet of workers doesn't reconnect in lock step after a broker
+    restart, not even on the first attempt.
+    """
+
+    def __init__(self, initial=1.0, maximum=60.0, multiplier=2.0,
+                 jitter=True):
+        """
+        Creates an instance of Backoff.
+
+        initial is the smallest delay in seconds.
+        maximum is the largest delay in seconds.
+        multiplier is how much the ceiling grows per consecutive failure.
+        jitter randomizes the delay when True. Default: True
+        """
+        self.initial = float(initial)
+        self.maximum = max(self.initial, float(maximum))
+        self.multiplier = float(multiplier)
+        self.jitter = jitter
+        #: Consecutive attempts since the last successful connection
+        self.attempts = 0
+        #: Total reconnects scheduled over the life of the worker
+        self.reconnects = 0
+        #: Total successful connections over the life of the worker
+        self.connects = 0
+        self.last_delay = None
+        self.last_connected = None
+        self.last_disconnected = None
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Creates an instance from the 'reconnect' worker config section.
+        """
+        return cls(
+            initial=config.get('initial', 1.0),
+            maximum=config.get('max', 60.0),
+            multiplier=config.get('multiplier', 2.0),
+            jitter=config.get('jitter', True))
+
+    def next_delay(self):
+        """
+        Returns the delay before the next attempt and counts the attempt.
+        """
+        exponent = self.attempts
+        if self.jitter:
+            exponent += 1
+        if self.multiplier > 1 and self.initial > 0:
+            # Past this the ceiling is maximum anyway and the power would
+            # overflow after a long enough outage
+            exponent = min(exponent, int(math.ceil(math.log(
+                self.maximum / self.initial, self.multiplier))))
+        ceiling = min(self.maximum, self.initial * self.multiplier ** exponent)
+        if self.jitter:
+            delay = random.uniform(self.initial, ceiling)
+        else:
+            delay = ceiling
+        self.attempts += 1
+        self.reconnects += 1
+        self.last_delay = delay
+        self.last_disconnected = time.time()
+        return delay
+
+    def reset(self):
+        """
+        Marks a successful connection. The next delay starts from initial.
+        """
+        self.attempts = 0
+        self.connects += 1
+        self.last_connected = time.time()
+
+    def stats(self):
+        """
+        Returns the reconnect counters as a dictionary.
+        """
+        return {
+            'attempts': self.attempts,
+            'reconnects': self.reconnects,
+            'connects': self.connects,
+            'last_delay': self.last_delay,
+            'last_connected': self.last_connected,
+            'last_disconnected': self.last_disconnected,
+        }
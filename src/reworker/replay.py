@@ -0,0 +1,147 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Replays a capture file into a worker running on the in memory broker.
+
+Run with: python -m reworker.replay CAPTURE module.WorkerClass [-s SPEED]
+"""
+
+import collections
+import time
+
+from reworker import bench, capture
+from reworker.fake import FakeBroker
+
+
+def load_worker_class(name):
+    """
+    Imports and returns the worker class named 'module.Class' or
+    'module:Class'.
+    """
+    if ':' in name:
+        module_name, class_name = name.split(':', 1)
+    else:
+        module_name, class_name = name.rsplit('.', 1)
+    module = __import__(module_name, fromlist=[class_name])
+    return getattr(module, class_name)
+
+
+def replay(path, WorkerCls, config_file=None, speed=1.0, timeout=None,
+           logger=None):
+    """
+    Feeds the deliveries recorded at path to a WorkerCls. Returns a
+    dictionary of results like bench.run_scenario.
+
+    speed scales the recorded gaps between deliveries. 1 keeps the
+    original timing, 10 is ten times faster and 0 delivers everything at
+    once.
+    timeout is how many seconds to wait for the worker to settle every
+    delivery. Default: the recorded duration at speed plus 60 seconds.
+    """
+    records = collections.deque(capture.read(path))
+    total = len(records)
+    broker = FakeBroker()
+    worker = bench.start_worker(WorkerCls, broker, config_file, logger)
+    if worker._capture is not None:
+        # Never record the replay, possibly over the file being read
+        worker._capture.close()
+        worker._capture = None
+    ioloop = worker._connection.ioloop
+    queue = worker._queue
+
+    first = records[0][0] if records else 0
+    recorded = records[-1][0] - first if records else 0
+    if timeout is None:
+        timeout = (recorded / speed if speed else 0) + 60
+    started = time.time()
+    deadline = started + timeout
+    while time.time() < deadline:
+        now = time.time()
+        while records and (
+                not speed or started + (records[0][0] - first) / speed <= now):
+            _, redelivered, properties, body = records.popleft()
+            broker.put(queue, body, properties, redelivered)
+        settled = broker.acked + broker.rejected
+        if not records and settled >= total and not broker.queue(queue):
+            break
+        if ioloop.poll() == 0:
+            time.sleep(0.0005)
+    ioloop.poll()
+    elapsed = time.time() - started
+
+    if worker._pool is not None:
+        # Threads still running at interpreter exit die noisily but a hung
+        # process must not outlast the timeout. A second of grace lets
+        # threads which are done pick up the shutdown.
+        worker._pool.shutdown(timeout=max(deadline - time.time(), 1))
+    return {
+        'scenario': '%s x%s' % (path, speed or 'max'),
+        'messages': broker.acked + broker.rejected,
+        'acked': broker.acked,
+        'rejected': broker.rejected,
+        'unsettled': total - broker.acked - broker.rejected,
+        'seconds': elapsed,
+        'recorded_seconds': recorded,
+        'msgs_per_sec': broker.acked / elapsed if elapsed else 0.0,
+        'published': len(broker.published),
+        'stages': {
+            'deliver_to_ack': bench.percentiles(broker.ack_latencies),
+        },
+        'alloc_peak_bytes': None,
+        'objects_retained': None,
+    }
+
+
+def main(argv=None):
+    """
+    Command line entry point.
+    """
+    import json
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description='Replay captured deliveries.')
+    parser.add_argument('capture', help='Capture file to replay.')
+    parser.add_argument(
+        'worker', help='Worker class as module.Class or module:Class.')
+    parser.add_argument(
+        '-c', '--config',
+        required=False,
+        help='Config file for the worker.')
+    parser.add_argument(
+        '-s', '--speed',
+        type=float,
+        default=1.0,
+        help=('Multiple of the recorded speed. 0 replays as fast as '
+              'possible. Default: 1'))
+    parser.add_argument(
+        '--json',
+        action='store_true',
+        default=False,
+        help='Print the result as JSON.')
+    args = parser.parse_args(argv)
+
+    result = replay(
+        args.capture, load_worker_class(args.worker), args.config,
+        args.speed)
+    if args.json:
+        print json.dumps(result, indent=2)
+    else:
+        print bench.format_result(result)
+        print '  recorded over %.3fs, %d acked, %d rejected' % (
+            result['recorded_seconds'], result['acked'], result['rejected'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Message body serializers.
+"""
+
+import json
+
+try:
+    import ujson as _fastjson
+except ImportError:
+    try:
+        import simplejson as _fastjson
+    except ImportError:
+        _fastjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class Serializer(object):
+    """
+    Encodes and decodes message bodies for a content type.
+    """
+
+    def __init__(self, name, content_type, dumps, loads):
+        """
+        Creates an instance of Serializer.
+
+        name is the name used in the worker config.
+        content_type is the content type advertised on messages.
+        dumps is a callable which encodes a structure to a string.
+        loads is a callable which decodes a string to a structure.
+        """
+        self.name = name
+        self.content_type = content_type
+        self._dumps = dumps
+        self._loads = loads
+
+    def dumps(self, message_struct):
+        """
+        Encodes message_struct.
+        """
+        return self._dumps(message_struct)
+
+    def loads(self, body):
+        """
+        Decodes body. Any decoding error is raised as a ValueError.
+        """
+        try:
+            return self._loads(body)
+        except ValueError:
+            raise
+        except Exception, ex:
+            raise ValueError('Could not decode %s body: %s' % (
+                self.content_type, ex))
+
+
+def _msgpack_loads(body):
+    """
+    Decodes msgpack with strings as text across msgpack versions.
+    """
+    try:
+        return msgpack.unpackb(body, raw=False)
+    except TypeError:
+        return msgpack.unpackb(body, encoding='utf-8')
+
+
+JSON = Serializer('json', 'application/json', json.dumps, json.loads)
+
+#: Serializers by config name. Optional libraries are only listed when
+#: they are installed, except fastjson which falls back to json.
+SERIALIZERS = {
+    'json': JSON,
+    'fastjson': JSON,
+}
+if _fastjson is not None:
+    SERIALIZERS['fastjson'] = Serializer(
+        'fastjson', 'application/json', _fastjson.dumps, _fastjson.loads)
+if msgpack is not None:
+    SERIALIZERS['msgpack'] = Serializer(
+        'msgpack', 'application/x-msgpack',
+        lambda m: msgpack.packb(m, use_bin_type=True), _msgpack_loads)
+
+
+def get_serializer(name):
+    """
+    Returns the serializer for the config name. Raises ValueError if it is
+    unknown or its library is not installed.
+    """
+    try:
+        return SERIALIZERS[name]
+    except KeyError:
+        raise ValueError(
+            'Unknown or unavailable serializer %s. Available: %s' % (
+                name, ", ".join(sorted(SERIALIZERS.keys()))))
+
+
+def for_content_type(content_type, preferred=None):
+    """
+    Returns the serializer used to decode a body of content_type. The
+    preferred serializer is used when its content type matches. Missing or
+    unknown content types are decoded as JSON since that is what every
+    message used to be.
+    """
+    if preferred is not None and preferred.content_type == content_type:
+        return preferred
+    packer = SERIALIZERS.get('msgpack')
+    if packer is not None and packer.content_type == content_type:
+        return packer
+    return JSON
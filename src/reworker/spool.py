@@ -0,0 +1,173 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Durable spool for publishes made while disconnected.
+"""
+
+import errno
+import fcntl
+import mmap
+import os
+import os.path
+import struct
+import threading
+
+#: Journal header: magic, read offset, write offset
+HEADER = struct.Struct('>8sQQ')
+MAGIC = 'RWSPOOL1'
+#: Record header: lengths of exchange, routing key, corr_id, reply_to, body
+RECORD = struct.Struct('>HHHHI')
+
+
+class Spool(object):
+    """
+    Append only journal of unsent publishes in a memory mapped file.
+
+    Records are kept in the order they were appended, which keeps the
+    order of the messages of every correlation id, and survive a restart
+    of the worker. The file is created at max_bytes so disk use never
+    grows past it. Appends which do not fit are refused.
+
+    Offsets are kept in memory so one process owns the journal at a time.
+    It is locked with flock and opening a journal another process holds
+    raises IOError.
+    """
+
+    def __init__(self, path, max_bytes=64 * 1024 * 1024, sync=True):
+        """
+        Creates an instance of Spool.
+
+        path is the journal file. It is created if needed.
+        max_bytes is the size of the journal file.
+        sync flushes every append to disk when True. Default: True
+        """
+        self.path = os.path.realpath(os.path.expanduser(path))
+        self.sync = sync
+        self._lock = threading.Lock()
+        exists = os.path.exists(self.path)
+        self._file = open(self.path, 'r+b' if exists else 'w+b')
+        try:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, ioe:
+            self._file.close()
+            if ioe.errno in (errno.EACCES, errno.EAGAIN):
+                raise IOError(
+                    ioe.errno,
+                    'Spool %s is in use by another process' % self.path)
+            raise
+        size = os.fstat(self._file.fileno()).st_size
+        self.max_bytes = max(size, int(max_bytes), HEADER.size + 1024)
+        if size < self.max_bytes:
+            # Sparse on most filesystems until written
+            self._file.truncate(self.max_bytes)
+        self._map = mmap.mmap(self._file.fileno(), self.max_bytes)
+        magic, self._read, self._write = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            self._read = self._write = HEADER.size
+            self._write_header()
+
+    def _write_header(self):
+        """
+        Stores the offsets in the journal header.
+        """
+        HEADER.pack_into(self._map, 0, MAGIC, self._read, self._write)
+
+    def __len__(self):
+        """
+        Returns the number of bytes of records waiting to be drained.
+        """
+        return self._write - self._read
+
+    def append(self, exchange, routing_key, corr_id, reply_to, body):
+        """
+        Appends a publish to the journal. Returns False if it does not fit.
+        """
+        fields = [str(exchange), str(routing_key), str(corr_id),
+                  str(reply_to or ''), body]
+        record = RECORD.pack(*[len(f) for f in fields]) + ''.join(fields)
+        with self._lock:
+            if self._write + len(record) > self.max_bytes:
+                return False
+            self._map[self._write:self._write + len(record)] = record
+            self._write += len(record)
+            self._write_header()
+            if self.sync:
+                self._map.flush()
+        return True
+
+    def records(self):
+        """
+        Returns every waiting publish as a list of
+        (exchange, routing_key, corr_id, reply_to, body) tuples, oldest
+        first.
+        """
+        found = []
+        with self._lock:
+            offset = self._read
+            while offset < self._write:
+                lengths = RECORD.unpack_from(self._map, offset)
+                offset += RECORD.size
+                fields = []
+                for length in lengths:
+                    fields.append(self._map[offset:offset + length])
+                    offset += length
+                found.append(tuple(fields))
+        return found
+
+    def clear(self):
+        """
+        Forgets every record once they have been published.
+        """
+        with self._lock:
+            self._read = self._write = HEADER.size
+            self._write_header()
+            if self.sync:
+                self._map.flush()
+
+    def release(self, count):
+        """
+        Forgets the oldest count records once they have been published.
+        Records appended since they were read are kept.
+        """
+        with self._lock:
+            for _ in range(count):
+                if self._read >= self._write:
+                    break
+                lengths = RECORD.unpack_from(self._map, self._read)
+                self._read += RECORD.size + sum(lengths)
+            if self._read >= self._write:
+                self._read = self._write = HEADER.size
+            self._write_header()
+            if self.sync:
+                self._map.flush()
+
+    def close(self):
+        """
+        Unmaps and closes the journal file.
+        """
+        with self._lock:
+            self._map.flush()
+            self._map.close()
+            self._file.close()
+
+
+def from_config(config):
+    """
+    Creates the spool described by the 'spool' worker config section.
+    """
+    return Spool(
+        config['path'],
+        max_bytes=config.get('max_bytes', 64 * 1024 * 1024),
+        sync=config.get('sync', True))
@@ -0,0 +1,308 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Prefork supervisor which runs workers in child processes.
+"""
+
+import errno
+import logging
+import os
+import signal
+import sys
+import time
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+from reworker.reconnect import Backoff
+
+# Python 2 has no signal.pthread_sigmask. Use libc's on Linux, where the
+# SIG_BLOCK and SIG_SETMASK values and sigset_t size are known.
+_libc = None
+if not hasattr(signal, 'pthread_sigmask') and sys.platform.startswith('linux'):
+    try:
+        import ctypes
+        import ctypes.util
+        _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        _libc.pthread_sigmask
+    except (ImportError, OSError, AttributeError):
+        _libc = None
+
+#: Signals which stop the supervisor and its children
+STOP_SIGNALS = (signal.SIGTERM, signal.SIGINT)
+
+#: Slot of this process when it is a supervised child, otherwise None
+_slot = None
+
+
+def current_slot():
+    """
+    Returns the slot number of this process when it was started by a
+    Supervisor, otherwise None.
+    """
+    return _slot
+
+
+def pin_to_cpu(cpu, logger=None):
+    """
+    Pins the current process to cpu. Returns True on success.
+
+    Uses os.sched_setaffinity when available, otherwise psutil if it is
+    installed.
+    """
+    logger = logger or logging.getLogger('reworker')
+    try:
+        if hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, set([cpu]))
+        elif psutil is not None:
+            psutil.Process(os.getpid()).cpu_affinity([cpu])
+        else:
+            logger.warn('CPU pinning needs psutil on this Python. Skipping.')
+            return False
+    except (OSError, ValueError, AttributeError), ex:
+        logger.warn('Could not pin to CPU %s: %s' % (cpu, ex))
+        return False
+    return True
+
+
+def _block_signals(signums):
+    """
+    Blocks signums in the calling thread. Signals sent meanwhile stay
+    pending. Returns the previous mask for _restore_signals, or None where
+    signals can not be blocked.
+    """
+    if hasattr(signal, 'pthread_sigmask'):
+        return signal.pthread_sigmask(signal.SIG_BLOCK, signums)
+    if _libc is None:
+        return None
+    new = (ctypes.c_ubyte * 128)()
+    old = (ctypes.c_ubyte * 128)()
+    _libc.sigemptyset(ctypes.byref(new))
+    for signum in signums:
+        _libc.sigaddset(ctypes.byref(new), signum)
+    # 0 is SIG_BLOCK on Linux
+    if _libc.pthread_sigmask(0, ctypes.byref(new), ctypes.byref(old)) != 0:
+        return None
+    return old
+
+
+def _restore_signals(previous):
+    """
+    Restores the mask _block_signals returned. Pending signals are
+    delivered.
+    """
+    if previous is None:
+        return
+    if hasattr(signal, 'pthread_sigmask'):
+        signal.pthread_sigmask(signal.SIG_SETMASK, previous)
+    else:
+        # 2 is SIG_SETMASK on Linux
+        _libc.pthread_sigmask(2, ctypes.byref(previous), None)
+
+
+def cpu_count():
+    """
+    Returns the number of CPUs, or 1 if it can not be found.
+    """
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return 1
+
+
+class Supervisor(object):
+    """
+    Forks a number of children which each run a worker and keeps them
+    running.
+
+    Children which exit are restarted with a backoff per slot. SIGTERM and
+    SIGINT are forwarded to the children as SIGTERM so they drain, and the
+    supervisor exits once they all have.
+    """
+
+    #: Seconds a child must run before its restart backoff is reset
+    stable_after = 60
+
+    def __init__(self, target, processes, pin_cpus=False, logger=None,
+                 backoff=None):
+        """
+        Creates an instance of Supervisor.
+
+        target is called in each child with the child's slot number. The
+            child exits with 0 when it returns and 1 if it raises.
+        processes is the number of children to run.
+        pin_cpus pins each child to a CPU when True. Default: False
+        logger is an optional logger.
+        backoff is an optional dictionary of Backoff settings for restarts.
+        """
+        self.target = target
+        self.processes = processes
+        self.pin_cpus = pin_cpus
+        self.logger = logger or logging.getLogger('reworker.supervisor')
+        self._backoff_config = backoff or {}
+        self._stopping = False
+        #: pid -> (slot, start time)
+        self.children = {}
+        self._backoffs = dict(
+            (slot, Backoff.from_config(self._backoff_config))
+            for slot in range(processes))
+        #: slot -> time the slot should be restarted
+        self._restart_at = {}
+        #: Stop signals which arrived while forking
+        self._held = []
+        #: Signal mask from before forking
+        self._mask = None
+
+    def _spawn(self, slot):
+        """
+        Forks a child for slot.
+        """
+        # A stop signal arriving in the child before it resets its handlers
+        # would run the parent's handler there, or on Python 2 be dropped
+        # before the child knows its pid. Block them while forking and
+        # deliver them once each side has its own handlers. Where they can
+        # not be blocked they are held by a handler instead.
+        self._held = []
+        handlers = dict(
+            (signum, signal.signal(signum, self._hold))
+            for signum in STOP_SIGNALS)
+        self._mask = _block_signals(STOP_SIGNALS)
+        pid = os.fork()
+        if pid == 0:
+            self._run_child(slot)
+        for signum, handler in handlers.items():
+            signal.signal(
+                signum, signal.SIG_DFL if handler is None else handler)
+        _restore_signals(self._mask)
+        self.children[pid] = (slot, time.time())
+        self.logger.info('Started child %s for slot %s.' % (pid, slot))
+        for signum in self._held:
+            os.kill(os.getpid(), signum)
+        return pid
+
+    def _hold(self, signum, frame):
+        """
+        Records a stop signal which arrived while forking.
+        """
+        self._held.append(signum)
+
+    def _run_child(self, slot):
+        """
+        Runs target in the child and exits. Never returns.
+        """
+        global _slot
+        code = 0
+        try:
+            _slot = slot
+            for signum in STOP_SIGNALS:
+                signal.signal(signum, signal.SIG_DFL)
+            _restore_signals(self._mask)
+            for signum in self._held:
+                os.kill(os.getpid(), signum)
+            if self.pin_cpus:
+                pin_to_cpu(slot % cpu_count(), self.logger)
+            self.target(slot)
+        except SystemExit, se:
+            code = se.code if isinstance(se.code, int) else 0
+        except BaseException, ex:
+            self.logger.error('Child for slot %s failed: %s: %s' % (
+                slot, type(ex), ex))
+            code = 1
+        os._exit(code)
+
+    def _on_signal(self, signum, frame):
+        """
+        Forwards a stop signal to every child.
+        """
+        self.logger.info(
+            'Signal %s received. Stopping %s children.' % (
+                signum, len(self.children)))
+        self._stopping = True
+        self._restart_at.clear()
+        for pid in self.children.keys():
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def _reap(self):
+        """
+        Collects exited children and schedules their restarts.
+        """
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError, oe:
+                if oe.errno == errno.EINTR:
+                    continue
+                if oe.errno == errno.ECHILD:
+                    self.children.clear()
+                break
+            if pid == 0:
+                break
+            slot, started = self.children.pop(pid, (None, None))
+            if slot is None:
+                continue
+            if status == 0:
+                self.logger.info('Child %s for slot %s exited cleanly.' % (
+                    pid, slot))
+            else:
+                self.logger.warn(
+                    'Child %s for slot %s exited with status %s.' % (
+                        pid, slot, status))
+            if self._stopping:
+                continue
+            if status == 0:
+                # A clean exit is a recycle, not a crash
+                self.logger.info('Restarting slot %s.' % slot)
+                self._restart_at[slot] = time.time()
+                continue
+            backoff = self._backoffs[slot]
+            if time.time() - started >= self.stable_after:
+                backoff.reset()
+            delay = backoff.next_delay()
+            self.logger.info('Restarting slot %s in %.1f seconds.' % (
+                slot, delay))
+            self._restart_at[slot] = time.time() + delay
+
+    def _restart_due(self):
+        """
+        Spawns children whose restart time has come.
+        """
+        now = time.time()
+        for slot, when in self._restart_at.items():
+            if when <= now:
+                del self._restart_at[slot]
+                self._spawn(slot)
+
+    def run(self, poll=0.2):
+        """
+        Starts the children and supervises them until stopped.
+
+        poll is how often, in seconds, children are checked on.
+        """
+        for signum in STOP_SIGNALS:
+            signal.signal(signum, self._on_signal)
+        for slot in range(self.processes):
+            self._spawn(slot)
+        while self.children or (self._restart_at and not self._stopping):
+            self._reap()
+            if not self._stopping:
+                self._restart_due()
+            time.sleep(poll)
+        self.logger.info('All children exited.')
@@ -16,17 +16,53 @@
 The worker class.
 """
 
+import collections
 import datetime
 import json
 import logging
 import os.path
+import signal
+import threading
 import time
 
 import pika
 import pika.exceptions
 import ssl
 
-from reworker.output import Output
+from reworker.acks import AckBatcher
+from reworker.brokers import BrokerSelector
+from reworker import capture
+from reworker.confirms import Confirmation, ConfirmTracker
+from reworker import dedup
+from reworker.manager import ConnectionManager
+from reworker import memory
+from reworker.metrics import Metrics, MetricsServer
+from reworker.output import BufferedOutput, Output
+from reworker.pool import IOLoopCallbacks, KeyedWorkerPool, WorkerPool
+from reworker import profiling
+from reworker.qos import AdaptivePrefetch, Backpressure
+from reworker.reconnect import Backoff
+from reworker import serializers
+from reworker import spool
+from reworker.supervisor import Supervisor, current_slot
+
+
+class BatchMessage(object):
+    """
+    One decoded delivery handed to process_batch.
+    """
+
+    def __init__(self, basic_deliver, properties, body, output,
+                 notify_cfg=None, dedup_key=None):
+        """
+        Creates an instance of BatchMessage.
+        """
+        self.basic_deliver = basic_deliver
+        self.properties = properties
+        self.body = body
+        self.output = output
+        self.notify_cfg = notify_cfg or {}
+        self.dedup_key = dedup_key
 
 
 class Worker(object):
@@ -37,14 +73,21 @@ class Worker(object):
     #: All inputs which should be passed in via body['dynamic'][ITEM]
     dynamic = ()
 
+    #: How many prepared BasicProperties send keeps for reuse
+    properties_cache_size = 256
+
     def __init__(self, mq_config, config_file=None,
-                 logger=None, **kwargs):
+                 logger=None, manager=None, connection_class=None,
+                 **kwargs):
         """
         Creates an instance of a Worker.
 
         mq_config should house: user, password, server, port and vhost.
+            server may be a list of brokers to fail over between.
         config_file is an optional full path to a json config file
         logger is an optional logger. Defaults to a logger to stderr
+        manager is an optional ConnectionManager whose connection is shared
+        connection_class is an optional stand-in for pika.SelectConnection
         **kwargs is all other keyword arguments
         """
         # NOTE: self.app_logger is the application level logger.
@@ -70,6 +113,15 @@ class Worker(object):
         # Closing should be True when we are meaning to close conenction
         self._closing = False
         self._connected = False
+        self._connection = None
+        self._channel = None
+        # Counts opened channels. Delivery tags only mean something on the
+        # channel they came from so deliveries carry the generation they
+        # were received in and calls for older ones are dropped.
+        self._generation = 0
+        self._connection_class = connection_class
+        # Seconds to wait before the next connect, None if none is pending
+        self._retry_in = None
 
         if kwargs:
             for key in kwargs.keys():
@@ -77,17 +129,258 @@ class Worker(object):
                     key, self.__class__.__name__))
 
         self._config = {}
-        self.__notify_cfg = {}
+        # Per message state. Thread local so concurrent messages don't mix.
+        self._message_state = threading.local()
         if config_file:
             with open(os.path.realpath(os.path.expanduser(
                     config_file)), 'r') as f_obj:
                 self._config = json.load(f_obj)
 
+        # Optional concurrent processing. When 'concurrency' is set in the
+        # worker config deliveries are handed to a pool of that many threads
+        # and all channel calls are marshalled back onto the ioloop thread.
+        # With 'concurrency_mode' set to 'keyed' the threads are lanes and
+        # messages sharing a correlation id run in order on the same lane.
+        self._callbacks = IOLoopCallbacks()
+        self._pool = None
+        concurrency = int(self._config.get('concurrency', 0))
+        mode = self._config.get('concurrency_mode', 'pool')
+        if concurrency > 0 and mode not in ('pool', 'keyed'):
+            raise ValueError('Unknown concurrency_mode %s' % mode)
+        # Optional offloading. With 'offload' set and no concurrency,
+        # messages still run one at a time in delivery order but on a
+        # background thread so the ioloop keeps servicing heartbeats during
+        # long steps.
+        offload = self._config.get('offload', False) and concurrency <= 0
+
+        # Optional basic_qos prefetch count. 'prefetch_adaptive' tunes the
+        # count at runtime from recent process() latency.
+        self._prefetch = self._config.get('prefetch', None)
+
+        # Optional batching. With 'batch' set deliveries are collected until
+        # 'size' are waiting or 'window' seconds pass and handed to
+        # process_batch together. Each is acked or rejected (requeued if
+        # 'requeue') by its result. Read before the prefetch defaults below
+        # so a batch can fill and the pool queue is sized to match.
+        self._batch_config = self._config.get('batch', None)
+        self._batch = []
+        self._batch_timeout = None
+        if self._batch_config is not None:
+            self._batch_size = int(self._batch_config.get('size', 100))
+            self._batch_window = float(self._batch_config.get('window', 1.0))
+            self._batch_requeue = self._batch_config.get('requeue', False)
+            # A smaller prefetch would never fill a batch
+            self._prefetch = self._prefetch or self._batch_size
+
+        if concurrency > 0:
+            # Every thread busy and 'concurrency_queue' messages waiting
+            self._prefetch = self._prefetch or concurrency + int(
+                self._config.get('concurrency_queue', None) or concurrency)
+        elif offload:
+            self._prefetch = self._prefetch or 1
+        self._adaptive_prefetch = None
+        if self._config.get('prefetch_adaptive', None) is not None:
+            self._adaptive_prefetch = AdaptivePrefetch.from_config(
+                self._config['prefetch_adaptive'],
+                initial=self._prefetch or max(concurrency, 1),
+                workers=max(concurrency, 1))
+            self._prefetch = self._adaptive_prefetch.current
+
+        # The pool queue holds every unacked delivery so handing one over
+        # never blocks the ioloop. Keyed lanes are unbounded as any number
+        # of messages may share one.
+        max_unacked = self._prefetch
+        if self._adaptive_prefetch is not None:
+            max_unacked = self._adaptive_prefetch.maximum
+        name = self.__class__.__name__.lower()
+        if concurrency > 0:
+            if mode == 'keyed':
+                self._pool = KeyedWorkerPool(concurrency, name=name)
+            else:
+                self._pool = WorkerPool(
+                    concurrency, max_pending=max_unacked, name=name)
+            self.app_logger.info(
+                'Processing up to %s messages concurrently (%s).' % (
+                    concurrency, mode))
+        elif offload:
+            self._pool = WorkerPool(1, max_pending=max_unacked, name=name)
+            self.app_logger.info('Processing messages off the ioloop.')
+
+        self._backoff = Backoff.from_config(self._config.get('reconnect', {}))
+
+        # Body serializer for sent messages. Incoming bodies are decoded
+        # based on their content_type.
+        self._serializer = serializers.get_serializer(
+            self._config.get('serializer', 'json'))
+
+        # Prepared publish state. Properties are reused for every publish
+        # with the same correlation id and reply_to and status bodies are
+        # serialized once.
+        self._app_id = str(self.__class__.__name__.lower())
+        self._properties = collections.OrderedDict()
+        self._properties_lock = threading.Lock()
+        self._status_bodies = dict(
+            (status, self._serializer.dumps({'status': status}))
+            for status in ('started', 'completed', 'failed'))
+
+        # Optional publisher confirms. send returns a Confirmation per
+        # publish which the broker resolves.
+        self._confirms = None
+        if self._config.get('publisher_confirms', False):
+            self._confirms = ConfirmTracker()
+
+        # Optional ack batching. Completed tags are acked with multiple=True
+        # once 'size' are waiting or after 'interval' seconds.
+        self._acks = None
+        self._ack_timeout = None
+        if self._config.get('ack_batch', None) is not None:
+            self._acks = AckBatcher.from_config(self._config['ack_batch'])
+
+        # Optional duplicate delivery cache. Final statuses are cached by
+        # correlation id and body digest and replayed for redeliveries.
+        self._dedup = None
+        self._dedup_always = False
+        if self._config.get('dedup', None) is not None:
+            self._dedup = dedup.from_config(self._config['dedup'])
+            self._dedup_always = self._config['dedup'].get('always', False)
+
+        # Optional durable spool. Publishes made while disconnected are
+        # journaled to 'path' and published after the next reconnect. Under
+        # --processes each child journals to 'path' suffixed with its slot.
+        self._spool = None
+        self._spooled_confirms = collections.deque()
+        # Held while the channel comes and goes so pool threads can spool
+        # directly during an outage without racing the ioloop
+        self._spool_lock = threading.RLock()
+        if self._config.get('spool', None) is not None:
+            spool_config = dict(self._config['spool'])
+            if current_slot() is not None:
+                spool_config['path'] = '%s.%s' % (
+                    spool_config['path'], current_slot())
+            self._spool = spool.from_config(spool_config)
+
+        # Optional capture. Every delivery is recorded to 'path' for replay
+        # with python -m reworker.replay.
+        self._capture = None
+        if self._config.get('capture', None) is not None:
+            self._capture = capture.from_config(self._config['capture'])
+            self.app_logger.info(
+                'Capturing deliveries to %s' % self._capture.path)
+
+        # Optional backpressure. Consuming is cancelled while in-flight
+        # deliveries or outbound bytes are above their high watermarks.
+        self._backpressure = None
+        self._flow_timeout = None
+        if self._config.get('backpressure', None) is not None:
+            self._backpressure = Backpressure.from_config(
+                self._config['backpressure'])
+
+        # Optional per message deadlines. Messages running longer than
+        # 'timeout' seconds, or the number of seconds in the body's 'field',
+        # are failed and rejected and their processing is cancelled.
+        # Nothing can safely interrupt process() on the ioloop thread so
+        # deadlines need 'offload' or 'concurrency'.
+        self._deadline_config = self._config.get('deadline', None)
+        if self._deadline_config is not None and not self._uses_threads():
+            raise ValueError(
+                "'deadline' needs 'offload' or 'concurrency' to be set")
+        self._deadlines = {}
+        self._expired = set()
+
+        # Optional sampling profiler. One in 'every' messages, and those
+        # whose correlation id is in 'corr_ids', run process() under
+        # cProfile. The aggregate is written to 'directory' on 'signal'
+        # (default SIGUSR2) and every 'dump_every' profiled messages, or
+        # logged on 'signal' when no directory is set.
+        self._profiler = None
+        if self._config.get('profile', None) is not None:
+            self._profiler = profiling.from_config(
+                self._config['profile'], name=self.__class__.__name__.lower())
+            signame = self._config['profile'].get('signal', 'SIGUSR2')
+            if signame and threading.current_thread().name == 'MainThread':
+                signal.signal(
+                    getattr(signal, signame), self._on_profile_signal)
+
+        # Optional per message memory accounting. With 'memory' set the
+        # memory process() leaves allocated is observed and logged above
+        # 'log_above' bytes. tracemalloc is used when it is available. The
+        # figures are process wide so messages must run one at a time.
+        self._allocations = None
+        self._allocations_log_above = None
+        memory_config = self._config.get('memory', None)
+        if memory_config is not None and (
+                concurrency > 0 or (offload and self._batch_config)):
+            self.app_logger.warn(
+                'Memory accounting is per process and messages do not run '
+                'one at a time. Ignoring memory.')
+            memory_config = None
+        if memory_config is not None:
+            self._allocations = memory.AllocationTracker(
+                memory_config.get('frames', 1))
+            self._allocations_log_above = memory_config.get(
+                'log_above', None)
+            if not self._allocations.traced:
+                self.app_logger.warn(
+                    'tracemalloc is not available. Measuring allocations '
+                    'by resident size.')
+
+        # Optional recycling. After 'max_messages' messages, or once the
+        # resident size passes 'max_rss_mb', the worker drains and exits so
+        # its supervisor starts a fresh one.
+        self._recycle = None
+        if self._config.get('recycle', None) is not None:
+            self._recycle = memory.RecyclePolicy.from_config(
+                self._config['recycle'])
+
+        # Metrics are always recorded. 'metrics' in the worker config
+        # (port, address) serves them in the Prometheus text format. Under
+        # --processes each child serves on port plus its slot number.
+        self.metrics = Metrics()
+        self._received = {}
+        # Deliveries handed to _handle which have not finished yet
+        self._in_flight = 0
+        self._metrics_server = None
+        if self._config.get('metrics', None) is not None:
+            metrics_port = int(self._config['metrics'].get('port', 0))
+            if metrics_port and current_slot():
+                metrics_port += current_slot()
+            self._metrics_server = MetricsServer(
+                self.metrics,
+                metrics_port,
+                self._config['metrics'].get('address', '127.0.0.1'))
+            self.app_logger.info('Serving metrics on %s:%s' % (
+                self._metrics_server.address, self._metrics_server.port))
+
+        # Seconds the broker may block the connection (for example on a
+        # memory alarm) before it is closed and reconnected.
+        self._blocked_timeout = mq_config.get(
+            'blocked_connection_timeout', None)
+        self._blocked_timer = None
+
+        # With a list of servers one is picked on every (re)connect from
+        # their connect latency and failures.
+        self._brokers = None
+        self._broker = None
+        self._connect_started = None
+        if isinstance(mq_config['server'], (list, tuple)):
+            servers = mq_config['server']
+            self._brokers = BrokerSelector.from_config(
+                servers, mq_config.get('failover', {}))
+            self._broker_params = dict(
+                (server, self._parse_connect_params(
+                    _broker_config(mq_config, server)))
+                for server in servers)
+            mq_config = _broker_config(mq_config, servers[0])
+
         (con_params, connection_string) = self._parse_connect_params(mq_config)
         self._con_params = con_params
 
         self.app_logger.info(connection_string)
-        self._connect()
+        # A manager shares its connection with this worker and connects
+        # it, otherwise the worker connects itself.
+        self._manager = manager
+        if self._manager is None:
+            self._connect()
 
     def _parse_connect_params(self, mq_config):
         """Parse the given dictionary ``mq_config``. Return connection params,
@@ -101,6 +394,10 @@ instead.
 SSL is false by default. Enabling SSL and setting a port manually will
 use the supplied port.
 
+If heartbeat is supplied it is the heartbeat interval, in seconds, asked
+of the broker. 0 turns heartbeats off. Without it the broker's value is
+used.
+
         """
         _ssl_port = 5671
         _non_ssl_port = 5672
@@ -121,11 +418,17 @@ use the supplied port.
             # port if no port was supplied
             _port = mq_config.get('port', _non_ssl_port)
 
+        _heartbeat = mq_config.get('heartbeat', None)
+        if _heartbeat is not None:
+            _heartbeat = int(_heartbeat)
+            _ssl_qp += '&heartbeat=%s' % _heartbeat
+
         con_params = pika.ConnectionParameters(
             host=mq_config['server'],
             port=_port,
             virtual_host=mq_config['vhost'],
             credentials=creds,
+            heartbeat_interval=_heartbeat,
             ssl=_ssl,
             ssl_options={'ssl_version': ssl.PROTOCOL_TLSv1}
         )
@@ -141,60 +444,166 @@ use the supplied port.
         """
         Used to connect or reconnect to the bus.
         """
+        self._select_broker()
         try:
-            if self._config.get('queue', None):
-                # This worker is setting a custom queue name. Probably to
-                # differentiate from other workers with similar names.
-                _queue_suffix = self._config.get('queue')
-            else:
-                # No special naming requested. Leave the instance suffix alone
-                _queue_suffix = self.__class__.__name__.lower()
-
-            self._queue = "worker.%s" % _queue_suffix
-            self._consumer_tag = None
-
-            self._connection = pika.SelectConnection(
+            connection_class = (
+                self._connection_class or pika.SelectConnection)
+            self._connection = connection_class(
                 parameters=self._con_params,
                 on_open_callback=self._on_open,
                 on_close_callback=self._on_close,
                 stop_ioloop_on_close=False)
-            self._connected = True
+            self._attach(self._connection)
         except pika.exceptions.AMQPConnectionError, ae:
             # This means we couldn't connect, so act like a reconnect
             self.app_logger.warn('Unable to make connection: %s' % ae.message)
             self._on_close(None, -1, str(ae))
 
+    def _select_broker(self):
+        """
+        Picks the broker for the next connection when several are
+        configured. Returns the connection parameters to use.
+        """
+        if self._brokers is not None:
+            self._broker = self._brokers.choose()
+            self._con_params, connection_string = self._broker_params[
+                self._broker]
+            self._connect_started = time.time()
+            self.app_logger.info(connection_string)
+        return self._con_params
+
+    def _reconnect_delay(self, backoff):
+        """
+        Returns how many seconds to wait before reconnecting after the
+        connection was lost. The lost broker is marked as failed and when
+        another broker is healthy it is tried right away.
+        """
+        delay = backoff.next_delay()
+        if self._broker is not None:
+            self._brokers.failed(self._broker)
+            if self._brokers.available():
+                delay = 0
+        return delay
+
+    def _attach(self, connection, watch_blocked=True):
+        """
+        Prepares the worker to consume over connection. The channel is
+        opened by _on_open once the connection is open.
+        """
+        if self._config.get('queue', None):
+            # This worker is setting a custom queue name. Probably to
+            # differentiate from other workers with similar names.
+            _queue_suffix = self._config.get('queue')
+        else:
+            # No special naming requested. Leave the instance suffix alone
+            _queue_suffix = self.__class__.__name__.lower()
+
+        self._queue = "worker.%s" % _queue_suffix
+        self._consumer_tag = None
+        self._connection = connection
+        self._connected = True
+        if self._blocked_timeout and watch_blocked:
+            self._blocked_timer = None
+            connection.callbacks.add(
+                0, pika.spec.Connection.Blocked, self._on_blocked, False)
+            connection.callbacks.add(
+                0, pika.spec.Connection.Unblocked, self._on_unblocked, False)
+
     def _on_open(self, connection):
         """
         Call back when a connection is opened.
         """
+        if self._broker is not None:
+            self._brokers.succeeded(
+                self._broker, time.time() - self._connect_started)
         self.app_logger.debug('Attemtping to open channel...')
         self._connection.channel(self._on_channel_open)
 
+    def _on_blocked(self, method_frame):
+        """
+        Starts the blocked connection timer when the broker blocks us.
+        """
+        self.app_logger.warn('Connection blocked by the broker: %s' % (
+            getattr(method_frame.method, 'reason', '')))
+        if self._blocked_timer is None:
+            self._blocked_timer = self._connection.add_timeout(
+                self._blocked_timeout, self._on_blocked_timeout)
+
+    def _on_unblocked(self, method_frame):
+        """
+        Cancels the blocked connection timer.
+        """
+        self.app_logger.info('Connection unblocked by the broker.')
+        if self._blocked_timer is not None:
+            self._connection.remove_timeout(self._blocked_timer)
+            self._blocked_timer = None
+
+    def _on_blocked_timeout(self):
+        """
+        Closes a connection which stayed blocked for too long so it is
+        reconnected.
+        """
+        self._blocked_timer = None
+        self.app_logger.error(
+            'Connection blocked for over %s seconds. Reconnecting.' % (
+                self._blocked_timeout))
+        self._connection.close(reply_text='Blocked for too long')
+
     def _on_channel_open(self, channel):
         """
         Call back when a channel is opened.
         """
         self.app_logger.info('Connection and channel open.')
         self._channel = channel
+        self._generation += 1
+        self._backoff.reset()
+        if self._prefetch:
+            self._basic_qos(self._prefetch)
+        if self._confirms is not None:
+            self._confirms.reset()
+            self._channel.confirm_delivery(self._confirms.on_confirm)
+        if self._spool is not None:
+            # Journaled publishes are older than anything still queued
+            self._drain_spool()
+        if self._uses_threads():
+            self._callbacks.start(self._connection)
         self.app_logger.debug('Attempting to start consuming...')
         self._consumer_tag = self._channel.basic_consume(
             self._process, queue=self._queue)
         self.app_logger.info('Consuming on queue %s' % self._queue)
 
+    def _uses_threads(self):
+        """
+        Returns True if messages are processed off the ioloop thread.
+        """
+        return self._pool is not None
+
+    def _basic_qos(self, prefetch_count):
+        """
+        Sets the prefetch count on the current channel. Runs on the ioloop
+        thread.
+        """
+        self._prefetch = prefetch_count
+        if self._channel is not None:
+            self._channel.basic_qos(prefetch_count=prefetch_count)
+            self.app_logger.debug('Prefetch count set to %s' % prefetch_count)
+
     def _on_close(self, connection, reply_code, reply_text):
         """
         Attempt to reconnect on close.
         """
         self.app_logger.debug('Connection closing.')
-        self._channel = None
-        self._connected = False
-        if getattr(self, '_connection', None):
-            self.app_logger.debug('Stopping the IOloop.')
-            self._connection.ioloop.stop()
-            self.app_logger.debug('Closing the connection.')
+        self._detach()
 
         if self._closing:
+            if getattr(self, '_connection', None):
+                self.app_logger.debug('Stopping the IOloop.')
+                self._connection.ioloop.stop()
+                self.app_logger.debug('Closing the connection.')
+            if self._pool is not None:
+                self._pool.shutdown(wait=False)
+            if self._capture is not None:
+                self._capture.close()
             try:
                 self._connection.close()
             except AttributeError, aex:
@@ -204,18 +613,121 @@ use the supplied port.
         else:
             self.app_logger.warn('Connection closed becuase %s (%s)' % (
                 reply_text, reply_code))
-            self.app_logger.info('Attempting to reconnect in 5 seconds ...')
+            delay = self._reconnect_delay(self._backoff)
+            self.metrics.reconnects.inc()
+            self.app_logger.info(
+                'Attempting to reconnect in %.1f seconds (attempt %s) ...' % (
+                    delay, self._backoff.attempts))
             self._closing = False
 
-            # Since we stop the ioloop we can't use add_timeout
-            time.sleep(5)
-            self.run_forever()
+            if connection is not None:
+                # The old ioloop keeps running so wait on it. _reconnect
+                # stops it and run_forever makes the new connection.
+                self._connection.add_timeout(delay, self._reconnect)
+            else:
+                # The connection was never made so there is no ioloop to
+                # wait on. run_forever waits before trying again.
+                self._retry_in = delay
+
+    def _detach(self):
+        """
+        Forgets the state tied to the closed channel and connection.
+        """
+        with self._spool_lock:
+            self._channel = None
+            if self._spool is not None:
+                # Publishes still waiting for the ioloop go to the spool
+                # before any pool thread spools a later one directly
+                self._callbacks.drain()
+        self._connected = False
+        self._callbacks.stop()
+        if self._confirms is not None:
+            self._confirms.fail_all('connection closed')
+        if self._acks is not None:
+            # Tags belong to the closed channel. The broker will redeliver.
+            self._acks.reset()
+            self._ack_timeout = None
+        self._received.clear()
+        self._deadlines.clear()
+        self._expired.clear()
+        if self._batch:
+            # Never handed to process_batch. The broker will redeliver.
+            self._in_flight -= len(self._batch)
+            self._batch = []
+        self._batch_timeout = None
+        if self._backpressure is not None:
+            # The new channel starts consuming again
+            self._backpressure.paused = False
+            self._flow_timeout = None
+            self.metrics.paused.set(0)
+
+    def _reconnect(self):
+        """
+        Stops the old ioloop so run_forever can make a new connection.
+        """
+        self._retry_in = 0
+        self._connection.ioloop.stop()
+
+    @property
+    def reconnect_stats(self):
+        """
+        Reconnect counters as a dictionary.
+        """
+        return self._backoff.stats()
 
     def ack(self, basic_deliver):
         """
         Shortcut for acking
         """
-        self._channel.basic_ack(basic_deliver.delivery_tag)
+        self._callbacks.call(
+            self._basic_ack, basic_deliver.delivery_tag,
+            self._get_generation())
+
+    def _stale(self, generation):
+        """
+        Returns True if generation belongs to an earlier channel. None is
+        taken as the current channel. Runs on the ioloop thread.
+        """
+        return generation is not None and generation != self._generation
+
+    def _basic_ack(self, delivery_tag, generation=None):
+        """
+        Acks delivery_tag on the current channel. Runs on the ioloop thread.
+        """
+        if (self._channel is None or self._stale(generation) or
+                delivery_tag in self._expired):
+            # The tag died with its channel, or was already rejected when
+            # its deadline passed
+            return
+        self.metrics.acked.inc()
+        received = self._received.pop(delivery_tag, None)
+        if received is not None:
+            self.metrics.latency.observe(time.time() - received)
+        if self._acks is None:
+            self._channel.basic_ack(delivery_tag)
+        elif self._acks.completed(delivery_tag):
+            self._flush_acks(full=False)
+        elif self._ack_timeout is None:
+            self._ack_timeout = self._connection.add_timeout(
+                self._acks.interval, self._on_ack_timeout)
+
+    def _flush_acks(self, full=True):
+        """
+        Sends batched acks. Runs on the ioloop thread.
+        """
+        multiple_tag, single_tags = self._acks.flush(full)
+        if multiple_tag is not None:
+            self._channel.basic_ack(multiple_tag, multiple=True)
+        for tag in single_tags:
+            self._channel.basic_ack(tag)
+
+    def _on_ack_timeout(self):
+        """
+        Timer callback which acks everything that has completed.
+        """
+        self._ack_timeout = None
+        if self._channel is not None:
+            self._flush_acks(full=True)
 
     def notify(
             self, slug, message, phase, corr_id=None,
@@ -229,17 +741,20 @@ use the supplied port.
         corr_id is the correlation id. Default: None
         *target is deprecated*!
         exchange is the exchange to publish on. Default: re
+
+        Returns a list with the result of send for each notification.
         """
-        this_phase = self.__notify_cfg.get(phase, {})
+        this_phase = self._get_notify_config(corr_id).get(phase, {})
         if target:
             self.app_logger.warn(
                 'notify should no longer be passed a target. Ignoring...')
 
+        sent = []
         if this_phase:
             for topic_suffix in this_phase.keys():
                 notify_topic = 'notify.%s' % topic_suffix
                 target = this_phase[topic_suffix]
-                self.send(
+                sent.append(self.send(
                     notify_topic,
                     corr_id,
                     {
@@ -249,12 +764,78 @@ use the supplied port.
                         'target': target,
                     },
                     exchange=''
-                )
+                ))
                 self.app_logger.info('Sent notification to %s for phase %s' % (
                     notify_topic, phase))
         else:
             self.app_logger.debug(
                 'No notifications to send for phase %s' % phase)
+        return sent
+
+    def _set_notify_config(self, corr_id, notify_cfg):
+        """
+        Stores the notify section of the message being processed.
+        """
+        self._message_state.notify_cfg = notify_cfg
+
+    def _get_notify_config(self, corr_id):
+        """
+        Returns the notify section of the message being processed.
+        """
+        message = self._batch_message(corr_id)
+        if message is not None:
+            return message.notify_cfg
+        return getattr(self._message_state, 'notify_cfg', {})
+
+    def _batch_message(self, corr_id):
+        """
+        Returns the BatchMessage for corr_id in the batch being processed,
+        or None.
+        """
+        batch = getattr(self._message_state, 'batch', None)
+        if not batch:
+            return None
+        return batch.get(str(corr_id))
+
+    def _set_dedup_key(self, corr_id, key):
+        """
+        Stores the dedup key of a message being processed.
+        """
+        keys = getattr(self._message_state, 'dedup_keys', None)
+        if keys is None:
+            keys = self._message_state.dedup_keys = {}
+        keys[corr_id] = key
+
+    def _set_delivery_tag(self, delivery_tag, generation=None):
+        """
+        Stores the delivery tag of the message being processed and the
+        generation of the channel it came from.
+        """
+        self._message_state.delivery_tag = delivery_tag
+        self._message_state.generation = generation
+
+    def _get_delivery_tag(self):
+        """
+        Returns the delivery tag of the message being processed, or None.
+        """
+        return getattr(self._message_state, 'delivery_tag', None)
+
+    def _get_generation(self):
+        """
+        Returns the channel generation of the message being processed, or
+        None.
+        """
+        return getattr(self._message_state, 'generation', None)
+
+    def _get_dedup_key(self, corr_id):
+        """
+        Returns the dedup key of the message being processed for corr_id.
+        """
+        message = self._batch_message(corr_id)
+        if message is not None:
+            return message.dedup_key
+        return getattr(self._message_state, 'dedup_keys', {}).get(
+            str(corr_id))
 
     def send(self, topic, corr_id, message_struct,
              exchange='re', reply_to='log'):
@@ -263,97 +844,870 @@ use the supplied port.
 
         topic is the topic the message will be sent to
         corr_id is the correlation id
-        message_struct is a dictionary or list which will become json and sent
+        message_struct is a dictionary or list which will be serialized and sent
         exchange is the exchange to publish on. Default: re
+
+        With publisher confirms enabled a Confirmation is returned which
+        is resolved when the broker acks or nacks the publish.
+        """
+        body = self._serializer.dumps(message_struct)
+        if self._dedup is not None and isinstance(message_struct, dict):
+            self._note_status(corr_id, message_struct.get('status'), body)
+        return self._publish(topic, corr_id, body, exchange, reply_to)
+
+    def started(self, properties):
+        """
+        Sends a started status for the message with the given properties.
+        """
+        return self._publish(
+            properties.reply_to, properties.correlation_id,
+            self._status_bodies['started'], '')
+
+    def completed(self, properties):
+        """
+        Sends a completed status for the message with the given properties.
+        """
+        body = self._status_bodies['completed']
+        if self._dedup is not None:
+            self._note_status(properties.correlation_id, 'completed', body)
+        return self._publish(
+            properties.reply_to, properties.correlation_id, body, '')
+
+    def failed(self, properties, data=None):
+        """
+        Sends a failed status for the message with the given properties.
+
+        data is an optional explanation sent along with the status.
+        """
+        if data is None:
+            body = self._status_bodies['failed']
+        else:
+            body = self._serializer.dumps({'status': 'failed', 'data': data})
+        if self._dedup is not None:
+            self._note_status(properties.correlation_id, 'failed', body)
+        return self._publish(
+            properties.reply_to, properties.correlation_id, body, '')
+
+    def _note_status(self, corr_id, status, body):
+        """
+        Caches body as the final status of the message being processed for
+        corr_id so a redelivery can be answered without processing.
+        """
+        if status in ('completed', 'failed'):
+            key = self._get_dedup_key(corr_id)
+            if key is not None:
+                self._dedup.put(key, body)
+
+    def _get_properties(self, corr_id, reply_to):
+        """
+        Returns BasicProperties for corr_id and reply_to, reusing prepared
+        ones for messages still being worked on.
         """
-        props = pika.spec.BasicProperties()
-        props.app_id = str(self.__class__.__name__.lower())
-        props.correlation_id = str(corr_id)
-        props.reply_to = reply_to
+        key = (corr_id, reply_to)
+        with self._properties_lock:
+            props = self._properties.pop(key, None)
+            if props is None:
+                props = pika.spec.BasicProperties()
+                props.app_id = self._app_id
+                props.correlation_id = str(corr_id)
+                props.reply_to = reply_to
+                props.content_type = self._serializer.content_type
+                if len(self._properties) >= self.properties_cache_size:
+                    self._properties.popitem(last=False)
+            # Most recently used goes last
+            self._properties[key] = props
+        return props
 
+    def _publish(self, topic, corr_id, body, exchange='re', reply_to='log'):
+        """
+        Publishes an already serialized body. Returns a Confirmation with
+        publisher confirms enabled, otherwise None.
+        """
+        props = self._get_properties(corr_id, reply_to)
+        confirmation = None
+        if self._confirms is not None:
+            confirmation = Confirmation()
+        call = (
+            self._basic_publish, exchange, topic, body, props, confirmation,
+            self._get_delivery_tag(), self._get_generation())
+        if self._spool is None or self._callbacks.in_ioloop():
+            self._callbacks.call(*call)
+            return confirmation
+        with self._spool_lock:
+            if self._channel is None:
+                # Queued calls only run once reconnected. Journal it now so
+                # it survives a crash and keeps its place in the spool.
+                self._spool_publish(exchange, topic, body, props, confirmation)
+            else:
+                self._callbacks.call(*call)
+        return confirmation
+
+    def _basic_publish(self, exchange, routing_key, body, properties,
+                       confirmation=None, delivery_tag=None,
+                       generation=None):
+        """
+        Publishes on the current channel. Publishes made while handling
+        delivery_tag are dropped once it has expired or its channel has
+        been replaced, as the broker redelivers it. Runs on the ioloop
+        thread.
+        """
+        if delivery_tag is not None and self._stale(generation):
+            self.app_logger.debug(
+                'Dropping publish for %s from a closed channel.' % (
+                    properties.correlation_id))
+            if confirmation is not None:
+                confirmation._resolve(False, 'channel closed')
+            return
+        if delivery_tag is not None and delivery_tag in self._expired:
+            self.app_logger.debug(
+                'Dropping publish for expired %s.' % properties.correlation_id)
+            if confirmation is not None:
+                confirmation._resolve(False, 'expired')
+            return
+        if self._channel is None and self._spool is not None:
+            self._spool_publish(
+                exchange, routing_key, body, properties, confirmation)
+            return
         self._channel.basic_publish(
             exchange=exchange,
-            routing_key=topic,
-            body=json.dumps(message_struct),
-            properties=props)
+            routing_key=routing_key,
+            body=body,
+            properties=properties)
+        self.metrics.published.inc()
+        self.metrics.published_bytes.inc(len(body))
+        if confirmation is not None:
+            self._confirms.published(confirmation)
+
+    def _spool_publish(self, exchange, routing_key, body, properties,
+                       confirmation=None):
+        """
+        Journals a publish made while disconnected.
+        """
+        with self._spool_lock:
+            if self._spool.append(
+                    exchange, routing_key, properties.correlation_id,
+                    properties.reply_to, body):
+                self.metrics.spooled.inc()
+                if confirmation is not None:
+                    self._spooled_confirms.append(confirmation)
+                return
+        self.metrics.spool_dropped.inc()
+        self.app_logger.error('Spool is full. Dropping publish for %s.' % (
+            properties.correlation_id))
+        if confirmation is not None:
+            confirmation._resolve(False, 'spool full')
+
+    def _drain_spool(self):
+        """
+        Publishes every spooled message, oldest first, on the new channel.
+        Runs on the ioloop thread.
+        """
+        with self._spool_lock:
+            records = self._spool.records()
+            if not records:
+                return
+            # Confirmations only exist for the newest records, the ones
+            # spooled by this process
+            confirms = [None] * (len(records) - len(self._spooled_confirms))
+            confirms.extend(self._spooled_confirms)
+            self._spooled_confirms.clear()
+        self.app_logger.info('Publishing %s spooled messages.' % len(records))
+        if self._confirms is not None:
+            # Every record needs a confirmation to know when it is safe
+            confirms = [c or Confirmation() for c in confirms]
+        for record, confirmation in zip(records, confirms):
+            exchange, routing_key, corr_id, reply_to, body = record
+            self._basic_publish(
+                exchange, routing_key, body,
+                self._get_properties(corr_id, reply_to or None), confirmation)
+        if self._confirms is None:
+            self._spool.release(len(records))
+            return
+        # Kept until the broker confirms them all. Otherwise they are
+        # published again on the next channel.
+        waiting = [len(confirms)]
+
+        def _on_confirm(confirmation):
+            if not confirmation.acked:
+                waiting[0] = -1
+            elif waiting[0] > 0:
+                waiting[0] -= 1
+                if waiting[0] == 0:
+                    self._spool.release(len(records))
+        for confirmation in confirms:
+            confirmation.add_done_callback(_on_confirm)
 
     def reject(self, basic_deliver, requeue=False):
         """
         Reject the message with the given `basic_deliver`
         """
-        self._channel.basic_reject(basic_deliver.delivery_tag,
-                                   requeue=requeue)
+        self._callbacks.call(
+            self._basic_reject, basic_deliver.delivery_tag, requeue,
+            self._get_generation())
+
+    def _basic_reject(self, delivery_tag, requeue, generation=None):
+        """
+        Rejects delivery_tag on the current channel. Runs on the ioloop thread.
+        """
+        if (self._channel is None or self._stale(generation) or
+                delivery_tag in self._expired):
+            return
+        self.metrics.rejected.inc()
+        self._received.pop(delivery_tag, None)
+        if self._acks is not None:
+            self._acks.rejected(delivery_tag)
+        self._channel.basic_reject(delivery_tag, requeue=requeue)
+
+    def _create_output(self, corr_id):
+        """
+        Creates the Output for a message. When 'output_buffer' is set in
+        the worker config lines are coalesced into fewer bus messages. Off
+        the ioloop thread they are also flushed by an ioloop timer once
+        'interval' passes.
+        """
+        level = self._config.get('OUTPUT_LEVEL', 'DEBUG')
+        if self._config.get('output_buffer', None) is not None:
+            call_later = None
+            if self._uses_threads():
+                call_later = self._call_later
+            return BufferedOutput.from_config(
+                self.send, corr_id, self._config['output_buffer'], level,
+                call_later=call_later)
+        return Output(self.send, corr_id, level)
+
+    def _call_later(self, seconds, func):
+        """
+        Calls func on the ioloop thread after seconds. May be called from
+        any thread.
+        """
+        self._callbacks.call(self._add_timeout, seconds, func)
+
+    def _add_timeout(self, seconds, func):
+        """
+        Schedules func on the current connection. Runs on the ioloop
+        thread.
+        """
+        if self._connection is not None:
+            self._connection.add_timeout(seconds, func)
 
     def _process(self, channel, basic_deliver, properties, body):
         """
-        Internal processing that happens before subclass starts processing.
+        Consumer callback. Hands the delivery to the pool when concurrency
+        is enabled, otherwise handles it inline on the ioloop.
+        """
+        self.metrics.received.inc()
+        received = time.time()
+        self._received[basic_deliver.delivery_tag] = received
+        if self._capture is not None and not self._capture.full:
+            if not self._capture.record(
+                    received, basic_deliver, properties, body):
+                self.app_logger.warn(
+                    'Capture %s is full. No longer recording.' % (
+                        self._capture.path))
+        if self._acks is not None:
+            self._acks.delivered(basic_deliver.delivery_tag)
+        if self._dedup is not None and (
+                basic_deliver.redelivered or self._dedup_always):
+            cached = self._dedup.get(
+                dedup.message_key(properties.correlation_id, body))
+            if cached is not None:
+                self._replay(basic_deliver, properties, cached)
+                return
+        self._in_flight += 1
+        if self._batch_config is not None:
+            self._add_to_batch(channel, basic_deliver, properties, body)
+        elif self._pool is not None:
+            self._pool.dispatch(
+                properties.correlation_id, self._run_message,
+                channel, basic_deliver, properties, body, self._generation)
+        else:
+            self._run_message(
+                channel, basic_deliver, properties, body, self._generation)
+        if self._backpressure is not None:
+            self._check_flow()
+
+    def _run_message(self, channel, basic_deliver, properties, body,
+                     generation=None):
+        """
+        Handles a delivery received on the channel generation and then
+        marks it finished on the ioloop thread.
         """
-        class_name = self.__class__.__name__
         try:
-            body = json.loads(body)
+            self._handle(channel, basic_deliver, properties, body, generation)
+        finally:
+            self._set_delivery_tag(None)
+            self._callbacks.call(
+                self._message_done, str(properties.correlation_id),
+                basic_deliver.delivery_tag, generation)
+
+    def _add_to_batch(self, channel, basic_deliver, properties, body):
+        """
+        Adds a delivery to the waiting batch and hands the batch over once
+        it is full. Runs on the ioloop thread.
+        """
+        self._batch.append((basic_deliver, properties, body))
+        if len(self._batch) >= self._batch_size:
+            self._flush_batch(channel)
+        elif self._batch_timeout is None:
+            self._batch_timeout = self._connection.add_timeout(
+                self._batch_window, lambda: self._on_batch_window(channel))
+
+    def _on_batch_window(self, channel):
+        """
+        Hands over a batch which did not fill within the window.
+        """
+        self._batch_timeout = None
+        self._flush_batch(channel)
+
+    def _flush_batch(self, channel):
+        """
+        Hands the waiting deliveries to process_batch. Runs on the ioloop
+        thread.
+        """
+        if self._batch_timeout is not None:
+            self._connection.remove_timeout(self._batch_timeout)
+            self._batch_timeout = None
+        items, self._batch = self._batch, []
+        if not items:
+            return
+        # A waiting batch is dropped with its channel so every delivery in
+        # it is from the current one
+        if self._pool is not None:
+            self._pool.dispatch(
+                items[0][1].correlation_id, self._run_batch, channel, items,
+                self._generation)
+        else:
+            self._run_batch(channel, items, self._generation)
+
+    def _run_batch(self, channel, items, generation=None):
+        """
+        Handles a batch and then marks each delivery finished on the ioloop
+        thread.
+        """
+        try:
+            self._handle_batch(channel, items, generation)
+        finally:
+            self._set_delivery_tag(None)
+            self._message_state.batch = None
+            for basic_deliver, properties, _ in items:
+                self._callbacks.call(
+                    self._message_done, str(properties.correlation_id),
+                    basic_deliver.delivery_tag, generation)
+
+    def _handle_batch(self, channel, items, generation=None):
+        """
+        Decodes a batch, calls process_batch once and acks or rejects each
+        delivery by its result.
+        """
+        messages = []
+        self._message_state.dedup_keys = {}
+        self._message_state.batch = None
+        self._set_delivery_tag(None, generation)
+        for basic_deliver, properties, body in items:
             corr_id = str(properties.correlation_id)
-            self.__notify_cfg = body.get('notify', {})
-            # Create an output logger for sending results
-            output = Output(self.send, corr_id)
-            output.setLevel(self._config.get('OUTPUT_LEVEL', 'DEBUG'))
-            # Execute
-            output.debug('Starting %s.%s - %s' % (
-                class_name,
-                corr_id,
-                str(datetime.datetime.now())
-            ))
             try:
-                self.process(channel, basic_deliver, properties, body, output)
+                body, output = self._begin(properties, body, corr_id)
+            except ValueError, vex:
+                self._parse_failed(basic_deliver, properties, corr_id, vex)
+                continue
+            # _begin keeps one message's state per thread so each keeps its
+            # own for process_batch
+            messages.append(BatchMessage(
+                basic_deliver, properties, body, output,
+                self._get_notify_config(corr_id),
+                self._get_dedup_key(corr_id)))
+        if not messages:
+            return
+        self._message_state.batch = dict(
+            (str(m.properties.correlation_id), m) for m in messages)
+
+        started = time.time()
+        try:
+            results = self._run_process(
+                str(messages[0].properties.correlation_id),
+                self.process_batch, channel, messages)
+        except KeyError, ke:
+            for message in messages:
+                self._missing_key(
+                    message.properties,
+                    str(message.properties.correlation_id),
+                    message.output, ke)
+            results = [False] * len(messages)
+        except NotImplementedError:
+            raise
+        except Exception, ex:
+            results = self._batch_failed(messages, '%s: %s' % (type(ex), ex))
+        if results is None:
+            results = [True] * len(messages)
+        elif len(results) != len(messages):
+            results = self._batch_failed(
+                messages, 'process_batch returned %s results for %s '
+                'messages' % (len(results), len(messages)))
+
+        for message, result in zip(messages, results):
+            if result:
+                self.ack(message.basic_deliver)
+            else:
+                self.reject(message.basic_deliver, self._batch_requeue)
+            self._end(
+                str(message.properties.correlation_id), message.output,
+                started)
+
+    def _batch_failed(self, messages, reason):
+        """
+        Fails every message of a batch process_batch could not handle.
+        Returns a falsy result for each.
+        """
+        class_name = self.__class__.__name__
+        self.app_logger.error('Batch of %s failed. Rejecting. %s' % (
+            len(messages), reason))
+        for message in messages:
+            message.output.flush()
+            self.send(message.properties.reply_to,
+                      str(message.properties.correlation_id), {
+                          'status': 'failed',
+                          'data': '%s failed processing a batch' % class_name
+                      }, exchange='')
+        return [False] * len(messages)
+
+    def _message_done(self, corr_id=None, delivery_tag=None,
+                      generation=None):
+        """
+        Counts a finished delivery. Runs on the ioloop thread.
+        """
+        self._in_flight -= 1
+        if not self._stale(generation):
+            self._expired.discard(delivery_tag)
+            deadline = self._deadlines.pop(delivery_tag, None)
+            if deadline is not None and self._connection is not None:
+                self._connection.remove_timeout(deadline[0])
+        if self._backpressure is not None:
+            self._check_flow()
+        if self._recycle is not None and not self._closing:
+            reason = self._recycle.done()
+            if self._recycle.rss is not None:
+                self.metrics.rss.set(self._recycle.rss)
+            if reason is not None:
+                self.app_logger.info('Recycling because it %s.' % reason)
+                if self._manager is not None:
+                    # The process exits so every worker on it stops
+                    self._manager.stop()
+                else:
+                    self.stop()
+
+    def _outbound_bytes(self):
+        """
+        Returns how many bytes are waiting to be written to the broker.
+        """
+        buf = getattr(self._connection, 'outbound_buffer', None) or ()
+        return sum([len(frame) for frame in buf])
+
+    def _check_flow(self):
+        """
+        Pauses or resumes consuming based on the backpressure watermarks.
+        Runs on the ioloop thread.
+        """
+        if self._channel is None:
+            return
+        if not self._backpressure.update(
+                self._in_flight, self._outbound_bytes()):
+            return
+        if self._backpressure.paused:
+            self._pause_consuming()
+        else:
+            self._resume_consuming()
+
+    def _pause_consuming(self):
+        """
+        Cancels the consumer until the watermarks drop. Messages already
+        delivered keep being processed.
+        """
+        self.app_logger.info(
+            'Pausing consuming: %s in-flight, %s outbound bytes.' % (
+                self._in_flight, self._outbound_bytes()))
+        self.metrics.paused.set(1)
+        if self._consumer_tag is not None:
+            self._channel.basic_cancel(consumer_tag=self._consumer_tag)
+            self._consumer_tag = None
+        # Outbound bytes drain without any message finishing so poll
+        self._flow_timeout = self._connection.add_timeout(
+            self._backpressure.interval, self._on_flow_timeout)
+
+    def _on_flow_timeout(self):
+        """
+        Rechecks the watermarks while paused.
+        """
+        self._flow_timeout = None
+        self._check_flow()
+        if (self._channel is not None and self._backpressure.paused and
+                self._flow_timeout is None):
+            self._flow_timeout = self._connection.add_timeout(
+                self._backpressure.interval, self._on_flow_timeout)
+
+    def _resume_consuming(self):
+        """
+        Starts consuming again after a pause.
+        """
+        self.metrics.paused.set(0)
+        if self._flow_timeout is not None:
+            self._connection.remove_timeout(self._flow_timeout)
+            self._flow_timeout = None
+        if self._closing or self._consumer_tag is not None:
+            return
+        self.app_logger.info('Resuming consuming.')
+        self._consumer_tag = self._channel.basic_consume(
+            self._process, queue=self._queue)
+
+    def _replay(self, basic_deliver, properties, status_body):
+        """
+        Answers a duplicate delivery with its cached final status and acks
+        it without processing. Runs on the ioloop thread.
+        """
+        self.app_logger.info(
+            'Duplicate delivery of %s. Replaying cached status.' % (
+                properties.correlation_id))
+        self.metrics.duplicates.inc()
+        self._publish(
+            properties.reply_to, properties.correlation_id, status_body, '')
+        self._basic_ack(basic_deliver.delivery_tag)
+
+    def _handle(self, channel, basic_deliver, properties, body,
+                generation=None):
+        """
+        Internal processing that happens before subclass starts processing.
+        """
+        corr_id = str(properties.correlation_id)
+        self._message_state.dedup_keys = {}
+        self._set_delivery_tag(basic_deliver.delivery_tag, generation)
+        try:
+            body, output = self._begin(properties, body, corr_id)
+            self._start_deadline(basic_deliver, properties, body)
+            started = time.time()
+            try:
+                self._run_process(
+                    corr_id, self.process, channel, basic_deliver,
+                    properties, body, output)
             except KeyError, ke:
-                output.debug(
-                    'An expected key in the message for %s for %s was '
-                    'missing: %s. Required keys: %s - %s' % (
-                        corr_id,
-                        class_name,
-                        ke,
-                        ",".join(self.dynamic),
-                        str(datetime.datetime.now())))
-                _data_msg = '%s failed due to missing key: %s. Required Keys: %s' % (
-                    class_name, ke, ",".join(self.dynamic))
-                self.send(properties.reply_to,
-                          corr_id, {
-                              'status': 'failed',
-                              'data': _data_msg
-                          },
-                          exchange='')
-
-            output.debug('Finished %s.%s - %s\n\n' % (
-                class_name,
-                corr_id,
-                str(datetime.datetime.now())))
+                self._missing_key(properties, corr_id, output, ke)
+            self._end(corr_id, output, started)
         except ValueError, vex:
-            self.app_logger.error('Could not parse msg. Rejecting. %s: %s' % (
-                type(vex), vex))
-            self.send(properties.reply_to, corr_id, {
-                'status': 'failed',
-                'data': '%s failed trying to parse message' % class_name
-            }, exchange='')
+            self._parse_failed(basic_deliver, properties, corr_id, vex)
+        except NotImplementedError:
+            # The subclass is incomplete, not the message bad
+            raise
+        except Exception, ex:
+            self._process_failed(basic_deliver, properties, corr_id, ex)
+
+    def _run_process(self, corr_id, func, *args):
+        """
+        Calls func, process or process_batch, under the profiler when
+        corr_id is sampled and measures its allocations. Returns what func
+        returns.
+        """
+        allocated = None
+        if self._allocations is not None:
+            allocated = self._allocations.current()
+        try:
+            if (self._profiler is not None and
+                    self._profiler.sampled(corr_id)):
+                self.metrics.profiled.inc()
+                return self._profiler.call(func, *args)
+            return func(*args)
+        finally:
+            if allocated is not None:
+                self._note_allocations(corr_id, allocated)
+
+    def _note_allocations(self, corr_id, before):
+        """
+        Records how much memory handling corr_id left allocated.
+        """
+        delta = self._allocations.current() - before
+        self.metrics.allocations.observe(max(delta, 0))
+        if (self._allocations_log_above is not None and
+                delta > self._allocations_log_above):
+            self.app_logger.warn('Message %s left %s bytes allocated.' % (
+                corr_id, delta))
+        else:
+            self.app_logger.debug('Message %s left %s bytes allocated.' % (
+                corr_id, delta))
+
+    def _on_profile_signal(self, signum, frame):
+        """
+        Signal handler which dumps the profiler stats.
+        """
+        if self._connection is not None:
+            # Signals arrive between bytecodes so dump from the ioloop
+            self._connection.add_timeout(0, self._dump_profile)
 
-            self.reject(basic_deliver, False)
+    def _dump_profile(self):
+        """
+        Writes the aggregated profile to the profile directory, or logs it
+        when there is none.
+        """
+        if self._profiler.directory:
+            path = self._profiler.dump()
+            if path is not None:
+                self.app_logger.info('Wrote profile of %s messages to %s' % (
+                    self._profiler.profiled, path))
+        else:
+            self.app_logger.info('Profile of %s messages:\n%s' % (
+                self._profiler.profiled, self._profiler.report()))
+
+    def _deadline_for(self, body):
+        """
+        Returns the number of seconds body may be processed for, or None.
+        """
+        if self._deadline_config is None:
+            return None
+        field = self._deadline_config.get('field', 'deadline')
+        if isinstance(body, dict) and body.get(field):
+            return float(body[field])
+        return self._deadline_config.get('timeout', None)
+
+    def _start_deadline(self, basic_deliver, properties, body, running=None):
+        """
+        Starts the deadline for a decoded message. Runs where the message
+        is processed. running is the task processing the message, if any.
+        """
+        seconds = self._deadline_for(body)
+        if not seconds:
+            return
+        if running is None:
+            running = threading.current_thread().ident
+        self._callbacks.call(
+            self._arm_deadline, basic_deliver.delivery_tag, properties,
+            seconds, running, self._get_generation())
+
+    def _arm_deadline(self, delivery_tag, properties, seconds, running,
+                      generation=None):
+        """
+        Schedules the deadline for delivery_tag. Runs on the ioloop thread.
+        """
+        if self._stale(generation):
+            return
+        timeout = self._connection.add_timeout(
+            seconds, lambda: self._on_deadline(delivery_tag))
+        self._deadlines[delivery_tag] = (timeout, properties, running)
+
+    def _on_deadline(self, delivery_tag):
+        """
+        Expires a message still running at its deadline and cancels its
+        processing. Runs on the ioloop thread.
+        """
+        entry = self._deadlines.pop(delivery_tag, None)
+        if entry is None:
+            return
+        _, properties, running = entry
+        self._expire(delivery_tag, properties)
+        self._cancel_running(running)
+
+    def _expire(self, delivery_tag, properties):
+        """
+        Fails and rejects a message which ran past its deadline. It is
+        requeued when 'requeue' is set in the deadline config. Runs on the
+        ioloop thread.
+        """
+        corr_id = str(properties.correlation_id)
+        self.app_logger.warn('%s ran past its deadline. Rejecting.' % corr_id)
+        self.metrics.deadlines.inc()
+        self.send(properties.reply_to, corr_id, {
+            'status': 'failed',
+            'data': '%s did not finish before its deadline' % (
+                self.__class__.__name__)
+        }, exchange='')
+        self._basic_reject(
+            delivery_tag, self._deadline_config.get('requeue', False))
+        # Later acks, rejects and publishes from the cancelled processing
+        # are dropped
+        self._expired.add(delivery_tag)
+
+    def _cancel_running(self, running):
+        """
+        Cancels the processing of an expired message. Python threads can
+        not be killed, so the pool retires the thread and starts another in
+        its place. The stuck thread exits if its call ever returns.
+        """
+        if self._pool is not None and running is not None:
+            self._pool.retire(running)
+
+    def _begin(self, properties, body, corr_id):
+        """
+        Decodes body and creates the Output for a message. Returns
+        (body, output). Raises ValueError if body can not be decoded.
+        """
+        if self._dedup is not None:
+            # Kept with the message, not shared by its correlation id, as
+            # steps of one release may overlap
+            self._set_dedup_key(
+                corr_id, dedup.message_key(properties.correlation_id, body))
+        decode_started = time.time()
+        body = serializers.for_content_type(
+            getattr(properties, 'content_type', None),
+            self._serializer).loads(body)
+        self.metrics.decode_time.observe(time.time() - decode_started)
+        self._set_notify_config(corr_id, body.get('notify', {}))
+        # Create an output logger for sending results
+        output = self._create_output(corr_id)
+        output.debug(
+            'Starting %s.%s - %s', self.__class__.__name__, corr_id,
+            datetime.datetime.now())
+        return (body, output)
+
+    def _missing_key(self, properties, corr_id, output, ke):
+        """
+        Reports a message which was missing an expected key.
+        """
+        class_name = self.__class__.__name__
+        self.metrics.missing_keys.inc()
+        output.debug(
+            'An expected key in the message for %s for %s was '
+            'missing: %s. Required keys: %s - %s',
+            corr_id, class_name, ke, ",".join(self.dynamic),
+            datetime.datetime.now())
+        _data_msg = '%s failed due to missing key: %s. Required Keys: %s' % (
+            class_name, ke, ",".join(self.dynamic))
+        # Buffered lines must go out before the final status
+        output.flush()
+        self.send(properties.reply_to,
+                  corr_id, {
+                      'status': 'failed',
+                      'data': _data_msg
+                  },
+                  exchange='')
+
+    def _end(self, corr_id, output, started):
+        """
+        Records timing and flushes output once process is done.
+        """
+        duration = time.time() - started
+        self.metrics.process_time.observe(duration)
+        if self._adaptive_prefetch is not None:
+            prefetch = self._adaptive_prefetch.record(duration)
+            if prefetch is not None:
+                self._callbacks.call(self._basic_qos, prefetch)
+
+        output.debug(
+            'Finished %s.%s - %s\n\n', self.__class__.__name__, corr_id,
+            datetime.datetime.now())
+        output.flush()
+
+    def _parse_failed(self, basic_deliver, properties, corr_id, vex):
+        """
+        Fails and rejects a message which could not be parsed.
+        """
+        class_name = self.__class__.__name__
+        self.app_logger.error('Could not parse msg. Rejecting. %s: %s' % (
+            type(vex), vex))
+        self.send(properties.reply_to, corr_id, {
+            'status': 'failed',
+            'data': '%s failed trying to parse message' % class_name
+        }, exchange='')
+
+        self.reject(basic_deliver, False)
+
+    def _process_failed(self, basic_deliver, properties, corr_id, ex):
+        """
+        Fails a message whose processing raised unexpectedly and rejects
+        it unless process settled it first.
+        """
+        class_name = self.__class__.__name__
+        self.app_logger.error('Unhandled error processing %s: %s: %s' % (
+            corr_id, type(ex), ex))
+        self.send(properties.reply_to, corr_id, {
+            'status': 'failed',
+            'data': '%s failed with an unexpected error' % class_name
+        }, exchange='')
+        self._callbacks.call(
+            self._reject_unsettled, basic_deliver.delivery_tag,
+            self._get_generation())
+
+    def _reject_unsettled(self, delivery_tag, generation=None):
+        """
+        Rejects delivery_tag unless it was already acked or rejected. Runs
+        on the ioloop thread.
+        """
+        if delivery_tag in self._received:
+            self._basic_reject(delivery_tag, False, generation)
 
     def process(self, channel, basic_deliver, properties, body, output):
         """
         Subclass must override this to implement their logic.
 
-        **Note**: Body is already loaded json.
+        **Note**: Body is already decoded (json unless another content type).
         """
         raise NotImplementedError('process must be implemented.')
 
+    def process_batch(self, channel, messages):
+        """
+        Subclass must override this when 'batch' is set in the worker
+        config. messages is a list of BatchMessage with basic_deliver,
+        properties, decoded body and output.
+
+        Return a list with a result per message in the same order. Truthy
+        results are acked and falsy ones rejected. Returning None acks
+        every message.
+        """
+        raise NotImplementedError('process_batch must be implemented.')
+
+    def stop(self):
+        """
+        Gracefully stops the worker. Consuming is cancelled, in-flight
+        messages get 'drain_timeout' seconds (worker config, default 30) to
+        finish and then the connection is closed. Runs on the ioloop thread.
+        """
+        self.app_logger.info('Stopping. Waiting on %s in-flight messages.' % (
+            self._in_flight))
+        self._closing = True
+        if self._channel is not None and self._consumer_tag is not None:
+            self._channel.basic_cancel(consumer_tag=self._consumer_tag)
+            self._consumer_tag = None
+        if self._batch:
+            # Don't wait out the window for the last partial batch
+            self._flush_batch(self._channel)
+        self._drain_deadline = time.time() + float(
+            self._config.get('drain_timeout', 30))
+        self._check_drained()
+
+    def _check_drained(self):
+        """
+        Closes the connection once in-flight messages are done or the drain
+        deadline passes, otherwise checks again shortly.
+        """
+        if self._in_flight > 0 and time.time() < self._drain_deadline:
+            self._connection.add_timeout(0.1, self._check_drained)
+            return
+        if self._in_flight > 0:
+            self.app_logger.warn(
+                'Drain timeout hit with %s messages in-flight.' % (
+                    self._in_flight))
+        if self._acks is not None and self._channel is not None:
+            self._flush_acks(full=True)
+        if self._manager is not None:
+            # The connection is shared. The manager closes it once every
+            # worker on it has drained.
+            self._manager.drained(self)
+        else:
+            self._connection.close()
+
     def run_forever(self):
         """
         Run forever ... or until someone makes it stop.
         """
         try:
-            if self._connected is False:
-                self._connect()
+            while True:
+                if self._connected is False:
+                    if self._retry_in:
+                        time.sleep(self._retry_in)
+                    self._retry_in = None
+                    self._connect()
 
-            self.app_logger.info('Starting the IOLoop.')
-            self._connection.ioloop.start()
+                if self._connected:
+                    self.app_logger.info('Starting the IOLoop.')
+                    self._connection.ioloop.start()
+
+                # The ioloop only returns without closing for a reconnect
+                if self._closing or self._retry_in is None:
+                    break
         except KeyboardInterrupt:
             self.app_logger.info('KeyboardInterrupt sent.')
             self._closing = True
@@ -361,13 +1715,75 @@ use the supplied port.
             self.app_logger.fatal('No connection or incompatible protocol.')
 
 
-def runner(WorkerCls):
+def _broker_config(mq_config, server):
     """
-    Helper function for running a worker.
+    Returns a copy of mq_config for one server of a list. server is a host
+    name, optionally followed by :port.
+    """
+    config = dict(mq_config, server=server)
+    if ':' in server:
+        host, port = server.rsplit(':', 1)
+        config.update(server=host, port=int(port))
+    return config
+
+
+def run_worker(WorkerCls, mq_conf, config_file=None):
+    """
+    Creates and runs a worker until it stops. SIGTERM makes the worker
+    drain its in-flight messages and exit.
 
     WorkerCls is the Worker Class to run.
+    mq_conf is the loaded message queue configuration.
+    config_file is an optional full path to the worker configuration file.
+    """
+    worker = WorkerCls(
+        mq_conf,
+        config_file=config_file)
+
+    def _on_sigterm(signum, frame):
+        worker._closing = True
+        if worker._connected:
+            # Signals arrive between bytecodes so stop from the ioloop
+            worker._connection.add_timeout(0, worker.stop)
+        else:
+            raise SystemExit(0)
+
+    signal.signal(signal.SIGTERM, _on_sigterm)
+    worker.run_forever()
+
+
+def run_workers(worker_classes, mq_conf, config_files=None):
+    """
+    Creates workers of each class over one shared connection and runs them
+    until they stop. SIGTERM makes every worker drain and exit.
+
+    worker_classes is a list of Worker Classes to run.
+    mq_conf is the loaded message queue configuration.
+    config_files is an optional list of full paths to the worker
+        configuration files, in the same order as worker_classes.
+    """
+    config_files = list(config_files or [])
+    config_files += [None] * (len(worker_classes) - len(config_files))
+    manager = ConnectionManager(mq_conf)
+    for WorkerCls, config_file in zip(worker_classes, config_files):
+        manager.add(WorkerCls, config_file=config_file)
+
+    def _on_sigterm(signum, frame):
+        manager._closing = True
+        if manager._connected:
+            # Signals arrive between bytecodes so stop from the ioloop
+            manager._connection.add_timeout(0, manager.stop)
+        else:
+            raise SystemExit(0)
+
+    signal.signal(signal.SIGTERM, _on_sigterm)
+    manager.run_forever()
+
+
+def _runner_parser(many=False):
+    """
+    Returns the command line parser used by runner and multi_runner.
     """
-    import os.path
     from argparse import ArgumentParser
 
     parser = ArgumentParser()
@@ -378,23 +1794,81 @@ def runner(WorkerCls):
         nargs=1,
         help='The Message Queue configuration file.')
 
+    if many:
+        parser.add_argument(
+            '-w', '--worker-config',
+            type=str,
+            required=False,
+            action='append',
+            help=('Optional full path to a worker specific configuration '
+                  'file. Repeat once per worker class, in order.'),
+            default=[])
+    else:
+        parser.add_argument(
+            '-w', '--worker-config',
+            type=str,
+            required=False,
+            help='Optional full path to worker specific configuration file.',
+            default=None)
+
     parser.add_argument(
-        '-w', '--worker-config',
-        type=str,
+        '-p', '--processes',
+        type=int,
         required=False,
-        help='Optional full path to worker specific configuration file.',
-        default=None)
+        help=('Number of worker processes to run under a supervisor. '
+              'Default: 1 with no supervisor.'),
+        default=1)
 
-    args = parser.parse_args()
+    parser.add_argument(
+        '--pin-cpus',
+        action='store_true',
+        required=False,
+        help='Pin each worker process to its own CPU.',
+        default=False)
+    return parser
+
+
+def _run_from_args(args, target):
+    """
+    Loads the mq config and runs target(mq_conf), under a supervisor when
+    more than one process is asked for.
+    """
     try:
         mq_conf = json.load(open(args.mq_config[0], 'r'))
-        worker = WorkerCls(
-            mq_conf,
-            config_file=args.worker_config)
-        worker.run_forever()
+        if args.processes > 1:
+            Supervisor(
+                lambda slot: target(mq_conf),
+                args.processes,
+                pin_cpus=args.pin_cpus).run()
+        else:
+            target(mq_conf)
     except KeyboardInterrupt:
         pass
     except Exception, ex:
         print "Error: %s %s" % (type(ex), ex)
         print "exiting..."
         raise SystemExit(1)
+
+
+def runner(WorkerCls):
+    """
+    Helper function for running a worker.
+
+    WorkerCls is the Worker Class to run.
+    """
+    args = _runner_parser().parse_args()
+    _run_from_args(
+        args, lambda mq_conf: run_worker(
+            WorkerCls, mq_conf, args.worker_config))
+
+
+def multi_runner(worker_classes):
+    """
+    Helper function for running several workers over one connection.
+
+    worker_classes is a list of Worker Classes to run.
+    """
+    args = _runner_parser(many=True).parse_args()
+    _run_from_args(
+        args, lambda mq_conf: run_workers(
+            worker_classes, mq_conf, args.worker_config))
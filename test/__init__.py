@@ -13,11 +13,107 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import json
+import logging
+import os.path
+import time
 import unittest
 
+import pika.spec
+
+from reworker.worker import Worker
+
+#: Connection settings for workers run on a FakeBroker. Nothing connects.
+FAKE_MQ_CONF = {
+    'server': 'localhost',
+    'vhost': '/',
+    'user': 'guest',
+    'password': 'guest',
+}
+
+#: Body of the messages put_messages queues
+BODY = json.dumps({
+    'notify': {'completed': {'irc': ['#test']}},
+    'group': 'test',
+    'parameters': {'command': 'test', 'subcommand': 'run'},
+    'dynamic': {}})
+
 
 class TestCase(unittest.TestCase):
     """
     Parent unittest class.
     """
     pass
+
+
+class AckWorker(Worker):
+    """
+    Worker which acks and does nothing else.
+    """
+
+    def process(self, channel, basic_deliver, properties, body, output):
+        self.ack(basic_deliver)
+
+
+class StatusWorker(Worker):
+    """
+    Worker which sends statuses and a few lines of output.
+    """
+
+    def process(self, channel, basic_deliver, properties, body, output):
+        self.ack(basic_deliver)
+        self.started(properties)
+        for num in range(3):
+            output.info('step %s of %s: %s', num, 3, body['group'])
+        self.completed(properties)
+
+
+def quiet_logger():
+    """
+    Returns a logger which drops everything below ERROR.
+    """
+    logger = logging.getLogger('reworker.test')
+    if not logger.handlers:
+        logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+    logger.setLevel(logging.ERROR)
+    return logger
+
+
+def run_until(worker, done, timeout=5):
+    """
+    Polls the ioloop of worker until done() returns True. Raises
+    AssertionError if it does not within timeout seconds.
+    """
+    deadline = time.time() + timeout
+    while not done():
+        if time.time() > deadline:
+            raise AssertionError('Not done after %s seconds' % timeout)
+        if worker._connection.ioloop.poll() == 0:
+            time.sleep(0.001)
+
+
+def start_worker(WorkerCls, broker, tmpdir, config=None):
+    """
+    Writes config to tmpdir and starts a WorkerCls on the FakeBroker
+    broker. Returns the worker once it consumes.
+    """
+    config_file = None
+    if config is not None:
+        config_file = os.path.join(tmpdir, 'config.json')
+        with open(config_file, 'w') as f_obj:
+            json.dump(config, f_obj)
+    worker = WorkerCls(
+        FAKE_MQ_CONF, config_file=config_file, logger=quiet_logger(),
+        connection_class=broker.connection_class)
+    run_until(worker, lambda: worker._consumer_tag is not None)
+    return worker
+
+
+def put_messages(broker, worker, count, body=BODY):
+    """
+    Queues count messages for worker with correlation ids 0 to count - 1.
+    """
+    for num in range(count):
+        broker.put(worker._queue, body, pika.spec.BasicProperties(
+            correlation_id=str(num), reply_to='r'))
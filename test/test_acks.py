@@ -0,0 +1,76 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests.
+"""
+
+from reworker import acks
+
+from . import TestCase, unittest
+
+
+class TestAckBatcher(TestCase):
+    """
+    Tests for the AckBatcher class.
+    """
+
+    def setUp(self):
+        self.batcher = acks.AckBatcher(size=3)
+        for tag in range(1, 6):
+            self.batcher.delivered(tag)
+
+    def test_in_order(self):
+        """
+        In order completions should be acked with one multiple ack.
+        """
+        assert self.batcher.completed(1) is False
+        assert self.batcher.completed(2) is False
+        assert self.batcher.completed(3) is True
+        assert self.batcher.flush() == (3, [])
+        assert len(self.batcher) == 0
+
+    def test_out_of_order_waits_for_gap(self):
+        """
+        A multiple ack must never cover a tag still being worked on.
+        """
+        self.batcher.completed(2)
+        self.batcher.completed(3)
+        assert self.batcher.flush() == (None, [])
+        self.batcher.completed(1)
+        assert self.batcher.flush() == (3, [])
+
+    def test_full_flush_acks_stragglers(self):
+        """
+        A full flush should ack what is past the gap one by one.
+        """
+        self.batcher.completed(1)
+        self.batcher.completed(3)
+        self.batcher.completed(5)
+        assert self.batcher.flush(full=True) == (1, [3, 5])
+        # 2 and 4 are still outstanding
+        self.batcher.completed(2)
+        self.batcher.completed(4)
+        assert self.batcher.flush() == (4, [])
+
+    def test_rejected_do_not_block(self):
+        """
+        Rejected tags should be skipped over but never be the ack tag.
+        """
+        self.batcher.completed(1)
+        self.batcher.rejected(2)
+        assert self.batcher.flush() == (1, [])
+        self.batcher.rejected(3)
+        self.batcher.completed(4)
+        assert self.batcher.flush() == (4, [])
@@ -0,0 +1,155 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests.
+"""
+
+import json
+import threading
+import time
+
+import mock
+import pika
+
+from reworker import asyncworker, worker
+
+from . import TestCase, unittest
+
+asyncio = asyncworker.asyncio
+if asyncio is not None:
+    From = getattr(asyncio, 'From', lambda x: x)
+    coroutine = asyncio.coroutine
+else:
+    coroutine = lambda f: f
+
+worker.pika = mock.MagicMock(pika)
+
+MQ_CONF = {
+    'server': '127.0.0.1',
+    'port': 5672,
+    'vhost': '/',
+    'user': 'guest',
+    'password': 'guest',
+}
+
+
+class AsyncDummyWorker(asyncworker.AsyncWorker):
+    """
+    Async worker to test with.
+    """
+
+    @coroutine
+    def process(self, channel, basic_deliver, properties, body, output):
+        output.info(str(body))
+        yield From(self.notify('slug', 'the message', 'started', corr_id=1))
+        if body.get('fail'):
+            raise KeyError('item')
+        yield From(self.ack(basic_deliver))
+
+
+def delivery(tag, body):
+    return {
+        'channel': mock.MagicMock(),
+        'basic_deliver': mock.MagicMock(delivery_tag=tag),
+        'properties': mock.MagicMock(
+            pika.spec.BasicProperties, correlation_id=tag,
+            reply_to='amq.gen-test'),
+        'body': json.dumps(body),
+    }
+
+
+@unittest.skipIf(asyncio is None, 'asyncio or trollius not installed')
+class TestAsyncWorker(TestCase):
+
+    def setUp(self):
+        self.w = AsyncDummyWorker(MQ_CONF, logger=mock.MagicMock())
+        self.w._on_open(mock.MagicMock('connection'))
+        self.w._on_channel_open(mock.MagicMock(pika.channel.Channel))
+
+    def tearDown(self):
+        self.w._loop.call_soon_threadsafe(self.w._loop.stop)
+
+    def run_until_idle(self, timeout=5):
+        """
+        Plays the ioloop until no messages are in flight.
+        """
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            self.w._callbacks.drain()
+            if self.w._in_flight == 0:
+                return
+            time.sleep(0.001)
+        raise AssertionError('Messages still in flight')
+
+    def test_concurrent_messages(self):
+        """
+        Many deliveries should be processed with acks and notifications.
+        """
+        notify = {'notify': {'started': {'irc': ['#test']}}}
+        for tag in range(1, 6):
+            self.w._process(**delivery(tag, notify))
+        self.run_until_idle()
+        assert self.w._channel.basic_ack.call_count == 5
+        # Output line and one notification per message, plus debug lines
+        notifies = [
+            c for c in self.w._channel.basic_publish.call_args_list
+            if c[1]['routing_key'] == 'notify.irc']
+        assert len(notifies) == 5
+        assert self.w._task_states == {}
+        assert self.w._corr_states == {}
+
+    def test_state_per_task(self):
+        """
+        Overlapping messages sharing a correlation id should each notify
+        with their own notify config.
+        """
+        # Both start before either task runs
+        paused = threading.Event()
+        self.w._loop.call_soon_threadsafe(paused.wait, 5)
+        for tag, target in ((1, '#one'), (2, '#two')):
+            kwargs = delivery(
+                tag, {'notify': {'started': {'irc': [target]}}})
+            kwargs['properties'].correlation_id = 1
+            self.w._process(**kwargs)
+        paused.set()
+        self.run_until_idle()
+        targets = sorted(
+            json.loads(c[1]['body'])['target'][0]
+            for c in self.w._channel.basic_publish.call_args_list
+            if c[1]['routing_key'] == 'notify.irc')
+        assert targets == ['#one', '#two']
+        assert self.w._task_states == {}
+
+    def test_missing_key(self):
+        """
+        A KeyError from the coroutine should send a failed status.
+        """
+        self.w._process(**delivery(1, {'fail': True}))
+        self.run_until_idle()
+        assert self.w._channel.basic_ack.call_count == 0
+        bodies = [json.loads(c[1]['body'])
+                  for c in self.w._channel.basic_publish.call_args_list]
+        assert bodies[-2]['status'] == 'failed'
+        assert self.w.metrics.missing_keys.value == 1
+
+    def test_parse_failure(self):
+        """
+        Bodies which can not be decoded should be rejected.
+        """
+        kwargs = delivery(1, {})
+        kwargs['body'] = 'not json'
+        self.w._process(**kwargs)
+        self.run_until_idle()
+        assert self.w._channel.basic_reject.call_count == 1
@@ -0,0 +1,149 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests.
+"""
+
+import json
+import shutil
+import tempfile
+
+import pika.spec
+
+from reworker import fake, worker
+
+from . import TestCase, run_until, start_worker, unittest
+
+
+class BatchWorker(worker.Worker):
+    """
+    Acks messages whose body has ok set and rejects the rest.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.batches = []
+        super(BatchWorker, self).__init__(*args, **kwargs)
+
+    def process_batch(self, channel, messages):
+        self.batches.append([m.properties.correlation_id for m in messages])
+        for message in messages:
+            self.notify('slug', 'message', 'started',
+                        corr_id=message.properties.correlation_id)
+        if any(m.body.get('short') for m in messages):
+            return [True]
+        return [m.body['ok'] for m in messages]
+
+
+class TestBatch(TestCase):
+    """
+    Tests for process_batch.
+    """
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.broker = fake.FakeBroker()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def start(self, config):
+        return start_worker(BatchWorker, self.broker, self.tmp, config)
+
+    def put(self, w, corr_id, body):
+        self.broker.put(w._queue, json.dumps(body), pika.spec.BasicProperties(
+            correlation_id=corr_id, reply_to='r'))
+
+    def test_size_and_window(self):
+        """
+        Full batches should go at once and partial ones after the window.
+        Each message is acked or rejected by its own result.
+        """
+        w = self.start({'batch': {'size': 3, 'window': 0.05}})
+        # The prefetch defaults to the batch size
+        assert w._prefetch == 3
+        for num in range(7):
+            self.put(w, str(num), {'ok': num != 4})
+        run_until(w, lambda: self.broker.acked + self.broker.rejected == 7)
+        assert w.batches == [['0', '1', '2'], ['3', '4', '5'], ['6']]
+        assert self.broker.acked == 6
+        assert self.broker.rejected == 1
+        run_until(w, lambda: w._in_flight == 0)
+
+    def test_bad_bodies_and_missing_keys(self):
+        """
+        Bodies which can not be parsed should be rejected alone and a
+        missing key should fail the whole batch.
+        """
+        w = self.start({'batch': {'size': 3, 'window': 10}})
+        self.broker.put(w._queue, '{not json', pika.spec.BasicProperties(
+            correlation_id='bad', reply_to='r'))
+        self.put(w, 'a', {'ok': True})
+        self.put(w, 'b', {})
+        run_until(w, lambda: self.broker.rejected == 3)
+        assert w.batches == [['a', 'b']]
+        assert self.broker.acked == 0
+        failed = [p[3] for p in self.broker.published if p[1] == 'r']
+        assert len(failed) == 3
+        assert all('failed' in body for body in failed)
+
+    def test_notify_per_message(self):
+        """
+        notify should use the notify section of the message it is for.
+        """
+        w = self.start({'batch': {'size': 2, 'window': 10}})
+        for num in range(2):
+            self.put(w, str(num), {
+                'ok': True,
+                'notify': {'started': {'irc': ['#chan%s' % num]}}})
+        run_until(w, lambda: self.broker.acked == 2)
+        targets = [
+            json.loads(p[3])['target']
+            for p in self.broker.published if p[1] == 'notify.irc']
+        assert targets == [['#chan0'], ['#chan1']]
+
+    def test_wrong_result_count(self):
+        """
+        A batch with a result count other than its message count should
+        fail and reject every message.
+        """
+        w = self.start({'batch': {'size': 2, 'window': 10}})
+        self.put(w, 'a', {'ok': True, 'short': True})
+        self.put(w, 'b', {'ok': True})
+        run_until(w, lambda: self.broker.rejected == 2)
+        assert self.broker.acked == 0
+        failed = [p[3] for p in self.broker.published if p[1] == 'r']
+        assert len(failed) == 2
+        assert all('failed' in body for body in failed)
+        run_until(w, lambda: w._in_flight == 0)
+
+    def test_pool_and_stop(self):
+        """
+        Batches should run on the pool and stop should not wait out the
+        window for a partial batch.
+        """
+        w = self.start({
+            'concurrency': 2, 'batch': {'size': 10, 'window': 60}})
+        for num in range(3):
+            self.put(w, str(num), {'ok': True})
+        run_until(w, lambda: w._in_flight == 3 and len(w._batch) == 3)
+        w.stop()
+        # Polling raises SystemExit once the worker has drained
+        self.assertRaises(SystemExit, run_until, w, lambda: False)
+        assert w.batches == [['0', '1', '2']]
+        assert self.broker.acked == 3
+
+
+if __name__ == '__main__':
+    unittest.main()
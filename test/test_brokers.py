@@ -0,0 +1,82 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests.
+"""
+
+from reworker import brokers
+
+from . import TestCase, unittest
+
+
+class TestBrokerSelector(TestCase):
+    """
+    Tests for the BrokerSelector class.
+    """
+
+    def test_untried_first(self):
+        """
+        Brokers never connected to should be tried first, picked at random.
+        """
+        bs = brokers.BrokerSelector(['a', 'b', 'c'])
+        picks = set(bs.choose(now=10) for _ in range(100))
+        assert picks == set(['a', 'b', 'c'])
+        bs.succeeded('a', 0.1)
+        bs.succeeded('b', 0.1)
+        assert bs.choose(now=10) == 'c'
+
+    def test_failures_are_skipped(self):
+        """
+        A failed broker should be skipped for a doubling penalty.
+        """
+        bs = brokers.BrokerSelector(['a', 'b'], penalty=5, max_penalty=8)
+        bs.failed('a', now=100)
+        assert bs.available(now=101) == ['b']
+        assert bs.choose(now=101) == 'b'
+        bs.succeeded('b', 0.1)
+        assert bs.choose(now=105) == 'a'
+        bs.failed('a', now=105)
+        assert bs.retry_at['a'] == 113
+        bs.succeeded('a', 0.1)
+        assert bs.failures['a'] == 0
+        assert bs.available(now=106) == ['a', 'b']
+
+    def test_all_failing_picks_first_back(self):
+        """
+        With every broker failing the one that comes back first is used.
+        """
+        bs = brokers.BrokerSelector(['a', 'b'])
+        bs.failed('a', now=100)
+        bs.failed('b', now=90)
+        assert bs.available(now=91) == []
+        assert bs.choose(now=91) == 'b'
+
+    def test_fastest_preferred(self):
+        """
+        Slow brokers should only be picked when close to the fastest.
+        """
+        bs = brokers.BrokerSelector(['a', 'b', 'c'], spread=0.5)
+        bs.succeeded('a', 0.1)
+        bs.succeeded('b', 0.12)
+        bs.succeeded('c', 1.0)
+        picks = set(bs.choose(now=10) for _ in range(50))
+        assert 'c' not in picks
+        assert picks <= set(['a', 'b'])
+
+    def test_invalid(self):
+        """
+        A selector needs at least one server.
+        """
+        self.assertRaises(ValueError, brokers.BrokerSelector, [])
@@ -0,0 +1,171 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests.
+"""
+
+import json
+import os.path
+import shutil
+import tempfile
+import threading
+import time
+
+import pika.spec
+
+from reworker import capture, fake, replay
+
+from . import (
+    AckWorker, StatusWorker, TestCase, put_messages, run_until, start_worker,
+    unittest)
+
+
+class TestCapture(TestCase):
+    """
+    Tests for recording and replaying deliveries.
+    """
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'capture')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_round_trip(self):
+        """
+        Records should read back with their time, flags and properties.
+        """
+        recorder = capture.Recorder(self.path)
+        deliver = pika.spec.Basic.Deliver(redelivered=True)
+        props = pika.spec.BasicProperties(
+            correlation_id='1', reply_to='r', headers={'a': 1})
+        assert recorder.record(10.5, deliver, props, '\x00{"x": 1}')
+        assert recorder.record(11.0, None, pika.spec.BasicProperties(), '')
+        recorder.close()
+        records = list(capture.read(self.path))
+        assert len(records) == 2
+        received, redelivered, props, body = records[0]
+        assert (received, redelivered, body) == (10.5, True, '\x00{"x": 1}')
+        assert props.correlation_id == '1'
+        assert props.reply_to == 'r'
+        assert props.headers == {'a': 1}
+        assert records[1][1] is False
+        assert records[1][3] == ''
+
+    def test_max_bytes_and_truncation(self):
+        """
+        Recording should stop at max_bytes and cut off records should be
+        skipped.
+        """
+        recorder = capture.Recorder(self.path, max_bytes=100)
+        props = pika.spec.BasicProperties()
+        assert recorder.record(1, None, props, 'a' * 40)
+        assert recorder.record(2, None, props, 'b' * 40) is False
+        assert recorder.full
+        recorder.close()
+        with open(self.path, 'ab') as f_obj:
+            f_obj.write(capture.RECORD.pack(3, 0, 2, 50) + '{}short')
+        assert [r[3] for r in capture.read(self.path)] == ['a' * 40]
+
+        with open(self.path, 'wb') as f_obj:
+            f_obj.write('NOTACAPT')
+        self.assertRaises(ValueError, list, capture.read(self.path))
+
+    def test_capture_and_replay(self):
+        """
+        A worker with capture set should record deliveries which replay
+        into another worker.
+        """
+        broker = fake.FakeBroker()
+        worker = start_worker(
+            AckWorker, broker, self.tmp, {'capture': {'path': self.path}})
+        put_messages(broker, worker, 5)
+        run_until(worker, lambda: broker.acked == 5)
+        worker._capture.close()
+        assert [r[2].correlation_id for r in capture.read(self.path)] == [
+            '0', '1', '2', '3', '4']
+
+        WorkerCls = replay.load_worker_class(
+            '%s:StatusWorker' % StatusWorker.__module__)
+        assert WorkerCls is StatusWorker
+        # Replaying with the same config must not record over the capture
+        result = replay.replay(
+            self.path, WorkerCls, os.path.join(self.tmp, 'config.json'),
+            speed=0, timeout=10)
+        assert result['acked'] == 5
+        assert result['unsettled'] == 0
+        assert result['published'] == 5 * 7
+        assert len(list(capture.read(self.path))) == 5
+        assert result['scenario'].endswith('xmax')
+
+    def test_large_properties(self):
+        """
+        Properties past 64KiB should be recorded and version 1 captures
+        should still read back.
+        """
+        recorder = capture.Recorder(self.path)
+        headers = {'big': 'x' * 70000}
+        assert recorder.record(
+            1.0, None, pika.spec.BasicProperties(headers=headers), 'body')
+        recorder.close()
+        records = list(capture.read(self.path))
+        assert records[0][2].headers == headers
+
+        old = os.path.join(self.tmp, 'old')
+        props = '{"correlation_id": "1"}'
+        with open(old, 'wb') as f_obj:
+            f_obj.write('RWCAPT01')
+            f_obj.write(capture.RECORDS['RWCAPT01'].pack(
+                2.0, 0, len(props), 4) + props + 'body')
+        records = list(capture.read(old))
+        assert records[0][2].correlation_id == '1'
+        assert records[0][3] == 'body'
+        # New records are never appended to an old capture
+        self.assertRaises(ValueError, capture.Recorder, old)
+
+    def test_replay_timeout(self):
+        """
+        A replay should return by its timeout, reporting what was not
+        settled, even while process hangs on a pool thread.
+        """
+        broker = fake.FakeBroker()
+        worker = start_worker(
+            AckWorker, broker, self.tmp, {'capture': {'path': self.path}})
+        put_messages(broker, worker, 2)
+        run_until(worker, lambda: broker.acked == 2)
+        worker._capture.close()
+
+        release = threading.Event()
+
+        class HangingWorker(AckWorker):
+            def process(self, *args, **kwargs):
+                release.wait()
+
+        with open(os.path.join(self.tmp, 'config.json'), 'w') as f_obj:
+            json.dump({'concurrency': 1}, f_obj)
+        started = time.time()
+        try:
+            result = replay.replay(
+                self.path, HangingWorker,
+                os.path.join(self.tmp, 'config.json'), speed=0, timeout=0.2)
+        finally:
+            release.set()
+        assert time.time() - started < 5
+        assert result['unsettled'] == 2
+
+
+if __name__ == '__main__':
+    unittest.main()
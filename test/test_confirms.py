@@ -0,0 +1,101 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests.
+"""
+
+import mock
+import pika
+
+from reworker import confirms
+
+from . import TestCase, unittest
+
+
+def frame(method):
+    """
+    Wraps a method like pika does for confirm callbacks.
+    """
+    return mock.MagicMock(method=method)
+
+
+class TestConfirmTracker(TestCase):
+    """
+    Tests for the ConfirmTracker class.
+    """
+
+    def setUp(self):
+        self.tracker = confirms.ConfirmTracker()
+        self.confs = [confirms.Confirmation() for _ in range(4)]
+        for conf in self.confs:
+            self.tracker.published(conf)
+
+    def test_single_ack(self):
+        """
+        A single ack should only settle its own tag, in any order.
+        """
+        self.tracker.on_confirm(frame(pika.spec.Basic.Ack(2, False)))
+        assert self.confs[1].done()
+        assert self.confs[1].acked is True
+        assert not self.confs[0].done()
+        assert len(self.tracker) == 3
+
+    def test_multiple_ack(self):
+        """
+        A multiple ack should settle every tag up to it in one go.
+        """
+        self.tracker.on_confirm(frame(pika.spec.Basic.Ack(3, True)))
+        assert [c.acked for c in self.confs] == [True, True, True, None]
+        assert self.tracker.acked == 3
+        assert len(self.tracker) == 1
+
+    def test_nack(self):
+        """
+        Nacks should resolve as not acked.
+        """
+        self.tracker.on_confirm(frame(pika.spec.Basic.Nack(1, False)))
+        assert self.confs[0].acked is False
+        assert self.confs[0].reason == 'nacked'
+        assert self.tracker.nacked == 1
+
+    def test_reset_fails_outstanding(self):
+        """
+        Outstanding publishes on a closed channel can never be confirmed.
+        """
+        self.tracker.reset()
+        assert all(c.acked is False for c in self.confs)
+        assert self.tracker.published(confirms.Confirmation()) == 1
+
+
+class TestConfirmation(TestCase):
+    """
+    Tests for the Confirmation class.
+    """
+
+    def test_callbacks(self):
+        """
+        Done callbacks should run on resolve, or right away once done.
+        """
+        conf = confirms.Confirmation()
+        before = mock.MagicMock()
+        conf.add_done_callback(before)
+        assert before.call_count == 0
+        conf._resolve(True)
+        before.assert_called_once_with(conf)
+        assert conf.wait(0) is True
+
+        after = mock.MagicMock()
+        conf.add_done_callback(after)
+        after.assert_called_once_with(conf)
@@ -0,0 +1,97 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests.
+"""
+
+import mock
+import os.path
+import shutil
+import tempfile
+
+from reworker import dedup
+
+from . import TestCase, unittest
+
+
+class TestDedup(TestCase):
+    """
+    Tests for the dedup caches.
+    """
+
+    def test_message_key(self):
+        """
+        Keys should depend on both the correlation id and the body.
+        """
+        key = dedup.message_key(1, '{"a": 1}')
+        assert key.startswith('1:')
+        assert key == dedup.message_key('1', '{"a": 1}')
+        assert key != dedup.message_key(2, '{"a": 1}')
+        assert key != dedup.message_key(1, '{"a": 2}')
+
+    def test_lru(self):
+        """
+        The memory cache should evict the least recently stored key.
+        """
+        cache = dedup.DedupCache(size=2)
+        cache.put('a', '1')
+        cache.put('b', '2')
+        cache.put('c', '3')
+        assert len(cache) == 2
+        assert cache.get('a') is None
+        assert cache.get('b') == '2'
+        assert cache.get('c') == '3'
+
+    def test_ttl(self):
+        """
+        Entries should expire after ttl seconds.
+        """
+        cache = dedup.DedupCache(ttl=10)
+        with mock.patch('reworker.dedup.time.time') as now:
+            now.return_value = 100
+            cache.put('a', '1')
+            now.return_value = 109
+            assert cache.get('a') == '1'
+            now.return_value = 110
+            assert cache.get('a') is None
+        assert len(cache) == 0
+
+    def test_sqlite(self):
+        """
+        The SQLite cache should be shared between instances on one file.
+        """
+        tmp = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp, 'dedup.db')
+            cache = dedup.from_config({'path': path, 'ttl': 10})
+            assert isinstance(cache, dedup.SqliteDedupCache)
+            cache.put('a', '{"status": "completed"}')
+            other = dedup.SqliteDedupCache(path, ttl=10)
+            assert other.get('a') == '{"status": "completed"}'
+            assert other.get('b') is None
+            with mock.patch('reworker.dedup.time.time') as now:
+                now.return_value = 1e12
+                assert other.get('a') is None
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_from_config(self):
+        """
+        Without a path a memory cache should be used.
+        """
+        cache = dedup.from_config({'size': 5, 'ttl': 60})
+        assert isinstance(cache, dedup.DedupCache)
+        assert cache.size == 5
+        assert cache.ttl == 60
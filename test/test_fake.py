@@ -0,0 +1,129 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests.
+"""
+
+import pika.spec
+
+from reworker import bench, fake
+
+from . import TestCase, unittest
+
+
+class TestFakeBroker(TestCase):
+    """
+    Tests for the in memory broker.
+    """
+
+    def consume(self, prefetch=0):
+        broker = fake.FakeBroker()
+        delivered = []
+        conn = broker.connection_class(
+            on_open_callback=lambda c: c.channel(opened))
+
+        def opened(channel):
+            channel.basic_qos(prefetch_count=prefetch)
+            channel.basic_consume(
+                lambda ch, deliver, props, body: delivered.append(
+                    (ch, deliver, body)),
+                queue='q')
+        return broker, conn, delivered
+
+    def test_prefetch_and_ack(self):
+        """
+        Deliveries should stop at the prefetch count until acked.
+        """
+        broker, conn, delivered = self.consume(prefetch=2)
+        for num in range(3):
+            broker.put('q', str(num))
+        conn.ioloop.poll()
+        conn.ioloop.poll()
+        conn.ioloop.poll()
+        assert [d[2] for d in delivered] == ['0', '1']
+        channel = delivered[0][0]
+        channel.basic_ack(delivered[1][1].delivery_tag, multiple=True)
+        conn.ioloop.poll()
+        assert [d[2] for d in delivered] == ['0', '1', '2']
+        assert broker.acked == 2
+        assert len(broker.ack_latencies) == 2
+
+    def test_reject_and_close_requeue(self):
+        """
+        Rejected and unacked messages should go back on the queue.
+        """
+        broker, conn, delivered = self.consume()
+        broker.put('q', 'a')
+        broker.put('q', 'b')
+        for _ in range(3):
+            conn.ioloop.poll()
+        channel = delivered[0][0]
+        channel.basic_reject(delivered[0][1].delivery_tag, requeue=False)
+        assert broker.rejected == 1
+        conn.close()
+        assert [m[1] for m in broker.queue('q')] == ['b']
+        assert broker.queue('q')[0][2] is True
+        assert broker.connections == []
+
+    def test_publish_routes_and_confirms(self):
+        """
+        Publishes should be recorded, routed and confirmed.
+        """
+        broker, conn, delivered = self.consume()
+        confirms = []
+        conn.ioloop.poll()
+        conn.ioloop.poll()
+        channel = broker.channels[0]
+        channel.confirm_delivery(confirms.append)
+        channel.basic_publish('', 'q', 'hi', pika.spec.BasicProperties())
+        channel.basic_publish('re', 'other', 'x')
+        conn.ioloop.poll()
+        conn.ioloop.poll()
+        assert len(broker.published) == 2
+        assert [d[2] for d in delivered] == ['hi']
+        assert [c.method.delivery_tag for c in confirms] == [1, 2]
+
+
+class TestBench(TestCase):
+    """
+    Tests for the benchmark suite.
+    """
+
+    def test_run_scenario(self):
+        """
+        A scenario should drive every message through a real worker.
+        """
+        result = bench.run_scenario('status', messages=20)
+        assert result['messages'] == 20
+        assert result['unsettled'] == 0
+        # Start banner, started, 3 lines, completed and finish banner
+        assert result['published'] == 20 * 7
+        assert result['msgs_per_sec'] > 0
+        for stage in ('decode', 'process', 'deliver_to_ack'):
+            assert set(result['stages'][stage]) == set(
+                ['p50', 'p90', 'p99', 'max'])
+        assert 'status: 20 messages' in bench.format_result(result)
+
+    def test_percentiles(self):
+        """
+        percentiles should pick the nearest ranked samples.
+        """
+        points = bench.percentiles(range(100))
+        assert points == {'p50': 50, 'p90': 90, 'p99': 99, 'max': 99}
+        assert bench.percentiles([]) == {}
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests.
+"""
+
+import mock
+import pika
+
+from reworker import manager, worker
+
+from . import TestCase, unittest
+
+MQ_CONF = {
+    'server': '127.0.0.1',
+    'port': 5672,
+    'vhost': '/',
+    'user': 'guest',
+    'password': 'guest',
+}
+
+
+class FirstWorker(worker.Worker):
+    """
+    Worker to test with.
+    """
+
+    def process(self, channel, basic_deliver, properties, body, output):
+        self.ack(basic_deliver)
+
+
+class SecondWorker(FirstWorker):
+    """
+    Another worker to test with.
+    """
+    pass
+
+
+class TestConnectionManager(TestCase):
+    """
+    Tests for the ConnectionManager class.
+    """
+
+    def setUp(self):
+        self.pika = mock.patch('reworker.manager.pika').start()
+        mock.patch('reworker.worker.pika').start()
+        mock.patch('reworker.worker.logging').start()
+        self.manager = manager.ConnectionManager(MQ_CONF)
+        self.first = self.manager.add(FirstWorker)
+        self.second = self.manager.add(SecondWorker)
+
+    def tearDown(self):
+        mock.patch.stopall()
+
+    def test_workers_share_connection(self):
+        """
+        Workers should not connect themselves and should get a channel
+        each on the shared connection.
+        """
+        assert self.first._connection is None
+        self.manager._connect()
+        assert self.pika.SelectConnection.call_count == 1
+        connection = self.manager._connection
+        assert self.first._connection is connection
+        assert self.second._connection is connection
+        assert self.first._queue == 'worker.firstworker'
+        assert self.second._queue == 'worker.secondworker'
+
+        self.manager._on_open(connection)
+        self.assertEqual(connection.channel.call_args_list, [
+            mock.call(self.first._on_channel_open),
+            mock.call(self.second._on_channel_open)])
+
+    def test_close_reconnects_all(self):
+        """
+        Losing the connection should detach every worker and reconnect.
+        """
+        self.manager._connect()
+        connection = self.manager._connection
+        for w in (self.first, self.second):
+            w._on_channel_open(mock.MagicMock(pika.channel.Channel))
+
+        self.manager._on_close(connection, 320, 'forced')
+        assert self.first._channel is None
+        assert self.second._channel is None
+        assert self.manager._connected is False
+        assert connection.add_timeout.call_args[0][1] == \
+            self.manager._reconnect
+
+    def test_stop_closes_after_all_drain(self):
+        """
+        The shared connection should close only once every worker drained.
+        """
+        self.manager._connect()
+        connection = self.manager._connection
+        self.second._in_flight = 1
+        self.manager.stop()
+        assert connection.close.call_count == 0
+
+        self.second._in_flight = 0
+        self.second._check_drained()
+        assert connection.close.call_count == 1
+        self.assertRaises(
+            SystemExit, self.manager._on_close, connection, 200, 'ok')
@@ -0,0 +1,125 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests.
+"""
+
+import shutil
+import tempfile
+
+import mock
+
+from reworker import fake, memory
+
+from . import (
+    AckWorker, TestCase, put_messages, run_until, start_worker, unittest)
+
+
+class TestMemory(TestCase):
+    """
+    Tests for memory accounting and the recycle policy.
+    """
+
+    def test_rss_bytes(self):
+        """
+        rss_bytes should find a resident size, with or without /proc.
+        """
+        assert memory.rss_bytes() > 1024 * 1024
+        with mock.patch('__builtin__.open', side_effect=IOError):
+            assert memory.rss_bytes() > 1024 * 1024
+
+    def test_allocation_tracker(self):
+        """
+        AllocationTracker should see memory kept alive by a call.
+        """
+        tracker = memory.AllocationTracker()
+        before = tracker.current()
+        kept = [' ' * (64 * 1024 * 1024)]
+        assert tracker.current() - before >= 32 * 1024 * 1024
+        del kept
+
+    def test_recycle_max_messages(self):
+        """
+        The policy should ask to recycle after max_messages.
+        """
+        policy = memory.RecyclePolicy(max_messages=3)
+        assert policy.done() is None
+        assert policy.done() is None
+        assert 'handled 3' in policy.done()
+
+    def test_recycle_max_rss(self):
+        """
+        The policy should check the resident size every check_every.
+        """
+        policy = memory.RecyclePolicy.from_config(
+            {'max_rss_mb': 1, 'check_every': 2})
+        assert policy.max_rss == 1024 * 1024
+        assert policy.done() is None
+        assert policy.rss is None
+        assert 'resident size' in policy.done()
+        assert policy.rss > policy.max_rss
+        assert memory.RecyclePolicy(max_rss=1024 ** 4).done() is None
+
+
+class TestWorkerRecycle(TestCase):
+    """
+    Tests for recycling a worker.
+    """
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_worker_recycles(self):
+        """
+        A worker should drain and exit once its recycle policy says so.
+        """
+        broker = fake.FakeBroker()
+        worker = start_worker(AckWorker, broker, self.tmp, {
+            'prefetch': 1,
+            'memory': {'log_above': 1024 ** 3},
+            'recycle': {'max_messages': 3}})
+        worker.app_logger = mock.MagicMock()
+        put_messages(broker, worker, 6)
+        # Polling raises SystemExit once the worker has drained
+        self.assertRaises(SystemExit, run_until, worker, lambda: False)
+        assert worker._recycle.handled == 3
+        assert worker.metrics.allocations.count >= 3
+        logged = [c for c in (worker.app_logger.warn.call_args_list +
+                              worker.app_logger.debug.call_args_list)
+                  if 'bytes allocated' in c[0][0]]
+        assert len(logged) >= 3
+        # Nothing is lost. Undelivered messages stay queued.
+        assert broker.acked + len(broker.queue(worker._queue)) == 6
+        assert broker.acked < 6
+
+    def test_accounting_needs_one_at_a_time(self):
+        """
+        Memory accounting should be ignored when messages run
+        concurrently as the figures are per process.
+        """
+        broker = fake.FakeBroker()
+        for config, accounted in (
+                ({'concurrency': 2, 'memory': {}}, False),
+                ({'offload': True, 'memory': {}}, True)):
+            worker = start_worker(AckWorker, broker, self.tmp, config)
+            worker._pool.shutdown()
+            assert (worker._allocations is not None) == accounted
+
+
+if __name__ == '__main__':
+    unittest.main()
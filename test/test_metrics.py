@@ -0,0 +1,82 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests.
+"""
+
+import urllib2
+
+from reworker import metrics
+
+from . import TestCase, unittest
+
+
+class TestMetrics(TestCase):
+    """
+    Tests for the metrics module.
+    """
+
+    def test_counter_and_gauge(self):
+        """
+        Counters and gauges should track their value.
+        """
+        c = metrics.Counter('c', 'help')
+        c.inc()
+        c.inc(4)
+        assert c.samples() == [('c', '', 5)]
+        g = metrics.Gauge('g', 'help')
+        g.set(3)
+        g.dec()
+        assert g.value == 2
+
+    def test_histogram_buckets(self):
+        """
+        Histogram samples should be cumulative with a +Inf bucket.
+        """
+        h = metrics.Histogram('h', 'help', buckets=(1, 5))
+        for value in (0.5, 1, 3, 10):
+            h.observe(value)
+        assert h.samples() == [
+            ('h_bucket', '{le="1"}', 2),
+            ('h_bucket', '{le="5"}', 3),
+            ('h_bucket', '{le="+Inf"}', 4),
+            ('h_sum', '', 14.5),
+            ('h_count', '', 4),
+        ]
+
+    def test_render(self):
+        """
+        Rendering should follow the Prometheus text format.
+        """
+        m = metrics.Metrics(prefix='test')
+        m.received.inc()
+        text = m.render()
+        assert '# TYPE test_messages_received_total counter\n' in text
+        assert 'test_messages_received_total 1\n' in text
+        assert '# TYPE test_process_seconds histogram\n' in text
+        assert 'test_process_seconds_bucket{le="+Inf"} 0\n' in text
+
+    def test_server(self):
+        """
+        The server should serve the rendered metrics.
+        """
+        m = metrics.Metrics()
+        server = metrics.MetricsServer(m, 0)
+        try:
+            response = urllib2.urlopen(
+                'http://127.0.0.1:%s/metrics' % server.port)
+            assert response.read() == m.render()
+        finally:
+            server.shutdown()
@@ -101,3 +101,153 @@ class TestOutput(TestCase):
         o.log('WARN', 'testing')
         o.log('ERROR', 'testing')
         self.send_meth.call_count == 0
+
+
+class TestBufferedOutput(TestCase):
+    """
+    Tests for the BufferedOutput class.
+    """
+
+    def setUp(self):
+        self.send_meth = mock.MagicMock(send)
+
+    def test_lines_are_coalesced(self):
+        """
+        Lines should be held until flush and sent as one message.
+        """
+        o = output.BufferedOutput(self.send_meth, CORR_ID, 'DEBUG')
+        o.info('one')
+        o.debug('two')
+        assert self.send_meth.call_count == 0
+        o.flush()
+        self.send_meth.assert_called_once_with(
+            'output', CORR_ID, {'messages': ['one', 'two']})
+        # Nothing left so nothing more is sent
+        o.flush()
+        assert self.send_meth.call_count == 1
+
+    def test_level_filtering(self):
+        """
+        Lines under the level should never be buffered.
+        """
+        o = output.BufferedOutput(self.send_meth, CORR_ID, 'INFO')
+        o.debug('skipped')
+        o.flush()
+        assert self.send_meth.call_count == 0
+
+    def test_flush_on_size(self):
+        """
+        Hitting the line or byte limit should flush.
+        """
+        o = output.BufferedOutput(self.send_meth, CORR_ID, max_lines=2)
+        o.info('a')
+        o.info('b')
+        self.send_meth.assert_called_once_with(
+            'output', CORR_ID, {'messages': ['a', 'b']})
+
+        self.send_meth.reset_mock()
+        o = output.BufferedOutput(self.send_meth, CORR_ID, max_bytes=5)
+        o.info('abc')
+        assert self.send_meth.call_count == 0
+        o.info('def')
+        assert self.send_meth.call_count == 1
+
+    def test_flush_on_level_escalation(self):
+        """
+        A line at or above the flush level should flush right away.
+        """
+        o = output.BufferedOutput(self.send_meth, CORR_ID)
+        o.info('fine')
+        o.error('broken')
+        self.send_meth.assert_called_once_with(
+            'output', CORR_ID, {'messages': ['fine', 'broken']})
+
+    def test_flush_on_interval(self):
+        """
+        Lines older than the interval should be flushed on the next log.
+        """
+        o = output.BufferedOutput(self.send_meth, CORR_ID, interval=10)
+        with mock.patch('reworker.output.time.time') as now:
+            now.return_value = 100
+            o.info('first')
+            now.return_value = 105
+            o.info('second')
+            assert self.send_meth.call_count == 0
+            now.return_value = 111
+            o.info('third')
+            self.send_meth.assert_called_once_with(
+                'output', CORR_ID, {'messages': ['first', 'second', 'third']})
+
+
+    def test_flush_on_timer(self):
+        """
+        With call_later lines should be flushed by a timer once the
+        interval passes even if nothing more is logged.
+        """
+        call_later = mock.MagicMock()
+        o = output.BufferedOutput(
+            self.send_meth, CORR_ID, interval=10, call_later=call_later)
+        o.info('first')
+        o.info('second')
+        assert call_later.call_count == 1
+        seconds, func = call_later.call_args[0]
+        assert seconds == 10
+        func()
+        self.send_meth.assert_called_once_with(
+            'output', CORR_ID, {'messages': ['first', 'second']})
+
+        # A timer whose lines already went out does nothing
+        o.info('third')
+        assert call_later.call_count == 2
+        o.flush()
+        assert self.send_meth.call_count == 2
+        o.info('fourth')
+        call_later.call_args_list[1][0][1]()
+        assert self.send_meth.call_count == 2
+
+class TestLazyOutput(TestCase):
+    """
+    Tests for lazy formatting on Output.
+    """
+
+    def setUp(self):
+        self.send_meth = mock.MagicMock(send)
+
+    def test_args_are_formatted(self):
+        """
+        Args should be formatted into the message when it is sent.
+        """
+        o = output.Output(self.send_meth, CORR_ID, 'DEBUG')
+        o.debug('%s is %d', 'answer', 42)
+        self.send_meth.assert_called_once_with(
+            'output', CORR_ID, {'message': 'answer is 42'})
+
+    def test_filtered_messages_are_not_formatted(self):
+        """
+        Args should never be rendered for messages under the level.
+        """
+        o = output.Output(self.send_meth, CORR_ID, 'INFO')
+        arg = mock.MagicMock()
+        o.debug('%s', arg)
+        assert arg.__str__.call_count == 0
+        assert self.send_meth.call_count == 0
+
+    def test_messages_without_args_are_untouched(self):
+        """
+        A message with no args should be sent as is, even with a %.
+        """
+        o = output.Output(self.send_meth, CORR_ID)
+        o.info('100% done')
+        self.send_meth.assert_called_once_with(
+            'output', CORR_ID, {'message': '100% done'})
+
+    def test_isEnabledFor(self):
+        """
+        isEnabledFor should accept level names and numbers.
+        """
+        o = output.Output(self.send_meth, CORR_ID, 'WARN')
+        assert o.isEnabledFor('ERROR')
+        assert o.isEnabledFor('error')
+        assert o.isEnabledFor(logging.WARNING)
+        assert not o.isEnabledFor('INFO')
+        assert not o.isEnabledFor(logging.DEBUG)
@@ -0,0 +1,243 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests.
+"""
+
+import select
+import threading
+import time
+
+import mock
+
+from reworker import pool
+
+from . import TestCase, unittest
+
+
+class TestWorkerPool(TestCase):
+    """
+    Tests for the WorkerPool class.
+    """
+
+    def test_submit_runs_on_pool_threads(self):
+        """
+        Submitted tasks should execute on threads other than the caller.
+        """
+        p = pool.WorkerPool(2)
+        seen = []
+        p.submit(lambda: seen.append(threading.current_thread()))
+        p.shutdown()
+        assert len(seen) == 1
+        assert seen[0] is not threading.current_thread()
+
+    def test_bounded_shutdown(self):
+        """
+        A shutdown with a timeout should return once it passes even while
+        a task hangs with more waiting behind it.
+        """
+        p = pool.WorkerPool(1, 1)
+        release = threading.Event()
+        p.submit(release.wait)
+        p.submit(release.wait)
+        assert p.shutdown(timeout=0.05) is False
+        assert p.alive() == 1
+        release.set()
+        assert p.shutdown(timeout=5) is True
+
+    def test_errors_do_not_kill_threads(self):
+        """
+        A failing task should not stop the pool from running later tasks.
+        """
+        p = pool.WorkerPool(1)
+        results = []
+
+        def fail():
+            raise Exception('oops')
+
+        p.submit(fail)
+        p.submit(results.append, 1)
+        p.shutdown()
+        assert results == [1]
+
+    def test_invalid_size(self):
+        """
+        A pool needs at least one thread.
+        """
+        self.assertRaises(ValueError, pool.WorkerPool, 0)
+
+    def test_retire_replaces_thread(self):
+        """
+        Retiring a stuck thread should let queued tasks run on a new one.
+        """
+        p = pool.WorkerPool(1)
+        stuck = threading.Event()
+        release = threading.Event()
+        idents = []
+
+        def hang():
+            idents.append(threading.current_thread().ident)
+            stuck.set()
+            release.wait(5)
+
+        p.submit(hang)
+        stuck.wait(5)
+        assert p.retire(idents[0]) is True
+        assert p.retire(idents[0]) is False
+        done = threading.Event()
+        p.submit(lambda: done.set())
+        assert done.wait(5)
+        release.set()
+        p.shutdown()
+
+
+class TestIOLoopCallbacks(TestCase):
+    """
+    Tests for the IOLoopCallbacks class.
+    """
+
+    def test_call_inline_on_ioloop(self):
+        """
+        Calls made on the ioloop thread should execute right away.
+        """
+        cb = pool.IOLoopCallbacks()
+        cb.start(mock.MagicMock())
+        func = mock.MagicMock()
+        cb.call(func, 1, a=2)
+        func.assert_called_once_with(1, a=2)
+
+    def test_call_from_other_thread_is_queued(self):
+        """
+        Without a way to wake the ioloop calls from other threads should
+        wait for the next drain.
+        """
+        connection = mock.MagicMock(spec=['add_timeout', 'remove_timeout'])
+        cb = pool.IOLoopCallbacks()
+        cb.start(connection)
+        assert connection.add_timeout.call_count == 1
+
+        func = mock.MagicMock()
+        thread = threading.Thread(target=cb.call, args=(func, 'x'))
+        thread.start()
+        thread.join()
+        assert func.call_count == 0
+
+        cb._on_timeout()
+        func.assert_called_once_with('x')
+        # The drain should reschedule itself
+        assert connection.add_timeout.call_count == 2
+
+        cb.stop()
+        assert connection.remove_timeout.call_count == 1
+
+
+    def _call_from_thread(self, cb, func, *args):
+        thread = threading.Thread(target=cb.call, args=(func,) + args)
+        thread.start()
+        thread.join()
+
+    def test_wake_threadsafe(self):
+        """
+        Calls from other threads should wake the ioloop once through
+        add_callback_threadsafe.
+        """
+        connection = mock.MagicMock()
+        cb = pool.IOLoopCallbacks()
+        cb.start(connection)
+        assert connection.add_timeout.call_count == 0
+
+        func = mock.MagicMock()
+        self._call_from_thread(cb, func, 1)
+        self._call_from_thread(cb, func, 2)
+        connection.add_callback_threadsafe.assert_called_once_with(
+            cb._on_wake)
+        cb._on_wake()
+        assert func.call_args_list == [mock.call(1), mock.call(2)]
+        self._call_from_thread(cb, func, 3)
+        assert connection.add_callback_threadsafe.call_count == 2
+
+    def test_wake_pipe(self):
+        """
+        With pika's poll based pollers a pipe should wake the ioloop and
+        other events should still reach the connection.
+        """
+        handler = mock.MagicMock()
+        poller = mock.MagicMock(_poll=select.poll(), _handler=handler)
+        connection = mock.MagicMock(
+            spec=['add_timeout', 'remove_timeout', 'ioloop'])
+        connection.ioloop.poller = poller
+        cb = pool.IOLoopCallbacks()
+        cb.start(connection)
+        assert connection.add_timeout.call_count == 0
+
+        func = mock.MagicMock()
+        self._call_from_thread(cb, func, 'x')
+        events = poller._poll.poll(1000)
+        assert events == [(cb._pipe[0], select.POLLIN)]
+        for fileno, event in events:
+            poller._handler(fileno, event)
+        func.assert_called_once_with('x')
+        assert poller._poll.poll(0) == []
+        poller._handler(99, 1, write_only=True)
+        handler.assert_called_once_with(99, 1, write_only=True)
+
+
+class TestKeyedWorkerPool(TestCase):
+    """
+    Tests for the KeyedWorkerPool class.
+    """
+
+    def test_same_key_is_ordered(self):
+        """
+        Tasks for one key should run in order on one thread.
+        """
+        p = pool.KeyedWorkerPool(4, max_pending=100)
+        seen = []
+        for num in range(50):
+            p.dispatch('release-1', lambda n=num: seen.append(
+                (n, threading.current_thread())))
+        p.shutdown()
+        assert [n for n, _ in seen] == range(50)
+        assert len(set(t for _, t in seen)) == 1
+
+    def test_dispatch_never_blocks(self):
+        """
+        Dispatching many tasks for a busy key should not block.
+        """
+        p = pool.KeyedWorkerPool(2)
+        release = threading.Event()
+        started = time.time()
+        for _ in range(10):
+            p.dispatch('release-1', release.wait, 5)
+        assert time.time() - started < 1
+        release.set()
+        p.shutdown()
+
+    def test_keys_spread_over_lanes(self):
+        """
+        Different keys should be able to land on different lanes and the
+        mapping should be stable.
+        """
+        p = pool.KeyedWorkerPool(4)
+        lanes = set(p.lane_for('release-%s' % n) for n in range(100))
+        assert lanes == set(range(4))
+        assert p.lane_for(12345) == p.lane_for('12345')
+        p.shutdown()
+
+    def test_invalid_lanes(self):
+        """
+        A keyed pool needs at least one lane.
+        """
+        self.assertRaises(ValueError, pool.KeyedWorkerPool, 0)
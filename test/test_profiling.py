@@ -0,0 +1,95 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests.
+"""
+
+import os
+import os.path
+import pstats
+import shutil
+import tempfile
+
+from reworker import fake, profiling
+
+from . import (
+    StatusWorker, TestCase, put_messages, run_until, start_worker, unittest)
+
+
+def _busy(num):
+    return sum(range(num))
+
+
+class TestProfiler(TestCase):
+    """
+    Tests for the Profiler class.
+    """
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_sampled(self):
+        """
+        Every Nth message and listed correlation ids should be sampled.
+        """
+        profiler = profiling.Profiler(every=3, corr_ids=[7])
+        picked = [n for n in range(1, 10) if profiler.sampled(n)]
+        assert picked == [3, 6, 7, 9]
+        profiler = profiling.Profiler(every=0, corr_ids=['a'])
+        assert not profiler.sampled('b')
+        assert profiler.sampled('a')
+
+    def test_call_aggregates_and_dumps(self):
+        """
+        Profiled calls should be added together and dumped every
+        dump_every.
+        """
+        profiler = profiling.Profiler(
+            directory=os.path.join(self.tmp, 'prof'), dump_every=2,
+            name='test')
+        assert profiler.dump() is None
+        assert 'Nothing' in profiler.report()
+        assert profiler.call(_busy, 10) == 45
+        assert not os.path.exists(profiler.directory)
+        profiler.call(_busy, 20)
+        files = os.listdir(profiler.directory)
+        assert len(files) == 1 and files[0].startswith('test-')
+        stats = pstats.Stats(os.path.join(profiler.directory, files[0]))
+        calls = [v[1] for k, v in stats.stats.items() if k[2] == '_busy']
+        assert calls == [2]
+        assert '_busy' in profiler.report()
+
+    def test_worker_profiles_process(self):
+        """
+        A worker with profile set should profile sampled messages and
+        dump them.
+        """
+        directory = os.path.join(self.tmp, 'prof')
+        broker = fake.FakeBroker()
+        worker = start_worker(StatusWorker, broker, self.tmp, {'profile': {
+            'every': 2, 'directory': directory, 'signal': None}})
+        put_messages(broker, worker, 4)
+        run_until(worker, lambda: broker.acked == 4)
+        assert worker.metrics.profiled.value == 2
+        assert worker._profiler.profiled == 2
+        worker._dump_profile()
+        assert len(os.listdir(directory)) == 1
+
+
+if __name__ == '__main__':
+    unittest.main()
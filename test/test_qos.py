@@ -0,0 +1,118 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests.
+"""
+
+from reworker import qos
+
+from . import TestCase, unittest
+
+
+class TestAdaptivePrefetch(TestCase):
+    """
+    Tests for the AdaptivePrefetch class.
+    """
+
+    def test_creation_clamps(self):
+        """
+        The initial count should be kept within the bounds.
+        """
+        ap = qos.AdaptivePrefetch(initial=500, minimum=2, maximum=50)
+        assert ap.current == 50
+        ap = qos.AdaptivePrefetch(initial=0, minimum=2, maximum=50)
+        assert ap.current == 2
+
+    def test_fast_messages_grow_prefetch(self):
+        """
+        Quick messages should deepen the prefetch.
+        """
+        ap = qos.AdaptivePrefetch(
+            initial=1, maximum=100, target_wait=1.0, interval=0)
+        assert ap.record(0.1, now=10) == 11
+        assert ap.current == 11
+
+    def test_slow_messages_shrink_prefetch(self):
+        """
+        Slow messages should leave work on the broker.
+        """
+        ap = qos.AdaptivePrefetch(
+            initial=50, workers=2, target_wait=1.0, interval=0)
+        assert ap.record(10.0, now=10) == 3
+
+    def test_interval_and_small_changes_ignored(self):
+        """
+        Changes should be rate limited and small moves ignored.
+        """
+        ap = qos.AdaptivePrefetch(
+            initial=1, target_wait=1.0, interval=60)
+        assert ap.record(0.1, now=100) == 11
+        # Within the interval nothing changes
+        assert ap.record(0.01, now=110) is None
+        ap.interval = 0
+        # 11 -> 12 is too small a move to bother the broker with
+        ap.latency = None
+        assert ap.record(1.0 / 11, now=200) is None
+
+    def test_from_config(self):
+        """
+        Config keys should map to the instance.
+        """
+        ap = qos.AdaptivePrefetch.from_config(
+            {'min': 3, 'max': 30, 'target_wait': 2}, initial=4, workers=2)
+        assert ap.minimum == 3
+        assert ap.maximum == 30
+        assert ap.target_wait == 2.0
+        assert ap.workers == 2
+        assert ap.current == 4
+
+
+class TestBackpressure(TestCase):
+    """
+    Tests for the Backpressure class.
+    """
+
+    def test_in_flight_watermarks(self):
+        """
+        Consuming should pause above the high mark and resume at the low.
+        """
+        bp = qos.Backpressure(in_flight_high=10, in_flight_low=4)
+        assert bp.update(10, 0) is False
+        assert bp.update(11, 0) is True
+        assert bp.paused is True
+        assert bp.update(5, 0) is False
+        assert bp.update(4, 0) is True
+        assert bp.paused is False
+
+    def test_outbound_watermarks(self):
+        """
+        Outbound bytes should also pause and low defaults to half of high.
+        """
+        bp = qos.Backpressure.from_config({'outbound_high': 1000})
+        assert bp.outbound_low == 500
+        assert bp.in_flight_high is None
+        assert bp.update(10000, 1001) is True
+        assert bp.paused is True
+        assert bp.update(0, 501) is False
+        assert bp.update(0, 500) is True
+
+    def test_resume_needs_both_low(self):
+        """
+        Resuming should wait for both values to drop.
+        """
+        bp = qos.Backpressure(in_flight_high=2, outbound_high=100)
+        assert bp.update(3, 0) is True
+        assert bp.update(0, 200) is False
+        assert bp.update(0, 10) is True
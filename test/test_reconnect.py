@@ -0,0 +1,76 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests.
+"""
+
+from reworker import reconnect
+
+from . import TestCase, unittest
+
+
+class TestBackoff(TestCase):
+    """
+    Tests for the Backoff class.
+    """
+
+    def test_exponential_without_jitter(self):
+        """
+        Without jitter the delay should grow by the multiplier to the cap.
+        """
+        b = reconnect.Backoff(initial=1, maximum=5, jitter=False)
+        assert [b.next_delay() for _ in range(5)] == [1, 2, 4, 5, 5]
+        assert b.attempts == 5
+        assert b.reconnects == 5
+
+    def test_jitter_within_bounds(self):
+        """
+        With jitter the delay should stay between initial and the ceiling,
+        which starts one step up so first attempts are spread too.
+        """
+        b = reconnect.Backoff(initial=1, maximum=30)
+        for attempt in range(10):
+            ceiling = min(30, 2 ** (attempt + 1))
+            assert 1 <= b.next_delay() <= ceiling
+        first = set(reconnect.Backoff().next_delay() for _ in range(50))
+        assert len(first) > 1
+        assert all(1 <= delay <= 2 for delay in first)
+
+    def test_long_outage(self):
+        """
+        The delay should stay at the cap however many attempts were made.
+        """
+        for jitter in (False, True):
+            b = reconnect.Backoff(maximum=60, jitter=jitter)
+            b.attempts = 1100
+            assert 1 <= b.next_delay() <= 60
+        b = reconnect.Backoff(maximum=60, multiplier=1e10, jitter=False)
+        b.attempts = 5000
+        assert b.next_delay() == 60
+
+    def test_reset(self):
+        """
+        A successful connection should restart the backoff.
+        """
+        b = reconnect.Backoff(initial=2, jitter=False)
+        b.next_delay()
+        b.next_delay()
+        b.reset()
+        assert b.next_delay() == 2
+        stats = b.stats()
+        assert stats['attempts'] == 1
+        assert stats['reconnects'] == 3
+        assert stats['connects'] == 1
+        assert stats['last_connected'] is not None
@@ -18,6 +18,7 @@ Unittests.
 
 import json
 import os.path
+import signal
 import sys
 import mock
 
@@ -39,6 +40,13 @@ class DummyWorker(worker.Worker):
 
 class TestWorker(TestCase):
 
+    def setUp(self):
+        self.sigterm = signal.getsignal(signal.SIGTERM)
+
+    def tearDown(self):
+        # run_worker installs its own SIGTERM handler
+        signal.signal(signal.SIGTERM, self.sigterm)
+
     def test_runner_inputs(self):
         """
         The runner function should honor inputs.
@@ -78,3 +86,52 @@ class TestWorker(TestCase):
                 config_file='examples/mqconf.json')
 
             assert dummy().run_forever.call_count == 1
+
+    def test_runner_processes(self):
+        """
+        With more than one process the runner should use a supervisor.
+        """
+        with nested(
+                mock.patch('reworker.worker.pika'),
+                mock.patch('reworker.worker.logging'),
+                mock.patch('reworker.worker.Supervisor')) as (_, _, sup):
+            sys.argv = ['', 'examples/mqconf.json', '-p', '3', '--pin-cpus']
+            dummy = mock.Mock(worker.Worker)
+            worker.runner(dummy)
+
+            assert sup.call_count == 1
+            args, kwargs = sup.call_args
+            assert args[1] == 3
+            assert kwargs['pin_cpus'] is True
+            assert sup.return_value.run.call_count == 1
+            # Workers are only created in the children
+            assert dummy.call_count == 0
+
+            # Each child runs its own worker
+            args[0](0)
+            dummy.assert_called_once_with(
+                json.load(open('examples/mqconf.json', 'r')),
+                config_file=None)
+            assert dummy().run_forever.call_count == 1
+
+    def test_multi_runner(self):
+        """
+        multi_runner should add every class to one ConnectionManager.
+        """
+        with nested(
+                mock.patch('reworker.worker.pika'),
+                mock.patch('reworker.worker.logging'),
+                mock.patch('reworker.worker.ConnectionManager')) as (
+                    _, _, manager):
+            sys.argv = [
+                '', 'examples/mqconf.json', '-w', 'examples/mqconf.json']
+            first = mock.Mock(worker.Worker)
+            second = mock.Mock(worker.Worker)
+            worker.multi_runner([first, second])
+
+            manager.assert_called_once_with(
+                json.load(open('examples/mqconf.json', 'r')))
+            self.assertEqual(manager().add.call_args_list, [
+                mock.call(first, config_file='examples/mqconf.json'),
+                mock.call(second, config_file=None)])
+            assert manager().run_forever.call_count == 1
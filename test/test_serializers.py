@@ -0,0 +1,84 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests.
+"""
+
+import json
+
+from reworker import serializers
+
+from . import TestCase, unittest
+
+
+class TestSerializers(TestCase):
+    """
+    Tests for the serializers module.
+    """
+
+    def test_json_round_trip(self):
+        """
+        The default serializer should be stdlib json.
+        """
+        s = serializers.get_serializer('json')
+        assert s.content_type == 'application/json'
+        body = s.dumps({'a': [1, 2]})
+        assert body == json.dumps({'a': [1, 2]})
+        assert s.loads(body) == {'a': [1, 2]}
+
+    def test_fastjson_always_available(self):
+        """
+        fastjson should fall back to json when no faster library exists.
+        """
+        s = serializers.get_serializer('fastjson')
+        assert s.content_type == 'application/json'
+        assert s.loads(s.dumps({'a': 'b'})) == {'a': 'b'}
+
+    def test_unknown_serializer(self):
+        """
+        Unknown names should raise ValueError.
+        """
+        self.assertRaises(ValueError, serializers.get_serializer, 'xml')
+
+    def test_decode_errors_are_value_errors(self):
+        """
+        Any decode error should surface as a ValueError.
+        """
+        def loads(body):
+            raise TypeError('bad')
+
+        s = serializers.Serializer('test', 'test/test', str, loads)
+        self.assertRaises(ValueError, s.loads, 'x')
+
+    def test_for_content_type(self):
+        """
+        Decoding should follow the content type, defaulting to json.
+        """
+        assert serializers.for_content_type(None) is serializers.JSON
+        assert serializers.for_content_type('text/plain') is \
+            serializers.JSON
+        fast = serializers.get_serializer('fastjson')
+        assert serializers.for_content_type(
+            'application/json', fast) is fast
+
+    @unittest.skipIf(serializers.msgpack is None, 'msgpack not installed')
+    def test_msgpack(self):
+        """
+        msgpack should round trip and be picked by content type.
+        """
+        s = serializers.get_serializer('msgpack')
+        assert s.loads(s.dumps({'a': u'b'})) == {'a': u'b'}
+        assert serializers.for_content_type(
+            'application/x-msgpack') is s
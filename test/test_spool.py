@@ -0,0 +1,101 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests.
+"""
+
+import os
+import os.path
+import shutil
+import tempfile
+
+from reworker import spool
+
+from . import TestCase, unittest
+
+
+class TestSpool(TestCase):
+    """
+    Tests for the Spool class.
+    """
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'spool')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_records_in_order(self):
+        """
+        Records should come back oldest first with every field intact.
+        """
+        s = spool.Spool(self.path, max_bytes=4096)
+        assert s.append('re', 'notify.irc', 1, None, '{"a": 1}')
+        assert s.append('', 'amq.gen-x', 1, 'log', '\x00\xffbinary')
+        self.assertEqual(s.records(), [
+            ('re', 'notify.irc', '1', '', '{"a": 1}'),
+            ('', 'amq.gen-x', '1', 'log', '\x00\xffbinary')])
+        s.clear()
+        assert s.records() == []
+        assert len(s) == 0
+        s.close()
+
+    def test_survives_reopen(self):
+        """
+        Records should still be there after the journal is reopened.
+        """
+        s = spool.Spool(self.path, max_bytes=4096)
+        s.append('re', 'topic', 'abc', 'log', 'body')
+        s.close()
+        s = spool.from_config({'path': self.path, 'max_bytes': 4096})
+        assert s.records() == [('re', 'topic', 'abc', 'log', 'body')]
+        s.close()
+
+    def test_release_keeps_newer(self):
+        """
+        Releasing the records read should keep those appended since.
+        """
+        s = spool.Spool(self.path, max_bytes=4096)
+        s.append('re', 'topic', 1, 'log', 'one')
+        s.append('re', 'topic', 2, 'log', 'two')
+        read = s.records()
+        s.append('re', 'topic', 3, 'log', 'three')
+        s.release(len(read))
+        assert s.records() == [('re', 'topic', '3', 'log', 'three')]
+        s.release(1)
+        assert len(s) == 0
+        s.close()
+
+    def test_one_owner(self):
+        """
+        A journal should only be opened by one owner at a time.
+        """
+        s = spool.Spool(self.path, max_bytes=4096)
+        self.assertRaises(IOError, spool.Spool, self.path, 4096)
+        s.close()
+        s = spool.Spool(self.path, max_bytes=4096)
+        s.close()
+
+    def test_disk_is_capped(self):
+        """
+        Appends which would grow the journal past max_bytes are refused.
+        """
+        s = spool.Spool(self.path, max_bytes=2048)
+        assert os.path.getsize(self.path) == 2048
+        assert s.append('re', 'topic', 1, 'log', 'x' * 1000)
+        assert not s.append('re', 'topic', 2, 'log', 'x' * 1000)
+        assert len(s.records()) == 1
+        s.close()
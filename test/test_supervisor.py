@@ -0,0 +1,208 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests.
+"""
+
+import os
+import shutil
+import signal
+import tempfile
+import time
+
+import mock
+
+from contextlib import nested
+from reworker import supervisor
+
+from . import TestCase, unittest
+
+
+def wait_for(check, timeout=5):
+    """
+    Polls check until it returns True or timeout seconds pass.
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if check():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+class TestSupervisor(TestCase):
+    """
+    Tests for the Supervisor class.
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def target(self, slot):
+        """
+        Records that slot ran in a file then exits.
+        """
+        with open(os.path.join(self.tmpdir, str(slot)), 'a') as f_obj:
+            f_obj.write('.')
+
+    def runs(self, slot):
+        path = os.path.join(self.tmpdir, str(slot))
+        if not os.path.exists(path):
+            return 0
+        return len(open(path).read())
+
+    def test_children_are_restarted(self):
+        """
+        A child which exits should be restarted after its backoff.
+        """
+        s = supervisor.Supervisor(
+            self.target, 1, logger=mock.MagicMock(),
+            backoff={'initial': 0.01, 'max': 0.01})
+        s._spawn(0)
+
+        def reaped():
+            s._reap()
+            return not s.children
+        assert wait_for(reaped)
+        assert self.runs(0) == 1
+        assert 0 in s._restart_at
+
+        time.sleep(0.02)
+        s._restart_due()
+        assert len(s.children) == 1
+        assert wait_for(reaped)
+        assert self.runs(0) == 2
+
+    def test_clean_exits_skip_backoff(self):
+        """
+        A child which exits cleanly, as when it recycles, should be
+        restarted right away and only failures should back off.
+        """
+        def target(slot):
+            self.target(slot)
+            if slot:
+                raise Exception('crashed')
+        s = supervisor.Supervisor(
+            target, 2, logger=mock.MagicMock(),
+            backoff={'initial': 30, 'max': 30})
+        s._spawn(0)
+        s._spawn(1)
+
+        def reaped():
+            s._reap()
+            return not s.children
+        assert wait_for(reaped)
+        assert s._restart_at[0] <= time.time()
+        assert s._restart_at[1] > time.time() + 20
+        s._restart_due()
+        assert len(s.children) == 1
+        assert wait_for(reaped)
+        assert self.runs(0) == 2
+
+    def test_signal_stops_restarts(self):
+        """
+        After a stop signal children are signalled and not restarted.
+        """
+        s = supervisor.Supervisor(
+            lambda slot: time.sleep(30), 2, logger=mock.MagicMock())
+        s._spawn(0)
+        s._spawn(1)
+        s._on_signal(15, None)
+
+        def reaped():
+            s._reap()
+            return not s.children
+        assert wait_for(reaped)
+        assert s._restart_at == {}
+
+    def test_signals_held_while_forking(self):
+        """
+        A stop signal arriving while forking should be held and delivered
+        once the parent's handlers are back.
+        """
+        s = supervisor.Supervisor(
+            lambda slot: None, 1, logger=mock.MagicMock())
+        handler = mock.MagicMock()
+        previous = signal.signal(signal.SIGTERM, handler)
+        try:
+            def fork():
+                assert signal.getsignal(signal.SIGTERM) == s._hold
+                s._hold(signal.SIGTERM, None)
+                return 4242
+            with nested(
+                    mock.patch('reworker.supervisor.os.fork', fork),
+                    mock.patch('reworker.supervisor.os.kill')) as (_, kill):
+                assert s._spawn(0) == 4242
+            assert signal.getsignal(signal.SIGTERM) is handler
+            kill.assert_called_once_with(os.getpid(), signal.SIGTERM)
+        finally:
+            signal.signal(signal.SIGTERM, previous)
+
+    @unittest.skipIf(
+        supervisor._block_signals([]) is None, 'signals can not be blocked')
+    def test_block_signals(self):
+        """
+        Signals sent while blocked should be delivered once restored.
+        """
+        received = []
+        previous = signal.signal(
+            signal.SIGTERM, lambda signum, frame: received.append(signum))
+        try:
+            mask = supervisor._block_signals([signal.SIGTERM])
+            os.kill(os.getpid(), signal.SIGTERM)
+            time.sleep(0.01)
+            assert received == []
+            supervisor._restore_signals(mask)
+            time.sleep(0.01)
+            assert received == [signal.SIGTERM]
+        finally:
+            signal.signal(signal.SIGTERM, previous)
+
+    def test_current_slot(self):
+        """
+        Children should know their slot.
+        """
+        assert supervisor.current_slot() is None
+        s = supervisor.Supervisor(
+            lambda slot: open(os.path.join(self.tmpdir, 'slot'), 'w').write(
+                str(supervisor.current_slot())),
+            2, logger=mock.MagicMock())
+        s._spawn(1)
+
+        def reaped():
+            s._reap()
+            return not s.children
+        assert wait_for(reaped)
+        assert open(os.path.join(self.tmpdir, 'slot')).read() == '1'
+
+    def test_pin_to_cpu(self):
+        """
+        Pinning should use whatever affinity API is available.
+        """
+        with mock.patch('reworker.supervisor.os') as os_mock:
+            os_mock.getpid.return_value = 1
+            assert supervisor.pin_to_cpu(0, mock.MagicMock()) is True
+            os_mock.sched_setaffinity.assert_called_once_with(0, set([0]))
+
+        os_mock = mock.MagicMock(spec=['getpid'])
+        os_mock.getpid.return_value = 1
+        with nested(
+                mock.patch('reworker.supervisor.os', os_mock),
+                mock.patch('reworker.supervisor.psutil')) as (_, psutil_mock):
+            assert supervisor.pin_to_cpu(1, mock.MagicMock()) is True
+            psutil_mock.Process().cpu_affinity.assert_called_once_with([1])